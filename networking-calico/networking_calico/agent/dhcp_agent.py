@@ -15,12 +15,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections.abc
+import json
 import logging
 import netaddr
 import os
-import re
 import socket
-import subprocess
 import sys
 import time
 
@@ -40,8 +40,13 @@ try:
 except ImportError:
     # Neutron code prior to 7f23ccc (15th March 2017).
     from neutron.agent.common import config
+from neutron_lib.utils import file as file_utils
 
 from networking_calico.agent.linux.dhcp import DnsmasqRouted
+from networking_calico.agent.linux.dhcp import get_running_dnsmasq
+from networking_calico.agent.linux.dhcp import network_fingerprint
+from networking_calico.agent.linux.dhcp import port_fingerprint
+from networking_calico.agent.linux import rtnetlink
 from networking_calico.common import config as calico_config
 from networking_calico.common import mkdir_p
 from networking_calico.compat import cfg
@@ -51,10 +56,10 @@ from networking_calico import datamodel_v1
 from networking_calico import datamodel_v2
 from networking_calico import datamodel_v3
 from networking_calico import etcdutils
+from networking_calico import etcdv3
 
 from etcd3gw.exceptions import Etcd3Exception
 
-from eventlet.event import Event
 from eventlet.queue import Empty
 from eventlet.queue import LightQueue
 
@@ -62,6 +67,26 @@ LOG = logging.getLogger(__name__)
 
 NETWORK_ID = 'calico'
 
+# ID of the network model that combines all of the local networks, when a
+# single Dnsmasq instance serves all of them.
+ALL_NETWORKS_ID = 'calico-all-networks'
+
+# In on-demand subnet mode, how often to poll etcd for changes to the subnets
+# that we have read, and the minimum time between reads of the whole subnet
+# tree.
+SUBNET_POLL_INTERVAL_SECS = 10
+
+# In on-demand subnet mode, the minimum time between reads for the same
+# subnet or network, when it wasn't found by the previous read.
+SUBNET_REREAD_INTERVAL_SECS = 1
+
+# Version of the format of the DHCP agent's state file.  A state file with
+# any other version is ignored.
+STATE_FILE_VERSION = 1
+
+# How often to save the DHCP agent's state, if it has changed.
+STATE_SAVE_INTERVAL_SECS = 5
+
 
 class FakePlugin(object):
     """Fake plugin class.
@@ -139,6 +164,33 @@ def copy_network(source_net):
                            "mtu": source_net.mtu})
 
 
+def combined_network(networks):
+    """Construct a network model that combines NETWORKS, for one Dnsmasq.
+
+    Each subnet keeps its own ID, and hence its own Dnsmasq tag, so DHCP
+    ranges and options are still per subnet.  The segment ID of each subnet
+    is set to the ID of its network, so that subnets only get routes to the
+    other subnets in the same network, and the MTU of each network is given
+    to its subnets by tag.
+    """
+    subnets = []
+    ports = []
+    subnet_mtus = {}
+    for net in networks:
+        for subnet in net.subnets:
+            subnets.append(dict(subnet, segment_id=net.id))
+            if subnet.ip_version == 4:
+                subnet_mtus[subnet.id] = net.mtu
+        ports.extend(port for port in net.ports
+                     if port.device_owner != constants.DEVICE_OWNER_DHCP)
+    return make_net_model({"id": ALL_NETWORKS_ID,
+                           "subnets": subnets,
+                           "ports": ports,
+                           "tenant_id": "calico",
+                           "mtu": 0,
+                           "subnet_mtus": subnet_mtus})
+
+
 def make_net_model(net_spec):
     try:
         net_model = dhcp.NetModel(False, net_spec)
@@ -166,8 +218,6 @@ class MTUWatcher(object):
         self.port_handler = port_handler
         self.mtu_by_if_name = {}
         self.port_id_by_if_name = {}
-        self.rx_up = re.compile('^[0-9]+: (tap[a-z0-9-]+).*:.* mtu ([0-9]+)')
-        self.rx_del = re.compile('Deleted [0-9]+: (tap[a-z0-9-]+)')
 
     def get_mtu(self, if_name):
         # Note, returns None if we haven't yet seen an MTU for the given
@@ -183,54 +233,39 @@ class MTUWatcher(object):
 
     def run(self):
         while True:
-            # Start 'ip monitor link' running on a separate thread.
-            running_event = Event()
-            exited_event = Event()
-            eventlet.spawn(self.process_command, ['ip', 'monitor', 'link'],
-                           running_event=running_event,
-                           exited_event=exited_event)
-
-            # Wait until we can be sure that 'ip monitor link' is really
-            # running (or has exited), and hence that we will see all
-            # further link transitions.
-            while not (running_event.ready() or exited_event.ready()):
-                # Create and delete a dummy interface.
-                os.system("ip link add calico-dhcp-dmy type dummy")
-                os.system("ip link del calico-dhcp-dmy type dummy")
-                time.sleep(0.5)
-
-            if not exited_event.ready():
-                # Now run 'ip link', to find MTU of all preexisting interfaces.
-                self.process_command(['ip', 'link'])
-
-            # Wait for the 'ip monitor link' thread to exit, so that we
-            # can then restart it.
-            exited_event.wait()
+            # Open a netlink socket that first reports all existing
+            # interfaces, and then every change to them.
+            try:
+                sock = rtnetlink.open_link_socket()
+            except (IOError, OSError):
+                LOG.exception("Failed to open netlink socket")
+                eventlet.sleep(1)
+                continue
+
+            # Process messages from it until it fails, for example because
+            # its receive buffer overflowed and hence we may have missed
+            # some changes.  Then open a new socket, which will report all
+            # interfaces again.
+            try:
+                while True:
+                    self.process_data(sock.recv(rtnetlink.RECV_BUFFER_SIZE))
+            except (IOError, OSError):
+                LOG.exception("Failed to read from netlink socket")
+            finally:
+                sock.close()
 
     # -----------------------------------------------------------------
     # Methods called from MTU watcher's own thread, or from agent thread.
     # -----------------------------------------------------------------
 
-    def process_command(self, command, running_event=None, exited_event=None):
-        process = subprocess.Popen(command, stdout=subprocess.PIPE)
-        while True:
-            line = process.stdout.readline()
-            if not line:
-                LOG.info("command %r exited", command)
-                break
-            if running_event:
-                running_event.send()
-                running_event = None
-            match_data = self.rx_up.match(line.decode('utf-8'))
-            if match_data:
-                self.record_mtu(match_data.group(1), int(match_data.group(2)))
+    def process_data(self, data):
+        for msg_type, if_name, mtu in rtnetlink.parse_link_messages(data):
+            if not if_name.startswith('tap'):
                 continue
-            match_data = self.rx_del.match(line.decode('utf-8'))
-            if match_data:
-                self.if_deleted(match_data.group(1))
-
-        if exited_event:
-            exited_event.send()
+            if msg_type == rtnetlink.RTM_DELLINK:
+                self.if_deleted(if_name)
+            elif mtu is not None:
+                self.record_mtu(if_name, mtu)
 
     def record_mtu(self, if_name, mtu):
         LOG.debug("MTU for %s is now %d", if_name, mtu)
@@ -258,68 +293,131 @@ class DnsmasqUpdater(object):
         # network ID.
         self._last_dnsmasq_ports = {}
 
+        # Networks that need updating, mapped to the time at which each
+        # first needed updating.
+        self._dirty_since = collections.OrderedDict()
+
+        # Networks that are being updated right now.
+        self._updating = set()
+
+        # Pool of threads for updating different networks in parallel.
+        self._pool = eventlet.GreenPool(
+            cfg.CONF.calico.dnsmasq_update_concurrency)
+
+        # When a single Dnsmasq instance serves all networks, updates for
+        # all networks are done together, as updates for ALL_NETWORKS_ID.
+        # Then these are the networks that might have changed since the last
+        # update, and the combined network model that Dnsmasq has now.
+        self.single_instance = cfg.CONF.calico.dnsmasq_single_instance
+        self._single_instance_network_ids = set()
+        self._single_instance_net = None
+
     def update_network(self, network_id):
         self.updates_needed.put(network_id)
 
+    def get_port_fingerprints(self, network_id):
+        """Get fingerprints of the ports that Dnsmasq has for NETWORK_ID."""
+        return self._last_dnsmasq_ports.get(network_id)
+
+    def adopt(self, network_id, port_fingerprints):
+        """Note that a running Dnsmasq already has PORT_FINGERPRINTS."""
+        self._last_dnsmasq_ports[network_id] = frozenset(port_fingerprints)
+
+    def get_single_instance_net(self):
+        """Get the combined network model that the single Dnsmasq has."""
+        return self._single_instance_net
+
+    def adopt_single_instance(self, net):
+        """Note that a running single Dnsmasq already has NET.
+
+        The fingerprints of the ports of each network that NET combines
+        should also be passed to adopt().
+        """
+        self._single_instance_net = net
+
     def start(self):
         while True:
             LOG.debug("DnsmasqUpdater: wait until updates needed")
-            dirty_network_ids = set()
-            dirty_network_ids.add(self.updates_needed.get())
+            self._mark_dirty(self.updates_needed.get())
             try:
                 while True:
-                    dirty_network_ids.add(self.updates_needed.get_nowait())
+                    self._mark_dirty(self.updates_needed.get_nowait())
             except Empty:
                 pass
-            LOG.debug("DnsmasqUpdater: updating now for %r", dirty_network_ids)
-            for network_id in dirty_network_ids:
-                # Handle any exceptions here so that the dnsmasq updater thread
-                # doesn't die.  There aren't any expected exception scenarios,
-                # but better to be more resilient here.
-                try:
-                    self.really_update_dnsmasq(network_id)
-                except Exception as e:
-                    LOG.exception("really_update_dnsmasq")
+            LOG.debug("DnsmasqUpdater: updating now for %r",
+                      list(self._dirty_since))
+            self._spawn_updates()
+
+    def _mark_dirty(self, network_id):
+        if self.single_instance and network_id != ALL_NETWORKS_ID:
+            self._single_instance_network_ids.add(network_id)
+            network_id = ALL_NETWORKS_ID
+        if network_id not in self._dirty_since:
+            self._dirty_since[network_id] = time.time()
+
+    def _spawn_updates(self):
+        # Start an update for each dirty network that isn't already being
+        # updated.  If a network is being updated, it stays dirty and we come
+        # back to it when its current update has finished, so that updates
+        # for the same network are never concurrent.  Spawning blocks while
+        # the pool is full.
+        for network_id in list(self._dirty_since):
+            if network_id in self._updating:
+                continue
+            dirty_since = self._dirty_since.pop(network_id)
+            self._updating.add(network_id)
+            self._pool.spawn_n(self._update_network_thread,
+                               network_id,
+                               dirty_since)
+
+    def _update_network_thread(self, network_id, dirty_since):
+        start_time = time.time()
+        try:
+            # Handle any exceptions here so that the dnsmasq updater thread
+            # doesn't die.  There aren't any expected exception scenarios, but
+            # better to be more resilient here.
+            self.really_update_dnsmasq(network_id)
+        except Exception:
+            LOG.exception("really_update_dnsmasq")
+        finally:
+            self._updating.discard(network_id)
+            end_time = time.time()
+            LOG.info("Dnsmasq update for network %s took %.3fs, "
+                     "%.3fs after the network needed updating",
+                     network_id, end_time - start_time,
+                     end_time - dirty_since)
+            if network_id in self._dirty_since:
+                # Network needed updating again while we were updating it.
+                # Wake up the main loop to handle that.
+                self.updates_needed.put(network_id)
 
     def really_update_dnsmasq(self, network_id):
+        if network_id == ALL_NETWORKS_ID:
+            self._update_single_instance()
+            return
+
         # Get NetModel for that network ID.
         net = self.agent.cache.get_network_by_id(network_id)
         LOG.debug("Net: %s", net)
-
-        # Compute the set of ports that we need Dnsmasq to handle for this
-        # network ID.
-        ports_needed = [
-            port for port in net.ports if port.device_id.startswith('tap')
-        ]
-        ports_needed.sort(key=lambda port: port.id)
-        for p in ports_needed:
-            LOG.debug("Port %s", p)
-            for edo in p.extra_dhcp_opts:
-                LOG.debug("DHCP option %s", edo)
-
-        # Compare a description of each needed port that includes all the
-        # information we care about, instead of just `p` (which is really just
-        # a pointer), so that we can spot when DHCP options change within the
-        # same port DictModel.
-        ports_needed_as_string = ''
-        for p in ports_needed:
-            ports_needed_as_string += ':' + p.device_id
-            for edo in p.extra_dhcp_opts:
-                ports_needed_as_string += ";" + edo.opt_name + "," + edo.opt_value + "," + str(edo.ip_version)
-            for fip in p.fixed_ips:
-                ports_needed_as_string += ";" + fip.ip_address
-        LOG.debug("Ports needed: %s", ports_needed_as_string)
+        ports_needed = _ports_needing_dnsmasq(net)
+        ports_needed_fingerprints = _port_fingerprints(ports_needed)
 
         # Compare that against what we've last asked Dnsmasq to handle.
-        if ports_needed_as_string != self._last_dnsmasq_ports.get(network_id):
+        last_fingerprints = self._last_dnsmasq_ports.get(network_id)
+        if ports_needed_fingerprints != last_fingerprints:
             # Requirements have changed, so start, restart or stop Dnsmasq for
             # that network ID.
-            LOG.info("old: %s", self._last_dnsmasq_ports.get(network_id))
-            LOG.info("new: %s", ports_needed_as_string)
+            last_fingerprints = last_fingerprints or frozenset()
+            LOG.info("Ports changed for network %s: %d new, %d old",
+                     network_id,
+                     len(ports_needed_fingerprints - last_fingerprints),
+                     len(last_fingerprints - ports_needed_fingerprints))
             if ports_needed:
-                LOG.info("Restart dnsmasq for network %s with %d port(s)",
+                # Dnsmasq is only restarted if its command line must change;
+                # otherwise it is told to reload its config files.
+                LOG.info("Update dnsmasq for network %s with %d port(s)",
                          network_id, len(ports_needed))
-                self.agent.call_driver('restart', net)
+                self.agent.call_driver('reload_or_restart', net)
             else:
                 # No ports left, so also remove this network from the cache.
                 _fix_network_cache_port_lookup(self.agent, net.id)
@@ -328,10 +426,87 @@ class DnsmasqUpdater(object):
                 self.agent.call_driver('disable', net)
 
             # Remember what we've asked Dnsmasq for.
-            self._last_dnsmasq_ports[network_id] = ports_needed_as_string
+            self._last_dnsmasq_ports[network_id] = ports_needed_fingerprints
         else:
             LOG.debug("No change")
 
+    def _update_single_instance(self):
+        """Update the single Dnsmasq instance that serves all networks."""
+        network_ids = self._single_instance_network_ids
+        self._single_instance_network_ids = set()
+        try:
+            changed_fingerprints = {}
+            for network_id in network_ids:
+                net = self.agent.cache.get_network_by_id(network_id)
+                LOG.debug("Net: %s", net)
+                ports_needed_fingerprints = _port_fingerprints(
+                    _ports_needing_dnsmasq(net))
+                if (ports_needed_fingerprints !=
+                        self._last_dnsmasq_ports.get(network_id)):
+                    LOG.info("Ports changed for network %s", network_id)
+                    changed_fingerprints[network_id] = (
+                        ports_needed_fingerprints)
+                    if net is not None and not ports_needed_fingerprints:
+                        # No ports left, so remove this network from the
+                        # cache.
+                        _fix_network_cache_port_lookup(self.agent, net.id)
+                        self.agent.cache.remove(net)
+            if not changed_fingerprints:
+                LOG.debug("No change")
+                return
+
+            networks = []
+            for network_id in self.agent.cache.get_network_ids():
+                net = self.agent.cache.get_network_by_id(network_id)
+                if _ports_needing_dnsmasq(net):
+                    networks.append(net)
+            net = combined_network(networks)
+            if networks:
+                # Keep the DHCP port that Dnsmasq set up before, instead of
+                # setting up a new one.
+                if self._single_instance_net is not None:
+                    net.ports.extend(
+                        port for port in self._single_instance_net.ports
+                        if port.device_owner == constants.DEVICE_OWNER_DHCP)
+                LOG.info("Update dnsmasq for %d network(s)", len(networks))
+                self.agent.call_driver('reload_or_restart', net)
+                self._single_instance_net = net
+            else:
+                LOG.info("Disable dnsmasq for all networks")
+                self.agent.call_driver('disable', net)
+                self._single_instance_net = None
+        except Exception:
+            # Check these networks again on the next update.
+            self._single_instance_network_ids |= network_ids
+            raise
+
+        # Remember what we've asked Dnsmasq for.
+        self._last_dnsmasq_ports.update(changed_fingerprints)
+
+
+def _ports_needing_dnsmasq(net):
+    """Return the ports in NET that Dnsmasq needs to handle, sorted by ID."""
+    if net is None:
+        return []
+    ports_needed = [
+        port for port in net.ports if port.device_id.startswith('tap')
+    ]
+    ports_needed.sort(key=lambda port: port.id)
+    for p in ports_needed:
+        LOG.debug("Port %s", p)
+        for edo in p.extra_dhcp_opts:
+            LOG.debug("DHCP option %s", edo)
+    return ports_needed
+
+
+def _port_fingerprints(ports):
+    # Compare a fingerprint of each needed port that covers all the
+    # information we care about, instead of just `p` (which is really just
+    # a pointer), so that we can spot when DHCP options change within the
+    # same port DictModel.
+    return frozenset(port_fingerprint(p) for p in ports)
+
+
 class CalicoEtcdWatcher(etcdutils.EtcdWatcher):
 
     def __init__(self, agent, hostname):
@@ -350,13 +525,26 @@ class CalicoEtcdWatcher(etcdutils.EtcdWatcher):
         self.hostname = hostname
         self.suppress_dnsmasq_updates = False
 
+        # While handling a batch of watch events, the IDs of the networks
+        # that need a Dnsmasq update at the end of the batch.
+        self.batch_network_ids = None
+
         # Register the etcd paths that we need to watch.
         self.register_path(workload_endpoint_prefix + "<name>",
                            on_set=self.on_endpoint_set,
                            on_del=self.on_endpoint_delete)
 
-        # Networks for which Dnsmasq needs updating.
-        self.dirty_networks = set()
+        # While processing a snapshot, the state of each network before the
+        # snapshot, and the IDs of the ports that the snapshot includes.
+        self.pre_snapshot_network_states = {}
+        self.snapshot_port_ids = None
+
+        # File in which to save our state, for a warm restart; and the etcd
+        # cluster ID and revision that our state corresponds to.
+        self.state_file = cfg.CONF.calico.dhcp_state_file
+        self.single_instance = cfg.CONF.calico.dnsmasq_single_instance
+        self.state_revision = None
+        self.state_changed = False
 
         # Use a separate thread for dnsmasq updating, so that we can
         # also trigger that for MTU changes.
@@ -383,8 +571,25 @@ class CalicoEtcdWatcher(etcdutils.EtcdWatcher):
         eventlet.spawn(self.mtu_watcher.run)
         eventlet.spawn(self.v1_subnet_watcher.start)
         eventlet.spawn(self.subnet_watcher.start)
+        if self.state_file:
+            eventlet.spawn(self._save_state_periodically)
         super(CalicoEtcdWatcher, self).start()
 
+    def handle_events(self, responses):
+        """Handle a batch of watch events.
+
+        Requests a Dnsmasq update once for each network that the batch has
+        changed, instead of once for each event.
+        """
+        self.batch_network_ids = set()
+        try:
+            super(CalicoEtcdWatcher, self).handle_events(responses)
+        finally:
+            network_ids = self.batch_network_ids
+            self.batch_network_ids = None
+            for network_id in network_ids:
+                self.dnsmasq_updater.update_network(network_id)
+
     def on_endpoint_set(self, response, name):
         """Handler for endpoint creations and updates.
 
@@ -536,6 +741,8 @@ class CalicoEtcdWatcher(etcdutils.EtcdWatcher):
 
         # Add this port into the NetModel.
         self.agent.cache.put_port(dhcp.DictModel(port))
+        if self.snapshot_port_ids is not None:
+            self.snapshot_port_ids.add(endpoint_id)
 
         # If we have seen the TAP interface, schedule updating Dnsmasq;
         # otherwise wait until we do see the TAP interface, whereupon
@@ -634,9 +841,15 @@ class CalicoEtcdWatcher(etcdutils.EtcdWatcher):
 
         # Check whether we should really do the following processing.
         if self.suppress_dnsmasq_updates:
+            # The end of the snapshot will update each network that has
+            # changed.
             LOG.debug("Don't update dnsmasq yet;"
                       " must be processing a snapshot")
-            self.dirty_networks.add(network_id)
+            return
+
+        if self.batch_network_ids is not None:
+            # The end of the batch will update this network.
+            self.batch_network_ids.add(network_id)
             return
 
         self.dnsmasq_updater.update_network(network_id)
@@ -668,14 +881,16 @@ class CalicoEtcdWatcher(etcdutils.EtcdWatcher):
     def _pre_snapshot_hook(self):
         """Called when a new snapshot is about to be read from etcdv3."""
 
-        # Add all current networks to the dirty set, so that we will stop their
-        # Dnsmasqs if no longer needed.  Also remove all port and subnet
-        # information.
-        LOG.debug("Reset cache for new snapshot")
-        for network_id in list(self.agent.cache.get_network_ids()):
-            self.dirty_networks.add(network_id)
-            _fix_network_cache_port_lookup(self.agent, network_id)
-            self.agent.cache.put(empty_network(network_id))
+        # Remember the current state of each network, so that after the
+        # snapshot we can update Dnsmasq only for the networks that have
+        # really changed.  The snapshot updates the existing cache in place,
+        # and we note which ports it includes, so that we can then remove
+        # the ports that it didn't include.
+        LOG.debug("Record cache state before new snapshot")
+        self.pre_snapshot_network_states = dict(
+            (network_id, self._network_state(network_id))
+            for network_id in self.agent.cache.get_network_ids())
+        self.snapshot_port_ids = set()
 
         # Suppress Dnsmasq updates until we've processed the whole snapshot.
         self.suppress_dnsmasq_updates = True
@@ -683,12 +898,210 @@ class CalicoEtcdWatcher(etcdutils.EtcdWatcher):
 
     def _post_snapshot_hook(self, _):
         LOG.debug("End of new snapshot")
+        self._remove_ports_not_in_snapshot()
+        self.snapshot_port_ids = None
 
-        # Now do Dnsmasq updates.
+        # Now do Dnsmasq updates, for the networks whose ports, subnets or
+        # other data have changed.
         self.suppress_dnsmasq_updates = False
-        for network_id in self.dirty_networks:
-            self._update_dnsmasq(network_id)
-        self.dirty_networks = set()
+        network_ids = (set(self.agent.cache.get_network_ids()) |
+                       set(self.pre_snapshot_network_states))
+        for network_id in network_ids:
+            if (self._network_state(network_id) !=
+                    self.pre_snapshot_network_states.get(network_id)):
+                self._update_dnsmasq(network_id)
+            else:
+                LOG.debug("Network %s unchanged by snapshot", network_id)
+        self.pre_snapshot_network_states = {}
+
+    def _new_revision_hook(self, cluster_id, revision):
+        self.state_revision = (cluster_id, revision)
+        self.state_changed = True
+
+    def _get_resume_point(self):
+        """Restore our state from the state file, if there is one."""
+        if not self.state_file:
+            return None
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            LOG.info("No state to restore from %s: %r", self.state_file, e)
+            return None
+        if not (isinstance(state, dict) and
+                state.get('version') == STATE_FILE_VERSION):
+            LOG.warning("Ignoring state file %s with unknown version",
+                        self.state_file)
+            return None
+
+        try:
+            nets = [(make_net_model(net_state['network']), net_state)
+                    for net_state in state['networks']]
+            resume_point = (state['cluster_id'], int(state['revision']))
+            single_state = state.get('single_instance') or {}
+            single_net = (make_net_model(single_state['network'])
+                          if single_state.get('network') else None)
+        except (KeyError, TypeError, ValueError):
+            LOG.exception("Invalid state file %s", self.state_file)
+            return None
+
+        for net, _ in nets:
+            LOG.info("Restore network %s with %d port(s)",
+                     net.id, len(net.ports))
+            _fix_network_cache_port_lookup(self.agent, net.id)
+            self.agent.cache.put(net)
+            for port in net.ports:
+                if port.device_owner != constants.DEVICE_OWNER_DHCP:
+                    self.local_endpoint_ids.add(port.id)
+                    self.mtu_watcher.watch_port(port.id, port.device_id)
+
+        # If Dnsmasq is still running, with the command line that it had
+        # when we saved our state, it still has the config for the ports
+        # that it had then; so we can keep it.  With a single Dnsmasq
+        # instance that is one Dnsmasq for all of the networks, under
+        # ALL_NETWORKS_ID; otherwise there is one for each network.
+        if self.single_instance:
+            pid, cmdline = get_running_dnsmasq(self.agent.conf,
+                                               ALL_NETWORKS_ID)
+            if (single_net is not None and cmdline and
+                    cmdline == single_state.get('dnsmasq_cmdline')):
+                LOG.info("Keep running Dnsmasq (PID %s) for all networks",
+                         pid)
+                for net, net_state in nets:
+                    if net_state.get('port_fingerprints') is not None:
+                        self.dnsmasq_updater.adopt(
+                            net.id, net_state['port_fingerprints'])
+                self.dnsmasq_updater.adopt_single_instance(single_net)
+                self.agent.call_driver('monitor_running_process',
+                                       single_net)
+        else:
+            for net, net_state in nets:
+                pid, cmdline = get_running_dnsmasq(self.agent.conf, net.id)
+                if (cmdline and
+                        cmdline == net_state.get('dnsmasq_cmdline') and
+                        net_state.get('port_fingerprints') is not None):
+                    LOG.info("Keep running Dnsmasq (PID %s) for network %s",
+                             pid, net.id)
+                    self.dnsmasq_updater.adopt(
+                        net.id, net_state['port_fingerprints'])
+                    self.agent.call_driver('monitor_running_process', net)
+
+        # Check whether Dnsmasq needs updating.  If we kept it and the ports
+        # haven't changed, this does nothing.
+        for net, _ in nets:
+            self._update_dnsmasq(net.id)
+
+        self.state_revision = resume_point
+        LOG.info("Restored state as at revision %s", resume_point[1])
+
+        # We may have saved our state when we had handled only some of the
+        # events at the saved revision - for example from a multi-key txn -
+        # so resume from that revision itself, not the one after it.
+        cluster_id, revision = resume_point
+        return cluster_id, revision - 1
+
+    def _save_state_periodically(self):
+        while True:
+            eventlet.sleep(STATE_SAVE_INTERVAL_SECS)
+            # Don't save while a snapshot is being processed, because then
+            # our cache is between two revisions.
+            if not self.state_changed or self.snapshot_port_ids is not None:
+                continue
+            self.state_changed = False
+            try:
+                self._save_state()
+            except Exception:
+                LOG.exception("Failed to save state to %s", self.state_file)
+                self.state_changed = True
+
+    def _save_state(self):
+        """Save our state to the state file.
+
+        The cache may be a little ahead of the revision that we save, if
+        we are part way through handling some events, or may not yet have
+        all of the events at that revision.  That is fine because, after a
+        restart, we handle events again from the saved revision itself, and
+        handling an event again has no further effect.
+        """
+        cluster_id, revision = self.state_revision
+        networks = []
+        for network_id in list(self.agent.cache.get_network_ids()):
+            net = self.agent.cache.get_network_by_id(network_id)
+            fingerprints = self.dnsmasq_updater.get_port_fingerprints(
+                network_id)
+            pid, cmdline = get_running_dnsmasq(self.agent.conf, network_id)
+            networks.append({
+                'network': _to_primitive(net),
+                'port_fingerprints': (sorted(fingerprints)
+                                      if fingerprints is not None else None),
+                'dnsmasq_pid': pid,
+                'dnsmasq_cmdline': cmdline,
+            })
+        state = {
+            'version': STATE_FILE_VERSION,
+            'cluster_id': cluster_id,
+            'revision': revision,
+            'networks': networks,
+        }
+        if self.single_instance:
+            net = self.dnsmasq_updater.get_single_instance_net()
+            pid, cmdline = get_running_dnsmasq(self.agent.conf,
+                                               ALL_NETWORKS_ID)
+            state['single_instance'] = {
+                'network': _to_primitive(net) if net is not None else None,
+                'dnsmasq_pid': pid,
+                'dnsmasq_cmdline': cmdline,
+            }
+        file_utils.replace_file(self.state_file, json.dumps(state))
+        LOG.debug("Saved state as at revision %s", revision)
+
+    def _remove_ports_not_in_snapshot(self):
+        """Remove cached ports and subnets that the snapshot didn't include."""
+        for network_id in list(self.agent.cache.get_network_ids()):
+            net = self.agent.cache.get_network_by_id(network_id)
+            for port in list(net.ports):
+                if port.device_owner == constants.DEVICE_OWNER_DHCP:
+                    continue
+                if port.id not in self.snapshot_port_ids:
+                    LOG.info("Port %s not in snapshot", port.id)
+                    self.local_endpoint_ids.discard(port.id)
+                    self.mtu_watcher.unwatch_port(port.id, port.device_id)
+                    self.agent.cache.remove_port(port)
+
+            # Remove subnets that are no longer used by any port.
+            net = self.agent.cache.get_network_by_id(network_id)
+            used_subnet_ids = set(
+                fixed_ip.subnet_id
+                for port in net.ports
+                if port.device_owner != constants.DEVICE_OWNER_DHCP
+                for fixed_ip in port.fixed_ips)
+            if any(s.id not in used_subnet_ids for s in net.subnets):
+                net = copy_network(net)
+                net.subnets = [s for s in net.subnets
+                               if s.id in used_subnet_ids]
+                _fix_network_cache_port_lookup(self.agent, network_id)
+                self.agent.cache.put(net)
+
+    def _network_state(self, network_id):
+        """Return a summary of the cached data for NETWORK_ID.
+
+        This is None if the network isn't in the cache, and otherwise
+        changes whenever anything changes that Dnsmasq config depends on.
+        """
+        net = self.agent.cache.get_network_by_id(network_id)
+        if net is None:
+            return None
+        return (network_fingerprint(net),
+                frozenset(port_fingerprint(p) for p in net.ports))
+
+
+def _to_primitive(value):
+    """Convert a NetModel, or part of one, to plain dicts and lists."""
+    if isinstance(value, collections.abc.Mapping):
+        return dict((k, _to_primitive(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_to_primitive(v) for v in value]
+    return value
 
 
 def _fix_network_cache_port_lookup(agent, network_id):
@@ -719,6 +1132,75 @@ class SubnetIDNotFound(Exception):
     pass
 
 
+class CidrIndex(object):
+    """Longest prefix match index from CIDRs to subnet IDs.
+
+    For each IP version and prefix length in use, we keep a dict from the
+    integer value of each CIDR's network address to the IDs of the subnets
+    with that CIDR.  A lookup masks the address to each prefix length in
+    use, longest first, so it costs at most one dict lookup per possible
+    prefix length.
+    """
+
+    def __init__(self):
+        # Map from (IP version, prefix length, network address as int) to an
+        # ordered set of subnet IDs.
+        self._subnet_ids = {}
+        # For each IP version, the number of CIDRs with each prefix length.
+        self._prefix_len_counts = {4: collections.Counter(),
+                                   6: collections.Counter()}
+        # For each IP version, the prefix lengths in use, longest first.
+        self._prefix_lens = {4: [], 6: []}
+
+    def __len__(self):
+        return len(self._subnet_ids)
+
+    def add(self, cidr, subnet_id):
+        key = self._key(cidr)
+        subnet_ids = self._subnet_ids.setdefault(key,
+                                                 collections.OrderedDict())
+        if subnet_id in subnet_ids:
+            return
+        subnet_ids[subnet_id] = True
+        self._update_prefix_lens(key, 1)
+
+    def remove(self, cidr, subnet_id):
+        key = self._key(cidr)
+        subnet_ids = self._subnet_ids.get(key)
+        if not subnet_ids or subnet_id not in subnet_ids:
+            return
+        del subnet_ids[subnet_id]
+        if not subnet_ids:
+            del self._subnet_ids[key]
+        self._update_prefix_lens(key, -1)
+
+    def lookup(self, ip_addr):
+        """Return the ID of the most specific subnet containing IP_ADDR."""
+        version = ip_addr.version
+        width = 32 if version == 4 else 128
+        value = int(ip_addr)
+        for prefix_len in self._prefix_lens[version]:
+            mask = ((1 << width) - 1) ^ ((1 << (width - prefix_len)) - 1)
+            subnet_ids = self._subnet_ids.get(
+                (version, prefix_len, value & mask))
+            if subnet_ids:
+                return next(iter(subnet_ids))
+        return None
+
+    @staticmethod
+    def _key(cidr):
+        net = netaddr.IPNetwork(cidr)
+        return (net.version, net.prefixlen, net.first)
+
+    def _update_prefix_lens(self, key, delta):
+        version, prefix_len, _ = key
+        counts = self._prefix_len_counts[version]
+        counts[prefix_len] += delta
+        if counts[prefix_len] <= 0:
+            del counts[prefix_len]
+        self._prefix_lens[version] = sorted(counts, reverse=True)
+
+
 class SubnetWatcher(etcdutils.EtcdWatcher):
 
     def __init__(self, endpoint_watcher, path):
@@ -729,10 +1211,38 @@ class SubnetWatcher(etcdutils.EtcdWatcher):
                            on_del=self.on_subnet_del)
         self.subnets_by_id = {}
 
+        # In on-demand mode, we don't watch the whole subnet tree, but
+        # instead read subnets when the agent first needs them, then poll
+        # for changes to the subnets that we have read.
+        self.on_demand = cfg.CONF.calico.subnets_on_demand
+
+        # Events for the reads that are in progress in on-demand mode,
+        # indexed by what they are reading, so that concurrent requests for
+        # the same data share a single read.
+        self._reads_in_progress = {}
+
+        # Times of the last on-demand reads for each subnet ID or network ID,
+        # and of the whole subnet tree, so that we don't keep re-reading data
+        # that isn't there.
+        self._last_read_time = {}
+
+        # The IDs of the subnets for each network ID, as at our last read of
+        # the whole subnet tree.  Subnets without a network ID are under
+        # None.
+        self._subnet_ids_by_network_id = {}
+
+        # Indexes from CIDR to subnet ID: for each network ID, and for all
+        # networks together.
+        self.cidr_index_by_network_id = collections.defaultdict(CidrIndex)
+        self.cidr_index = CidrIndex()
+
     def start(self):
         # Catch and report any exceptions that escape here.
         try:
-            super(SubnetWatcher, self).start()
+            if self.on_demand:
+                self._poll_subnets()
+            else:
+                super(SubnetWatcher, self).start()
         except Etcd3Exception as e3e:
             LOG.exception("Etcd3Exception in SubnetWatcher.start():\n%s",
                           e3e.detail_text)
@@ -745,6 +1255,136 @@ class SubnetWatcher(etcdutils.EtcdWatcher):
             # exit.
             self.endpoint_watcher.stop()
 
+    def _poll_subnets(self):
+        """Keep the subnets that we have read on demand up to date."""
+        LOG.info("Poll for changes to subnets under %s", self.prefix)
+        self._stopped = False
+        last_revision = None
+        while not self._stopped:
+            eventlet.sleep(SUBNET_POLL_INTERVAL_SECS)
+            try:
+                _, revision = etcdv3.get_status()
+                if revision == last_revision:
+                    # Nothing at all has changed in etcd.
+                    continue
+                self._forget_unused_subnets()
+                for subnet_id in list(self.subnets_by_id):
+                    self._read_subnet(subnet_id)
+                last_revision = revision
+            except Etcd3Exception as e3e:
+                LOG.warning("Failed to poll subnets under %s: %s",
+                            self.prefix, e3e.detail_text)
+
+    def _forget_unused_subnets(self):
+        network_ids = set(
+            self.endpoint_watcher.agent.cache.get_network_ids())
+        for subnet_id, subnet_data in list(self.subnets_by_id.items()):
+            if subnet_data.get('network_id', NETWORK_ID) not in network_ids:
+                LOG.debug("Forget unused subnet %s", subnet_id)
+                self._unindex_subnet(subnet_id)
+                del self.subnets_by_id[subnet_id]
+
+    def _read_once(self, read_id, read_fn):
+        """Call READ_FN, unless a read for READ_ID is already in progress.
+
+        If one is, wait for that read to finish instead.
+        """
+        event = self._reads_in_progress.get(read_id)
+        if event is not None:
+            event.wait()
+            return
+        event = eventlet.Event()
+        self._reads_in_progress[read_id] = event
+        try:
+            read_fn()
+        finally:
+            self._last_read_time[read_id] = time.time()
+            del self._reads_in_progress[read_id]
+            event.send()
+
+    def _read_recently(self, read_id):
+        last_read_time = self._last_read_time.get(read_id)
+        return (last_read_time is not None and
+                time.time() - last_read_time < SUBNET_REREAD_INTERVAL_SECS)
+
+    def _read_subnet(self, subnet_id):
+        """Read one subnet from etcd, and update our cache with it."""
+        def read():
+            key = self.prefix + "/" + subnet_id
+            try:
+                value, mod_revision = etcdv3.get(key)
+            except etcdv3.KeyNotFound:
+                self.on_subnet_del(None, subnet_id)
+                return
+            self.on_subnet_set(
+                etcdutils.Response(action='set',
+                                   key=key,
+                                   value=value,
+                                   mod_revision=mod_revision),
+                subnet_id)
+        self._read_once(('subnet', subnet_id), read)
+
+    def _read_network_subnets(self, network_id, ip_addr):
+        """Read and cache the subnets that belong to NETWORK_ID.
+
+        Subnets are keyed only by subnet ID, so finding the subnets for a
+        network means reading all of them.  We normally do that at most once
+        per SUBNET_POLL_INTERVAL_SECS, keeping the data for NETWORK_ID and
+        just the subnet IDs for other networks; in between, we read the
+        subnets that another network needs one by one.  If that doesn't find
+        a subnet for IP_ADDR - for example because the subnet was created
+        after our last read of the tree - we read the tree again, at most
+        once per SUBNET_REREAD_INTERVAL_SECS.  NETWORK_ID None means the
+        subnets that have no network ID.
+        """
+        def read_tree():
+            self._read_once('tree',
+                            lambda: self._read_subnet_tree(network_id))
+            self._read_known_subnets(network_id)
+
+        def read():
+            tree_last_read = self._last_read_time.get('tree')
+            if (tree_last_read is None or
+                    time.time() - tree_last_read >=
+                    SUBNET_POLL_INTERVAL_SECS):
+                read_tree()
+            else:
+                self._read_known_subnets(network_id)
+                if (self._lookup_subnet_id(ip_addr, network_id) is None and
+                        not self._read_recently('tree')):
+                    read_tree()
+        self._read_once(('network', network_id), read)
+
+    def _read_known_subnets(self, network_id):
+        """Read the subnets of NETWORK_ID that our last tree read found."""
+        subnet_ids = self._subnet_ids_by_network_id.get(network_id, [])
+        if not subnet_ids:
+            LOG.debug("No subnets for network %s", network_id)
+        for subnet_id in subnet_ids:
+            if subnet_id not in self.subnets_by_id:
+                self._read_subnet(subnet_id)
+
+    def _read_subnet_tree(self, network_id):
+        """Read the whole subnet tree, and cache the subnets for NETWORK_ID.
+
+        Also records the IDs of the subnets for every network.
+        """
+        subnet_ids_by_network_id = collections.defaultdict(list)
+        for key, value, mod_revision in etcdv3.get_prefix(self.prefix + "/"):
+            subnet_id = key[len(self.prefix) + 1:]
+            subnet_data = etcdutils.safe_decode_json(value, 'subnet')
+            subnet_network_id = (subnet_data.get('network_id')
+                                 if isinstance(subnet_data, dict) else None)
+            subnet_ids_by_network_id[subnet_network_id].append(subnet_id)
+            if subnet_network_id == network_id:
+                self.on_subnet_set(
+                    etcdutils.Response(action='set',
+                                       key=key,
+                                       value=value,
+                                       mod_revision=mod_revision),
+                    subnet_id)
+        self._subnet_ids_by_network_id = subnet_ids_by_network_id
+
     def on_subnet_set(self, response, subnet_id):
         """Handler for subnet creations and updates."""
         LOG.debug("Subnet %s created or updated", subnet_id)
@@ -760,31 +1400,73 @@ class SubnetWatcher(etcdutils.EtcdWatcher):
             LOG.warning("Invalid subnet data: %s", subnet_data)
             return
 
+        try:
+            netaddr.IPNetwork(subnet_data['cidr'])
+        except (netaddr.AddrFormatError, TypeError, ValueError):
+            LOG.warning("Invalid subnet CIDR: %s", subnet_data)
+            return
+
+        self._unindex_subnet(subnet_id)
         self.subnets_by_id[subnet_id] = subnet_data
+        self._index_subnet(subnet_id)
         return
 
     def on_subnet_del(self, response, subnet_id):
         """Handler for subnet deletions."""
         LOG.info("Subnet %s deleted", subnet_id)
         if subnet_id in self.subnets_by_id:
+            self._unindex_subnet(subnet_id)
             del self.subnets_by_id[subnet_id]
         return
 
+    def _index_subnet(self, subnet_id):
+        subnet_data = self.subnets_by_id[subnet_id]
+        cidr = subnet_data['cidr']
+        self.cidr_index.add(cidr, subnet_id)
+        network_id = subnet_data.get('network_id')
+        if network_id:
+            self.cidr_index_by_network_id[network_id].add(cidr, subnet_id)
+
+    def _unindex_subnet(self, subnet_id):
+        subnet_data = self.subnets_by_id.get(subnet_id)
+        if subnet_data is None:
+            return
+        cidr = subnet_data['cidr']
+        self.cidr_index.remove(cidr, subnet_id)
+        network_id = subnet_data.get('network_id')
+        if network_id in self.cidr_index_by_network_id:
+            index = self.cidr_index_by_network_id[network_id]
+            index.remove(cidr, subnet_id)
+            if not index:
+                del self.cidr_index_by_network_id[network_id]
+
     def get_subnet_id_for_addr(self, ip_str, network_id):
         ip_addr = netaddr.IPAddress(ip_str)
-        for subnet_id, subnet_data in self.subnets_by_id.items():
-            # If we know we're looking within a given Neutron network, only
-            # consider this subnet if it belongs to that network.
-            if network_id and subnet_data['network_id'] != network_id:
-                continue
-            if ip_addr in netaddr.IPNetwork(subnet_data['cidr']):
-                return subnet_id
-        return None
+        subnet_id = self._lookup_subnet_id(ip_addr, network_id)
+        if (subnet_id is None and self.on_demand and
+                not self._read_recently(('network', network_id))):
+            self._read_network_subnets(network_id, ip_addr)
+            subnet_id = self._lookup_subnet_id(ip_addr, network_id)
+        return subnet_id
+
+    def _lookup_subnet_id(self, ip_addr, network_id):
+        if not network_id:
+            return self.cidr_index.lookup(ip_addr)
+        # If we know we're looking within a given Neutron network, only
+        # consider subnets that belong to that network.
+        index = self.cidr_index_by_network_id.get(network_id)
+        if index is None:
+            return None
+        return index.lookup(ip_addr)
 
     def get_subnet(self, subnet_id):
         """Get data for the specified subnet."""
         LOG.debug("Get subnet %s", subnet_id)
 
+        if (subnet_id not in self.subnets_by_id and self.on_demand and
+                not self._read_recently(('subnet', subnet_id))):
+            self._read_subnet(subnet_id)
+
         if subnet_id not in self.subnets_by_id:
             return None
 
@@ -891,7 +1573,8 @@ def setup_logging():
 
 def main():
     register_options(cfg.CONF)
-    calico_config.register_options(cfg.CONF)
+    calico_config.register_options(
+        cfg.CONF, additional_options=calico_config.DHCP_AGENT_OPTS)
     common_config.init(sys.argv[1:])
     setup_logging()
     try:
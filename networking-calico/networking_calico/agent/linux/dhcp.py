@@ -13,7 +13,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections.abc
 import copy
+import hashlib
 import netaddr
 import os
 import re
@@ -21,12 +23,17 @@ import sys
 import time
 
 from neutron.agent.linux import dhcp
+from neutron_lib.utils import file as file_utils
 from oslo_log import log as logging
 
 from networking_calico.compat import constants
 
 LOG = logging.getLogger(__name__)
 
+# Generated Dnsmasq config, indexed by network ID.  Driver instances are
+# created afresh for each operation, so this has to live at module level.
+_network_configs = {}
+
 
 class DnsmasqRouted(dhcp.Dnsmasq):
     """Dnsmasq DHCP driver for routed virtual interfaces."""
@@ -200,8 +207,137 @@ class DnsmasqRouted(dhcp.Dnsmasq):
         if bridge_ports_added:
             cmd.append(bridge_option)
 
+        # A network model that combines several networks has an MTU for each
+        # IPv4 subnet, instead of one MTU for the whole network.
+        subnet_mtus = getattr(self.network, 'subnet_mtus', None)
+        if isinstance(subnet_mtus, collections.abc.Mapping):
+            for subnet_id, mtu in sorted(subnet_mtus.items()):
+                if mtu > 0:
+                    cmd.append('--dhcp-option-force=tag:%s,option:mtu,%d' %
+                               (self._SUBNET_TAG_PREFIX % subnet_id, mtu))
+
         return cmd
 
+    def reload_or_restart(self):
+        """Apply the current NetModel, restarting Dnsmasq only if needed.
+
+        Dnsmasq re-reads its host, addn_hosts and opts files on SIGHUP, so
+        when the running process already has the command line that we
+        would give it now, we just rewrite those files and signal it.
+        Otherwise - for example because the set of TAP interfaces, the
+        subnets or the DHCP ranges have changed - we do a full restart.
+        """
+        pm = self._get_process_manager()
+        running_cmd = _get_cmdline_from_pid(pm.pid) if pm.active else None
+        wanted_cmd = self._build_cmdline_callback(pm.get_pid_file_name())
+        if (running_cmd and
+                _cmdline_args(running_cmd) == _cmdline_args(wanted_cmd)):
+            LOG.debug('Reload dnsmasq for network %s', self.network.id)
+            self.reload_allocations()
+        else:
+            LOG.debug('Restart dnsmasq for network %s', self.network.id)
+            self.restart()
+
+    def monitor_running_process(self):
+        """Monitor a Dnsmasq that is already running for this network.
+
+        For a Dnsmasq that a previous run of the agent started, so that it
+        is respawned if it dies, as for one that we spawn ourselves.
+        """
+        pm = self._get_process_manager(
+            cmd_callback=self._build_cmdline_callback)
+        self.process_monitor.register(uuid=pm.uuid,
+                                      service_name=dhcp.DNSMASQ_SERVICE_NAME,
+                                      monitored_process=pm)
+
+    def disable(self, retain_port=False, *args, **kwargs):
+        if not retain_port:
+            _network_configs.pop(self.network.id, None)
+        super(DnsmasqRouted, self).disable(retain_port, *args, **kwargs)
+
+    def _output_config_files(self):
+        """Write the host, addn_hosts and opts files for this network.
+
+        The lines for each port are cached, together with a fingerprint of
+        the port, so that we only regenerate lines for ports that have
+        changed since we last wrote the files.  A change to the network
+        itself (e.g. to its subnets) invalidates the whole cache.
+        """
+        net_fingerprint = network_fingerprint(self.network)
+        config = _network_configs.get(self.network.id)
+        if config is None or config.fingerprint != net_fingerprint:
+            config = _NetworkConfig(net_fingerprint)
+            _network_configs[self.network.id] = config
+
+        opts, subnet_index_map = self._generate_opts_per_subnet()
+        port_lines = collections.OrderedDict()
+        dhcp_ports = []
+        num_changed = 0
+        for port in self.network.ports:
+            if port.device_owner == constants.DEVICE_OWNER_DHCP:
+                # Options for DHCP ports depend on the other DHCP ports, so
+                # we generate those together below.
+                dhcp_ports.append(port)
+                continue
+            fingerprint = port_fingerprint(port)
+            lines = config.port_lines.get(port.id)
+            if lines is None or lines.fingerprint != fingerprint:
+                lines = self._generate_port_lines(port, fingerprint,
+                                                  subnet_index_map)
+                num_changed += 1
+            port_lines[port.id] = lines
+        changed = (num_changed or
+                   list(port_lines) != list(config.port_lines))
+        config.port_lines = port_lines
+        LOG.debug('Regenerated config for %d of %d port(s) on network %s',
+                  num_changed, len(port_lines), self.network.id)
+
+        with self._restricted_to_ports(dhcp_ports):
+            dhcp_port_opts = self._generate_opts_per_port(subnet_index_map)
+        opts += [opt for lines in port_lines.values() for opt in lines.opts]
+        opts += dhcp_port_opts
+        opts_data = '\n'.join(opts)
+        if opts_data != config.opts_data:
+            changed = True
+            config.opts_data = opts_data
+
+        for kind, data in [
+                ('host', ''.join(lines.host
+                                 for lines in port_lines.values())),
+                ('addn_hosts', ''.join(lines.addn_hosts
+                                       for lines in port_lines.values())),
+                ('opts', opts_data),
+        ]:
+            file_name = self.get_conf_file_name(kind)
+            if changed or not os.path.exists(file_name):
+                file_utils.replace_file(file_name, data)
+
+    def _generate_port_lines(self, port, fingerprint, subnet_index_map):
+        """Generate the host, addn_hosts and opts lines for PORT."""
+        with self._restricted_to_ports([port]):
+            host = self._capture_conf_file('host', self._output_hosts_file)
+            addn_hosts = self._capture_conf_file('addn_hosts',
+                                                 self._output_addn_hosts_file)
+            opts = self._generate_opts_per_port(subnet_index_map)
+        return _PortLines(fingerprint, host, addn_hosts, opts)
+
+    def _capture_conf_file(self, kind, output_fn):
+        """Call Neutron's OUTPUT_FN and return what it writes for KIND.
+
+        The data is kept in memory instead of being written to the file.
+        """
+        file_name = self.get_conf_file_name(kind)
+        _capturing_file_utils.captured[file_name] = None
+        try:
+            output_fn()
+            return _capturing_file_utils.captured[file_name]
+        finally:
+            del _capturing_file_utils.captured[file_name]
+
+    def _restricted_to_ports(self, ports):
+        """Context in which self.network only has PORTS."""
+        return _NetworkRestriction(self, ports)
+
     def _destroy_namespace_and_port(self):
         try:
             self.device_manager.destroy(self.network, self.interface_name)
@@ -210,6 +346,138 @@ class DnsmasqRouted(dhcp.Dnsmasq):
                         self.interface_name)
 
 
+class _NetworkConfig(object):
+    """Generated Dnsmasq config for a network."""
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        # _PortLines for each non-DHCP port, indexed by port ID.
+        self.port_lines = collections.OrderedDict()
+        self.opts_data = None
+
+
+_PortLines = collections.namedtuple(
+    '_PortLines', ['fingerprint', 'host', 'addn_hosts', 'opts'])
+
+
+class _NetworkRestriction(object):
+    """Context manager that narrows a driver's network to some ports."""
+
+    def __init__(self, driver, ports):
+        self.driver = driver
+        self.ports = ports
+        self.network = None
+
+    def __enter__(self):
+        self.network = self.driver.network
+        self.driver.network = _PortSubsetNetwork(self.network, self.ports)
+
+    def __exit__(self, *exc_info):
+        self.driver.network = self.network
+
+
+class _PortSubsetNetwork(object):
+    """View of a NetModel that only has some of its ports."""
+
+    def __init__(self, network, ports):
+        self._network = network
+        self.ports = ports
+
+    def __getattr__(self, name):
+        return getattr(self._network, name)
+
+
+def _canonical(value):
+    """Return a hashable, order-independent form of a NetModel value."""
+    if isinstance(value, collections.abc.Mapping):
+        return tuple(sorted((k, _canonical(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonical(v) for v in value)
+    return value
+
+
+def _fingerprint(value):
+    return hashlib.sha1(repr(_canonical(value)).encode()).hexdigest()
+
+
+def port_fingerprint(port):
+    """Return a fingerprint of all the data for PORT.
+
+    Two ports with the same fingerprint generate the same Dnsmasq config.
+    """
+    return _fingerprint(port)
+
+
+def network_fingerprint(network):
+    """Return a fingerprint of the non-port data for NETWORK."""
+    return _fingerprint(dict((k, v) for k, v in network.items()
+                             if k != 'ports'))
+
+
+class _CapturingFileUtils(object):
+    """Stand-in for neutron_lib's file utils in Neutron's DHCP module.
+
+    Keeps the data that Neutron writes to the file names in 'captured' in
+    memory, instead of writing it to those files, so that we can use
+    Neutron's code for generating Dnsmasq config for one port at a time.
+    Other files are written as normal.
+    """
+
+    def __init__(self):
+        self.captured = {}
+
+    def replace_file(self, file_name, data, *args, **kwargs):
+        if file_name in self.captured:
+            self.captured[file_name] = data
+        else:
+            file_utils.replace_file(file_name, data, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(file_utils, name)
+
+
+_capturing_file_utils = _CapturingFileUtils()
+dhcp.file_utils = _capturing_file_utils
+
+
+def get_running_dnsmasq(conf, network_id):
+    """Find the Dnsmasq process, if any, for NETWORK_ID.
+
+    Returns (pid, cmdline), where cmdline is the process's command line as
+    a list, or (None, None) if Dnsmasq isn't running for that network.
+    """
+    pid_file = os.path.join(conf.dhcp_confs, network_id, 'pid')
+    try:
+        with open(pid_file, 'r') as f:
+            pid = int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None, None
+    cmdline = _get_cmdline_from_pid(pid)
+    if not cmdline:
+        return None, None
+    return pid, cmdline
+
+
+def _get_cmdline_from_pid(pid):
+    """Return the command line of process PID as a list, or None."""
+    if pid is None:
+        return None
+    try:
+        with open('/proc/%s/cmdline' % pid, 'r') as f:
+            return f.read().split('\0')
+    except (IOError, OSError):
+        return None
+
+
+def _cmdline_args(cmd):
+    """Return the arguments of CMD that affect Dnsmasq's behaviour.
+
+    Skips the program name, which may or may not include a path, and any
+    empty arguments.
+    """
+    return [arg for arg in cmd[1:] if arg]
+
+
 class CalicoDeviceManager(dhcp.DeviceManager):
     """Device manager for the default namespace that Calico operates in."""
 
@@ -0,0 +1,122 @@
+# Copyright (c) 2026 Tigera, Inc. All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Minimal rtnetlink client for following Linux interface changes.
+
+This provides just enough of rtnetlink to list all network interfaces and
+then be notified of interface changes, with the name and MTU of each
+interface, without running any 'ip' subprocesses.
+"""
+
+import socket
+import struct
+
+from networking_calico.compat import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+# Netlink constants, from linux/netlink.h and linux/rtnetlink.h.
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+NLMSG_ERROR = 0x2
+NLMSG_DONE = 0x3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+
+# struct nlmsghdr: length, type, flags, sequence number, port ID.
+_NLMSGHDR = struct.Struct('=IHHII')
+# struct ifinfomsg: family, pad, type, index, flags, change.
+_IFINFOMSG = struct.Struct('=BxHiII')
+# struct rtattr: length, type.
+_RTATTR = struct.Struct('=HH')
+
+# Big enough for any single netlink datagram that the kernel sends us.
+RECV_BUFFER_SIZE = 1 << 17
+
+# Socket receive buffer to request, so that a burst of interface changes
+# is less likely to overflow it.
+SOCKET_RCVBUF_SIZE = 1 << 20
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def open_link_socket():
+    """Open a netlink socket that reports all interfaces and their changes.
+
+    The socket is subscribed to link notifications before requesting a dump
+    of all existing links, so that no change can be missed between the two.
+    """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                        SOCKET_RCVBUF_SIZE)
+        sock.bind((0, RTMGRP_LINK))
+        request = _IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        sock.send(_NLMSGHDR.pack(_NLMSGHDR.size + len(request),
+                                 RTM_GETLINK,
+                                 NLM_F_REQUEST | NLM_F_DUMP,
+                                 1,
+                                 0) + request)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def parse_link_messages(data):
+    """Parse a netlink datagram from a socket opened by open_link_socket.
+
+    Yields (msg_type, if_name, mtu) for each RTM_NEWLINK or RTM_DELLINK
+    message.  mtu is None if the message did not include an MTU.
+    """
+    offset = 0
+    while offset + _NLMSGHDR.size <= len(data):
+        msg_len, msg_type, _, _, _ = _NLMSGHDR.unpack_from(data, offset)
+        if msg_len < _NLMSGHDR.size:
+            LOG.warning("Bad netlink message length %d", msg_len)
+            return
+        if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+            if_name, mtu = _parse_link_attrs(
+                data,
+                offset + _NLMSGHDR.size + _IFINFOMSG.size,
+                offset + msg_len)
+            if if_name is not None:
+                yield msg_type, if_name, mtu
+        elif msg_type == NLMSG_ERROR:
+            LOG.warning("Netlink error message received")
+        offset += _align(msg_len)
+
+
+def _parse_link_attrs(data, offset, end):
+    if_name = None
+    mtu = None
+    while offset + _RTATTR.size <= end:
+        attr_len, attr_type = _RTATTR.unpack_from(data, offset)
+        if attr_len < _RTATTR.size:
+            break
+        value = data[offset + _RTATTR.size:offset + attr_len]
+        if attr_type == IFLA_IFNAME:
+            if_name = value.split(b'\0', 1)[0].decode('utf-8')
+        elif attr_type == IFLA_MTU:
+            mtu, = struct.unpack('=I', value[:4])
+        offset += _align(attr_len)
+    return if_name, mtu
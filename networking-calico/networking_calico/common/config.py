@@ -44,12 +44,52 @@ SHARED_OPTS = [
     # default of 60 seconds here as opposed to something much shorter.
     cfg.IntOpt('etcd_timeout', default=60,
                help="Timeout (in seconds) for etcd requests."),
+    cfg.IntOpt('etcd_read_parallelism', default=1, min=1,
+               help="The number of concurrent requests to use when reading "
+                    "all of the etcd data under a prefix, for example when "
+                    "taking a snapshot.  The default of 1 means that such "
+                    "reads are done serially."),
+    cfg.IntOpt('etcd_read_chunk_bytes', default=1024 * 1024, min=1024,
+               help="The approximate size in bytes to aim for in each "
+                    "response when reading many keys from etcd.  The number "
+                    "of keys requested in each read adapts to the sizes of "
+                    "the keys and values already read, so as to stay near "
+                    "this size."),
+    cfg.BoolOpt('etcd_watch_multiplexing', default=False,
+                help="If true, all of the etcd watches in each process share "
+                     "a single watch stream to etcd, instead of each watch "
+                     "having its own connection."),
     cfg.StrOpt('openstack_region',
                help="When in a multi-region OpenStack deployment, a unique "
                     "name for the region that this node (controller or "
                     "compute) belongs to."),
 ]
 
+# Options that only the Calico DHCP agent uses.
+DHCP_AGENT_OPTS = [
+    cfg.IntOpt('dnsmasq_update_concurrency', default=1, min=1,
+               help="The maximum number of networks for which the Calico "
+                    "DHCP agent updates Dnsmasq concurrently.  Updates for "
+                    "the same network are always done one at a time."),
+    cfg.BoolOpt('dnsmasq_single_instance', default=False,
+                help="If true, the Calico DHCP agent runs a single Dnsmasq "
+                     "instance for all of the networks on its host, instead "
+                     "of one Dnsmasq per network.  This uses much less "
+                     "memory on hosts with many networks, and any change "
+                     "only updates one Dnsmasq, but a problem with one "
+                     "network's config then affects DHCP for all networks."),
+    cfg.BoolOpt('subnets_on_demand', default=False,
+                help="If true, the Calico DHCP agent only reads the subnets "
+                     "that its local endpoints need, when it needs them, "
+                     "and then polls etcd for changes to those subnets, "
+                     "instead of watching all the subnets in the region."),
+    cfg.StrOpt('dhcp_state_file',
+               help="If set, the Calico DHCP agent periodically saves its "
+                    "state to this file, and on restart uses it to carry on "
+                    "from where it left off, keeping any Dnsmasq processes "
+                    "that are still running with the right config."),
+]
+
 
 def register_options(conf, additional_options=None):
     options_to_register = (
@@ -42,6 +42,16 @@ NOT_NAMESPACED = None
 
 LOG = log.getLogger(__name__)
 
+# Cache of the metadata of Calico v3 resources that we have recently read or
+# written, as a map from etcd key to (mod_revision, metadata).  When we
+# rewrite a resource, we need to preserve its existing metadata (in
+# particular its UID and creation timestamp).  If we know the resource's
+# metadata at a particular mod_revision, we can do that without first reading
+# the resource from etcd, by making the write conditional on that
+# mod_revision; and fall back to reading the resource only if that condition
+# fails.
+_metadata_cache = {}
+
 
 def put(resource_kind, namespace, name, spec, annotations={}, labels=None,
         mod_revision=None):
@@ -74,14 +84,140 @@ def put(resource_kind, namespace, name, spec, annotations={}, labels=None,
     Returns True if the write happened successfully; False if not.
     """
     key = _build_key(resource_kind, namespace, name)
+    cached_revision, metadata = _get_cached_metadata(key, mod_revision)
+    if metadata is not None:
+        value = _build_value(resource_kind, namespace, name, spec,
+                             annotations=annotations, labels=labels,
+                             existing_metadata=metadata)
+        succeeded, revision = etcdv3.put(key, json.dumps(value),
+                                         mod_revision=cached_revision,
+                                         with_revision=True)
+        _update_metadata_cache(key, value, succeeded, revision)
+        if succeeded or cached_revision == mod_revision:
+            return succeeded
+        # Our cached metadata was out of date, so fall through to read the
+        # existing resource and write with the requested condition.
+        LOG.debug("Cached metadata for %s out of date", key)
+
+    value = _build_value(resource_kind, namespace, name, spec,
+                         annotations=annotations, labels=labels)
+    succeeded, revision = etcdv3.put(key, json.dumps(value),
+                                     mod_revision=mod_revision,
+                                     with_revision=True)
+    _update_metadata_cache(key, value, succeeded, revision)
+    return succeeded
+
+
+def put_many(resource_kind, namespace, resources):
+    """Write many Calico v3 resources of the same kind to etcdv3.
+
+    - resource_kind (string): E.g. WorkloadEndpoint, Profile, etc.
+
+    - namespace (string): The namespace to put the resources in.
+
+    - resources: an iterable of dicts, each holding the keyword arguments for
+      one call to put(), i.e. 'name' and 'spec' and optionally 'annotations',
+      'labels' and 'mod_revision'.
+
+    The writes are batched into as few etcd transactions as possible, but
+    each is guarded by its own mod_revision as for put().
+
+    Returns a dict mapping each resource name to True if its write happened
+    successfully, or False if not.
+    """
+    resources = list(resources)
+    results = {}
+
+    # First write all the resources for which we have cached metadata,
+    # conditional on the cached mod_revision.
+    cached = []
+    uncached = []
+    for resource in resources:
+        key = _build_key(resource_kind, namespace, resource['name'])
+        cached_revision, metadata = _get_cached_metadata(
+            key, resource.get('mod_revision'))
+        if metadata is not None:
+            cached.append((resource, cached_revision, metadata))
+        else:
+            uncached.append(resource)
+    if cached:
+        cached_results = _put_many(resource_kind, namespace, cached)
+        for resource, cached_revision, _ in cached:
+            name = resource['name']
+            if (cached_results[name] or
+                    cached_revision == resource.get('mod_revision')):
+                results[name] = cached_results[name]
+            else:
+                # Our cached metadata was out of date.
+                LOG.debug("Cached metadata for %s out of date", name)
+                uncached.append(resource)
+
+    # Now write the remaining resources, reading their existing metadata
+    # first.
+    if uncached:
+        results.update(_put_many(
+            resource_kind,
+            namespace,
+            [(resource, resource.get('mod_revision'), None)
+             for resource in uncached]))
+    return results
+
+
+def _put_many(resource_kind, namespace, writes):
+    # Write resources, where 'writes' is a list of (resource, mod_revision,
+    # existing_metadata) tuples, and return a map from resource name to
+    # whether each write succeeded.
+    etcd_writes = []
+    values_by_key = {}
+    names_by_key = {}
+    for resource, mod_revision, metadata in writes:
+        name = resource['name']
+        key = _build_key(resource_kind, namespace, name)
+        value = _build_value(resource_kind, namespace, name,
+                             resource['spec'],
+                             annotations=resource.get('annotations', {}),
+                             labels=resource.get('labels'),
+                             existing_metadata=metadata)
+        names_by_key[key] = name
+        values_by_key[key] = value
+        etcd_writes.append({
+            'key': key,
+            'value': json.dumps(value),
+            'mod_revision': mod_revision,
+        })
+    results = {}
+    for key, (succeeded, revision) in etcdv3.put_many(
+            etcd_writes, with_revision=True).items():
+        _update_metadata_cache(key, values_by_key[key], succeeded, revision)
+        results[names_by_key[key]] = succeeded
+    return results
+
+
+def _build_value(resource_kind, namespace, name, spec, annotations={},
+                 labels=None, existing_metadata=None):
+    """Build the full value to write for a Calico v3 resource.
+
+    Existing metadata, such as the resource's UID and creation timestamp, is
+    preserved if the resource already exists.  If existing_metadata is None,
+    the existing resource is read from etcd to find its metadata; otherwise
+    existing_metadata is used, and an empty dict means that the resource is
+    new.
+    """
     value = None
-    try:
-        # Get the existing resource so we can persist its metadata.
-        value, _ = _get_with_metadata(resource_kind, namespace, name)
-    except etcdv3.KeyNotFound:
-        pass
-    except ValueError:
-        LOG.warning("etcd value not valid JSON, so ignoring")
+    if existing_metadata is None:
+        try:
+            # Get the existing resource so we can persist its metadata.
+            value, _ = _get_with_metadata(resource_kind, namespace, name)
+        except etcdv3.KeyNotFound:
+            pass
+        except ValueError:
+            LOG.warning("etcd value not valid JSON, so ignoring")
+    elif existing_metadata:
+        value = {
+            'kind': resource_kind,
+            'apiVersion': 'projectcalico.org/v3',
+            'metadata': dict(existing_metadata),
+        }
     if value is None:
         # Build basic resource structure.
         value = {
@@ -114,7 +250,7 @@ def put(resource_kind, namespace, name, spec, annotations={}, labels=None,
         value['metadata']['labels'] = labels
     # Set the new spec (overriding whatever may already be there).
     value['spec'] = spec
-    return etcdv3.put(key, json.dumps(value), mod_revision=mod_revision)
+    return value
 
 
 def get(resource_kind, name):
@@ -182,35 +318,82 @@ def get_all(resource_kind, namespace,
     prefix = _build_key(resource_kind, namespace, '')
     results = etcdv3.get_prefix(prefix, revision=revision)
     tuples = []
+    keys_seen = set()
     for result in results:
-        key, value, mod_revision = result
-        name = key.split('/')[-1]
-
-        # Decode the value.
-        spec = labels = annotations = None
-        try:
-            value_dict = json.loads(value)
-            LOG.debug("value dict: %s", value_dict)
-            spec = value_dict['spec']
-            labels = value_dict['metadata'].get('labels', {})
-            annotations = value_dict['metadata'].get('annotations', {})
-        except ValueError:
-            # When the value is not valid JSON, we still return a tuple for
-            # this key, with spec, labels and annotations all as None.  This is
-            # so that the caller can correctly differentiate between
-            # overwriting an existing value (which => a transaction with
-            # specified mod_revision) and creating a key that did not exist
-            # before (=> a transaction with version 0).
-            LOG.warning("etcd value not valid JSON (%s)", value)
-
-        if with_labels_and_annotations:
-            t = (name, (spec, labels, annotations), mod_revision)
-        else:
-            t = (name, spec, mod_revision)
-        tuples.append(t)
+        keys_seen.add(result[0])
+        tuples.append(_decode_resource(result, with_labels_and_annotations))
+
+    # Discard cached metadata for resources of this kind that no longer
+    # exist.
+    for key in list(_metadata_cache.keys()):
+        if key.startswith(prefix) and key not in keys_seen:
+            del _metadata_cache[key]
     return tuples
 
 
+def iter_all(resource_kind, namespace,
+             with_labels_and_annotations=False, revision=None):
+    """Iterate through all Calico v3 resources of a certain kind in etcdv3.
+
+    This is a generator version of get_all, with the same arguments, that
+    yields the same tuples, but in ascending order of resource name, and
+    reading them from etcd one chunk at a time as the caller iterates.
+
+    So as to keep memory use bounded, this doesn't add the resources to the
+    metadata cache; it only refreshes the ones already cached, and discards
+    cached metadata for resources that no longer exist.
+    """
+    prefix = _build_key(resource_kind, namespace, '')
+    # The cached keys that we haven't yet reached, in descending order so
+    # that we can pop them as we reach them.
+    cached_keys = sorted((k for k in _metadata_cache if k.startswith(prefix)),
+                         reverse=True)
+    for result in etcdv3.iter_prefix(prefix, revision=revision):
+        key = result[0]
+        while cached_keys and cached_keys[-1] < key:
+            _metadata_cache.pop(cached_keys.pop(), None)
+        cache_metadata = bool(cached_keys) and cached_keys[-1] == key
+        if cache_metadata:
+            cached_keys.pop()
+        yield _decode_resource(result, with_labels_and_annotations,
+                               cache_metadata=cache_metadata)
+    for key in cached_keys:
+        _metadata_cache.pop(key, None)
+
+
+def _decode_resource(result, with_labels_and_annotations,
+                     cache_metadata=True):
+    # Decode a (key, value, mod_revision) tuple from etcdv3 into the form
+    # that get_all and iter_all return.
+    key, value, mod_revision = result
+    name = key.split('/')[-1]
+
+    # Decode the value.
+    spec = labels = annotations = None
+    try:
+        value_dict = json.loads(value)
+        LOG.debug("value dict: %s", value_dict)
+        spec = value_dict['spec']
+        labels = value_dict['metadata'].get('labels', {})
+        annotations = value_dict['metadata'].get('annotations', {})
+        if cache_metadata:
+            _metadata_cache[key] = (str(mod_revision),
+                                    value_dict['metadata'])
+    except ValueError:
+        # When the value is not valid JSON, we still return a tuple for this
+        # key, with spec, labels and annotations all as None.  This is so that
+        # the caller can correctly differentiate between overwriting an
+        # existing value (which => a transaction with specified mod_revision)
+        # and creating a key that did not exist before (=> a transaction with
+        # version 0).
+        LOG.warning("etcd value not valid JSON (%s)", value)
+
+    if with_labels_and_annotations:
+        return (name, (spec, labels, annotations), mod_revision)
+    else:
+        return (name, spec, mod_revision)
+
+
 def delete(resource_kind, namespace, name, mod_revision=None):
     """Delete a Calico v3 resource from etcdv3.
 
@@ -223,9 +406,35 @@ def delete(resource_kind, namespace, name, mod_revision=None):
     Returns True if the deletion was successful; False if not.
     """
     key = _build_key(resource_kind, namespace, name)
+    _metadata_cache.pop(key, None)
     return etcdv3.delete(key, mod_revision=mod_revision)
 
 
+def delete_many(resource_kind, namespace, resources):
+    """Delete many Calico v3 resources of the same kind from etcdv3.
+
+    - resource_kind (string): E.g. WorkloadEndpoint, Profile, etc.
+
+    - namespace (string): The namespace to delete the resources in.
+
+    - resources: an iterable of (name, mod_revision) pairs, where mod_revision
+      may be None for an unguarded delete.
+
+    Returns a dict mapping each resource name to True if its deletion was
+    successful, or False if not.
+    """
+    deletes = []
+    names_by_key = {}
+    for name, mod_revision in resources:
+        key = _build_key(resource_kind, namespace, name)
+        _metadata_cache.pop(key, None)
+        names_by_key[key] = name
+        deletes.append({'key': key, 'mod_revision': mod_revision})
+    results = etcdv3.delete_many(deletes)
+    return dict((names_by_key[key], deleted)
+                for key, deleted in results.items())
+
+
 SANITIZE_LABEL_MAX_LENGTH = 63
 
 
@@ -287,10 +496,51 @@ def _build_key(resource_kind, namespace, name):
         )
 
 
+def _get_cached_metadata(key, mod_revision):
+    """Get cached metadata that allows writing a resource without reading it.
+
+    - key (string): The resource's etcd key.
+
+    - mod_revision: The condition for the write, as for put().
+
+    Returns (cached_revision, metadata), where metadata is the existing
+    metadata to preserve (an empty dict if the write is to create a new
+    resource), and cached_revision is the condition to use for the write
+    instead of mod_revision; or (None, None) if there is no usable cached
+    metadata.
+    """
+    if mod_revision == 0:
+        # Creating a new resource, so there is no existing metadata.
+        return 0, {}
+    cached = _metadata_cache.get(key)
+    if cached is None:
+        return None, None
+    cached_revision, metadata = cached
+    if mod_revision is None or mod_revision == etcdv3.MUST_UPDATE:
+        # We can use the cached metadata if the resource has not changed
+        # since we cached it.
+        return cached_revision, metadata
+    if str(mod_revision) == cached_revision:
+        return mod_revision, metadata
+    return None, None
+
+
+def _update_metadata_cache(key, value, succeeded, revision):
+    if succeeded and revision is not None:
+        _metadata_cache[key] = (str(revision), value['metadata'])
+    else:
+        _metadata_cache.pop(key, None)
+
+
+def _reset_globals():
+    _metadata_cache.clear()
+
+
 def _get_with_metadata(resource_kind, namespace, name):
     # Note: 'with_metadata' here means including the Calico data model
     # metadata, as well as the etcdv3 mod_revision.
     key = _build_key(resource_kind, namespace, name)
     value_as_string, mod_revision = etcdv3.get(key)
     value = json.loads(value_as_string)
+    _metadata_cache[key] = (str(mod_revision), dict(value['metadata']))
     return value, mod_revision
@@ -14,6 +14,7 @@
 
 import collections
 import eventlet
+import eventlet.queue
 import json
 import re
 
@@ -38,6 +39,20 @@ ACTION_MAPPING = {
 }
 WATCH_TIMEOUT_SECS = 10
 
+# Maximum number of watch events that can be read from etcd but not yet
+# dispatched.  When this many are waiting, we stop reading from etcd until
+# the handlers catch up.
+EVENT_QUEUE_SIZE = 1000
+
+# Maximum number of watch events to pass to handle_events() at once.
+MAX_EVENT_BATCH = 100
+
+# Queued after the last event of a watch stream.
+_END_OF_STREAM = object()
+
+# Placeholder for no event, because None is a valid event.
+_NO_EVENT = object()
+
 
 # Replacement for "if isinstance(v, StringTypes)" that works with
 # Python 2 and 3, as advised by
@@ -51,8 +66,16 @@ def _is_string_instance(obj):
 
 
 class PathDispatcher(object):
+    """Dispatches etcd events to the handlers registered for their keys.
+
+    Registered paths are compiled into a tree of _PathNodes, so that
+    dispatching an event takes a single pass over the parts of its key.
+    Each handler is called with the values of the <captures> in its path,
+    so it doesn't need to parse the key again.
+    """
+
     def __init__(self):
-        self.handler_root = {}
+        self.handler_root = _PathNode()
 
     def register(self, path, on_set=None, on_del=None):
         LOG.info("Registering path %s set=%s del=%s", path, on_set, on_del)
@@ -62,46 +85,58 @@ class PathDispatcher(object):
             m = re.match(r'<(.*)>', part)
             if m:
                 capture_name = m.group(1)
-                name, node = node.setdefault("capture", (capture_name, {}))
-                assert name == capture_name, (
-                    "Conflicting capture name %s vs %s" % (name, capture_name)
+                if node.capture_child is None:
+                    node.capture_name = capture_name
+                    node.capture_child = _PathNode()
+                assert node.capture_name == capture_name, (
+                    "Conflicting capture name %s vs %s" % (node.capture_name,
+                                                           capture_name)
                 )
+                node = node.capture_child
             else:
-                node = node.setdefault(part, {})
+                node = node.children.setdefault(part, _PathNode())
         if on_set:
-            node["set"] = on_set
+            node.handlers["set"] = on_set
         if on_del:
-            node["delete"] = on_del
+            node.handlers["delete"] = on_del
 
     def handle_event(self, response):
         """handle_event
 
         :param Response: A python-etcd response object for a watch.
         """
-        LOG.debug("etcd event %s for key %s", response.action, response.key)
-        key_parts = response.key.strip("/").split("/")
-        self._handle(key_parts, response, self.handler_root, {})
-
-    def _handle(self, key_parts, response, handler_node, captures):
-        while key_parts:
-            next_part = key_parts.pop(0)
-            if "capture" in handler_node:
-                capture_name, handler_node = handler_node["capture"]
-                captures[capture_name] = next_part
-            elif next_part in handler_node:
-                handler_node = handler_node[next_part]
-            else:
-                LOG.debug("No matching sub-handler for %s", response.key)
-                return
-        # We've reached the end of the key.
         action = ACTION_MAPPING.get(response.action)
-        if action in handler_node:
-            LOG.debug("Found handler for event %s for %s, captures: %s",
-                      action, response.key, captures)
-            handler_node[action](response, **captures)
-        else:
-            LOG.debug("No handler for event %s on %s. Handler node %s.",
-                      action, response.key, handler_node)
+        node = self.handler_root
+        captures = {}
+        for part in response.key.strip("/").split("/"):
+            # As a capture matches any key part, it takes precedence over
+            # literal parts at the same level.
+            if node.capture_child is not None:
+                captures[node.capture_name] = part
+                node = node.capture_child
+            else:
+                node = node.children.get(part)
+                if node is None:
+                    return
+        handler = node.handlers.get(action)
+        if handler is not None:
+            handler(response, **captures)
+
+
+class _PathNode(object):
+    """Node of a PathDispatcher's tree, for one part of a path."""
+
+    __slots__ = ('children', 'capture_name', 'capture_child', 'handlers')
+
+    def __init__(self):
+        # Child nodes for literal parts of the path.
+        self.children = {}
+        # Name and child node for a <capture> part of the path.
+        self.capture_name = None
+        self.capture_child = None
+        # Handlers for events whose key ends at this node, indexed by
+        # "set" or "delete".
+        self.handlers = {}
 
 
 Response = collections.namedtuple(
@@ -118,12 +153,39 @@ class EtcdWatcher(object):
     - watcher.stop()
     """
 
-    def __init__(self, prefix, round_trip_suffix=None):
+    def __init__(self, prefix, round_trip_suffix=None,
+                 progress_notify_interval=None, snapshot_changes_only=False):
         LOG.debug("Creating EtcdWatcher for %s", prefix)
         self.prefix = prefix
         self.round_trip_suffix = round_trip_suffix
+
+        # If set, the interval in seconds at which the etcd server sends
+        # progress notifications on our watch.  Then we check that the watch
+        # is working by receiving those, instead of by writing a round-trip
+        # key, so we allow two intervals before deciding that it isn't.
+        self.progress_notify_interval = progress_notify_interval
+        if progress_notify_interval:
+            self.watch_timeout = max(WATCH_TIMEOUT_SECS,
+                                     2 * progress_notify_interval)
+        else:
+            self.watch_timeout = WATCH_TIMEOUT_SECS
         self.dispatcher = PathDispatcher()
         self._stopped = False
+
+        # If set, we remember the mod_revision of each key that we have
+        # dispatched, and a new snapshot then only dispatches keys whose
+        # mod_revision differs, plus deletions for keys that have gone.
+        self.snapshot_changes_only = snapshot_changes_only
+        self._key_revisions = {}
+
+        # Number of times that etcd has cancelled our watch.
+        self.watch_cancellations = 0
+
+        # Number of times that reading watch events has had to wait for the
+        # handlers to make room in the event queue, and the most events that
+        # have been waiting in that queue.
+        self.event_queue_full_waits = 0
+        self.event_queue_max_depth = 0
         self.debug_reporter = lambda msg: msg
 
     def register_path(self, *args, **kwargs):
@@ -135,6 +197,36 @@ class EtcdWatcher(object):
     def _post_snapshot_hook(self, _):
         pass
 
+    def _get_resume_point(self):
+        """Get a point from which to try resuming, instead of a snapshot.
+
+        Returns (cluster_id, revision) if this watcher already has the data
+        for its tree as at REVISION of etcd cluster CLUSTER_ID, for example
+        because it was saved by a previous run of the same process; or None.
+        """
+        return None
+
+    def _new_revision_hook(self, cluster_id, revision):
+        """Called when all events up to REVISION have been processed."""
+        pass
+
+    def _can_resume_watch(self, cluster_id, last_revision):
+        """Check whether we can resume watching after last_revision.
+
+        That is possible if we are still talking to the same etcd cluster,
+        and etcd has not compacted away the revisions that we have not yet
+        seen.  In that case a new watch from last_revision + 1 will report
+        everything that we have missed, so there is no need to take a new
+        snapshot.
+        """
+        new_cluster_id, revision = etcdv3.get_status()
+        if new_cluster_id != cluster_id:
+            return False
+        if int(revision) <= last_revision:
+            # Nothing has been written since the last revision that we saw.
+            return True
+        return not etcdv3.revision_compacted(self.prefix, last_revision + 1)
+
     def start(self):
         LOG.info("Start watching %s", self.prefix)
         self._stopped = False
@@ -142,65 +234,112 @@ class EtcdWatcher(object):
         # The current etcd cluster ID.
         current_cluster_id = None
 
-        while not self._stopped:
-            # Get the current etcdv3 cluster ID and revision, so (a) we can
-            # detect if the cluster ID changes, and (b) we know when to start
-            # watching from.
-            try:
-                cluster_id, last_revision = etcdv3.get_status()
-                last_revision = int(last_revision)
-                LOG.debug("Current cluster_id %s, revision %d",
-                          cluster_id, last_revision)
-                if cluster_id != current_cluster_id:
-                    # No particular handling here; but keep track of the
-                    # current cluster ID and log if it changes.  (In the
-                    # circumstances that can cause a cluster ID change, our
-                    # watch (below) for the old cluster ID would have timed out
-                    # - either because of connection loss, or because of no
-                    # further events coming - and then we would have looped
-                    # back round to here; and the next watch will be created
-                    # against the new cluster.)
-                    if current_cluster_id is not None:
-                        LOG.warning("Cluster ID changed")
-                    current_cluster_id = cluster_id
-            except ConnectionFailedError as e:
-                LOG.debug("%r", e)
-                LOG.warning("etcd not available, will retry in 5s")
-                eventlet.sleep(5)
-                continue
+        # Whether the last watch ended only because it was idle, so that we
+        # can try to resume watching from the last known revision instead of
+        # taking a new snapshot.
+        watch_was_idle = False
+        last_revision = None
+        my_name = self.__class__.__name__
+
+        # If we already have data as at some revision, try to resume from
+        # there - as though a watch had gone idle after that revision - so
+        # that we only need the events since then, instead of a snapshot.
+        resume_point = self._get_resume_point()
+        if resume_point is not None:
+            current_cluster_id, last_revision = resume_point
+            watch_was_idle = True
 
-            # Allow subclass to do pre-snapshot processing, and to return any
-            # data that it will need for reconciliation after the snapshot.
-            my_name = self.__class__.__name__
-            LOG.debug("%s Calling pre-snapshot hook", my_name)
-            snapshot_data = self._pre_snapshot_hook()
-
-            try:
-                # Get all existing values and process them through the
-                # dispatcher.
-                LOG.debug("%s Loading snapshot", my_name)
-                for result in etcdv3.get_prefix(self.prefix,
-                                                revision=last_revision):
-                    key, value, mod_revision = result
-                    # Convert to what the dispatcher expects - see below.
-                    response = Response(
-                        action='set',
-                        key=key,
-                        value=value,
-                        mod_revision=mod_revision,
-                    )
-                    LOG.debug("status event: %s", response)
-                    self.dispatcher.handle_event(response)
-            except ConnectionFailedError as e:
-                LOG.debug("%r", e)
-                LOG.warning("etcd not available, will retry in 5s")
-                eventlet.sleep(5)
-                continue
-
-            # Allow subclass to do post-snapshot reconciliation.
-            LOG.debug("%s Done loading snapshot, calling post snapshot hook",
-                      my_name)
-            self._post_snapshot_hook(snapshot_data)
+        while not self._stopped:
+            resume = False
+            if watch_was_idle:
+                watch_was_idle = False
+                try:
+                    resume = self._can_resume_watch(current_cluster_id,
+                                                    last_revision)
+                except Exception:
+                    LOG.exception("Failed to check if watch can resume")
+
+            if resume:
+                LOG.debug("%s Resuming watch after revision %d",
+                          my_name, last_revision)
+            else:
+                # Get the current etcdv3 cluster ID and revision, so (a) we
+                # can detect if the cluster ID changes, and (b) we know when
+                # to start watching from.
+                try:
+                    cluster_id, last_revision = etcdv3.get_status()
+                    last_revision = int(last_revision)
+                    LOG.debug("Current cluster_id %s, revision %d",
+                              cluster_id, last_revision)
+                    if cluster_id != current_cluster_id:
+                        # No particular handling here; but keep track of the
+                        # current cluster ID and log if it changes.  (In the
+                        # circumstances that can cause a cluster ID change,
+                        # our watch (below) for the old cluster ID would have
+                        # timed out - either because of connection loss, or
+                        # because of no further events coming - and then we
+                        # would have looped back round to here; and the next
+                        # watch will be created against the new cluster.)
+                        if current_cluster_id is not None:
+                            LOG.warning("Cluster ID changed")
+                        current_cluster_id = cluster_id
+                except ConnectionFailedError as e:
+                    LOG.debug("%r", e)
+                    LOG.warning("etcd not available, will retry in 5s")
+                    eventlet.sleep(5)
+                    continue
+
+                # Allow subclass to do pre-snapshot processing, and to return
+                # any data that it will need for reconciliation after the
+                # snapshot.
+                LOG.debug("%s Calling pre-snapshot hook", my_name)
+                snapshot_data = self._pre_snapshot_hook()
+
+                try:
+                    # Get all existing values and process them through the
+                    # dispatcher.
+                    LOG.debug("%s Loading snapshot", my_name)
+                    new_key_revisions = {}
+                    num_dispatched = 0
+                    for result in etcdv3.get_prefix(self.prefix,
+                                                    revision=last_revision):
+                        key, value, mod_revision = result
+                        if self.snapshot_changes_only:
+                            # (etcd3gw gives us mod_revision as a string.)
+                            revision = int(mod_revision)
+                            new_key_revisions[key] = revision
+                            if self._key_revisions.get(key) == revision:
+                                # Unchanged since we last dispatched it.
+                                continue
+                        # Convert to what the dispatcher expects - see below.
+                        response = Response(
+                            action='set',
+                            key=key,
+                            value=value,
+                            mod_revision=mod_revision,
+                        )
+                        LOG.debug("status event: %s", response)
+                        self.dispatcher.handle_event(response)
+                        num_dispatched += 1
+                except ConnectionFailedError as e:
+                    LOG.debug("%r", e)
+                    LOG.warning("etcd not available, will retry in 5s")
+                    eventlet.sleep(5)
+                    continue
+
+                if self.snapshot_changes_only:
+                    num_deleted = self._dispatch_snapshot_deletions(
+                        new_key_revisions, last_revision)
+                    LOG.info("%s snapshot has %d keys: dispatched %d new or "
+                             "changed, %d deleted", my_name,
+                             len(new_key_revisions), num_dispatched,
+                             num_deleted)
+
+                # Allow subclass to do post-snapshot reconciliation.
+                LOG.debug("%s Done loading snapshot, calling post snapshot "
+                          "hook", my_name)
+                self._post_snapshot_hook(snapshot_data)
+                self._new_revision_hook(current_cluster_id, last_revision)
 
             # Now watch for any changes, starting after the revision above.
             try:
@@ -208,7 +347,8 @@ class EtcdWatcher(object):
                 LOG.debug("%s Starting to watch for updates", my_name)
                 event_stream, cancel = etcdv3.watch_subtree(
                     self.prefix,
-                    str(last_revision + 1))
+                    str(last_revision + 1),
+                    progress_notify=bool(self.progress_notify_interval))
 
                 # It is possible for that watch call to be affected by an etcd
                 # compaction, if there is a sequence of events as follows.
@@ -238,29 +378,12 @@ class EtcdWatcher(object):
                 # "member_id":"10276657743932975437","raft_term":"2"},
                 # "compact_revision":"32"}}
                 #
-                # Both of those response lines are consumed by the etcd3gw
-                # client/watch code, with nothing reported up to this code
-                # here.  Hence the next thing that will happen here is timing
-                # out after WATCH_TIMEOUT_SECS (10s).  Then we'll loop round,
-                # get the current revision, and start watching again from
-                # there.
-                #
-                # Given the things that EtcdWatcher is used for, I think that's
-                # good enough without more specific handling.  EtcdWatcher is
-                # used for:
-                #
-                # - agent status, where the impacts are placing a VM on a
-                #   compute host where Felix has died, or not using a compute
-                #   host where Felix has just become available.  For Felix
-                #   death there is a window (TTL) of 90s anyway, so another 10s
-                #   doesn't make a big difference.
-                #
-                # - port status, where the impact is just correct presentation
-                #   in the OpenStack UI.
-                #
-                # - DHCP info, where the impact is dnsmasq not being able to
-                #   answer a DHCP request.  But any sensible guest OS will
-                #   retry anyway for at least 10s, so I think we're still OK.
+                # etcd3gw's own watch code would consume both of those
+                # response lines, with nothing reported up to this code, so we
+                # would only find out by timing out after WATCH_TIMEOUT_SECS.
+                # Our watch code instead reports the second line as a
+                # 'CANCELED' event, which we handle below by taking a new
+                # snapshot straightaway.
             except Exception:
                 # Log and handle by restarting the loop, which means we'll get
                 # the tree again and then try watching again.  E.g. it could be
@@ -273,22 +396,26 @@ class EtcdWatcher(object):
             # (This is updated below as we see watch events.)
             last_event_time = monotonic_time()
 
-            def _cancel_watch_if_broken():
+            # Set when we have finished with this watch for another reason.
+            watch_ended = eventlet.event.Event()
+
+            def _cancel_watch_if_broken(watch_ended):
                 # Loop until we should cancel the watch, either because of
                 # inactivity or because of stop() having been called.
-                while not self._stopped:
+                while not self._stopped and not watch_ended.ready():
                     self.debug_reporter("Start of loop")
-                    # If WATCH_TIMEOUT_SECS has now passed since the last watch
+                    # If the watch timeout has now passed since the last watch
                     # event, break out of this loop.  If we are also writing a
                     # key within the tree every WATCH_TIMEOUT_SECS / 3 seconds,
-                    # this can only happen either if there is some roundtrip
+                    # or etcd is sending us progress notifications, this can
+                    # only happen either if there is some roundtrip
                     # connectivity problem, or if the watch is invalid because
                     # of a recent compaction.  Whatever the reason, we need to
                     # terminate this watch and take a new overall status and
                     # snapshot of the tree.
                     time_now = monotonic_time()
-                    if time_now > last_event_time + WATCH_TIMEOUT_SECS:
-                        if self.round_trip_suffix is not None:
+                    if time_now > last_event_time + self.watch_timeout:
+                        if self._checks_watch():
                             LOG.warning("Watch is not working")
                             self.debug_reporter("Watch is not working")
                         else:
@@ -320,75 +447,226 @@ class EtcdWatcher(object):
             # stop() is called.  Cancelling the watch adds None to the event
             # stream, so the following for loop will see that.
             self.debug_reporter("Start _cancel_watch_if_broken")
-            eventlet.spawn(_cancel_watch_if_broken)
+            eventlet.spawn(_cancel_watch_if_broken, watch_ended)
+
+            # Read the event stream in another greenlet, and pass the events
+            # to us through a bounded queue, so that slow handlers don't stop
+            # us reading from etcd unless the queue fills up.
+            event_queue = eventlet.queue.LightQueue(EVENT_QUEUE_SIZE)
+            reader = eventlet.spawn_n(self._read_events, event_stream,
+                                      event_queue)
+            full_waits = self.event_queue_full_waits
+            try:
+                for events in self._event_batches(event_queue):
+                    LOG.debug("Events: %s", events)
+                    last_event_time = monotonic_time()
+
+                    # If the EtcdWatcher has been stopped, return from the
+                    # whole loop.
+                    if self._stopped:
+                        LOG.info("EtcdWatcher has been stopped")
+                        return
+
+                    # Otherwise a None event means that the watch has been
+                    # cancelled owing to inactivity.  In that case we break
+                    # out from this loop, and the watch will be restarted.
+                    # If we are not writing a round-trip key, inactivity does
+                    # not imply that the watch is broken, so we try to resume
+                    # from the last known revision instead of taking a new
+                    # snapshot.
+                    event = events[0]
+                    if event is None:
+                        LOG.debug("Watch cancelled owing to inactivity")
+                        watch_was_idle = not self._checks_watch()
+                        break
 
-            for event in event_stream:
-                LOG.debug("Event: %s", event)
-                last_event_time = monotonic_time()
+                    # etcd has cancelled the watch, most likely because the
+                    # revision that we asked to watch from has been
+                    # compacted.  That won't get better by trying again from
+                    # the same revision, so take a new snapshot now.
+                    if event.get('type') == 'CANCELED':
+                        self.watch_cancellations += 1
+                        LOG.warning("%s watch cancelled by etcd: %s; taking a "
+                                    "new snapshot (%d watch cancellation(s) "
+                                    "so far)", my_name,
+                                    event.get('cancel_reason') or
+                                    "compacted at revision %s" %
+                                    event.get('compact_revision'),
+                                    self.watch_cancellations)
+                        watch_ended.send()
+                        cancel()
+                        break
 
-                # If the EtcdWatcher has been stopped, return from the whole
-                # loop.
-                if self._stopped:
-                    LOG.info("EtcdWatcher has been stopped")
-                    return
+                    # A progress notification means that we have now seen all
+                    # events up to its revision, so the watch is working and
+                    # we can advance our last known revision.
+                    if event.get('type') == 'PROGRESS':
+                        revision = int(event['header']['revision'])
+                        LOG.debug("Watch progress at revision %d", revision)
+                        if revision > last_revision:
+                            last_revision = revision
+                            self._new_revision_hook(current_cluster_id,
+                                                    last_revision)
+                        continue
+
+                    # Otherwise we have a batch of key/value events.
+                    responses = [_event_to_response(e) for e in events]
+                    self.handle_events(responses)
+
+                    if self.snapshot_changes_only:
+                        for response in responses:
+                            if response.action == 'delete':
+                                self._key_revisions.pop(response.key, None)
+                            else:
+                                self._key_revisions[response.key] = \
+                                    response.mod_revision
+
+                    # Update last known revision.
+                    mod_revision = responses[-1].mod_revision
+                    if mod_revision > last_revision:
+                        last_revision = mod_revision
+                        LOG.debug("Last known revision is now %d",
+                                  last_revision)
+                        self._new_revision_hook(current_cluster_id,
+                                                last_revision)
+            finally:
+                eventlet.kill(reader)
+                full_waits = self.event_queue_full_waits - full_waits
+                if full_waits:
+                    LOG.warning("%s handlers fell behind the watch: reading "
+                                "waited for a full event queue %d time(s); "
+                                "maximum queue depth so far %d", my_name,
+                                full_waits, self.event_queue_max_depth)
+
+    def handle_events(self, responses):
+        """Dispatch a batch of watch events, in order.
+
+        Subclasses can override this to handle a batch of events together,
+        for example so as to amortise some work across the whole batch.
+        """
+        for response in responses:
+            LOG.debug("Event: %s", response)
+            self.dispatcher.handle_event(response)
 
-                # Otherwise a None event means that the watch has been
-                # cancelled owing to inactivity.  In that case we break out
-                # from this loop, and the watch will be restarted.
-                if event is None:
-                    LOG.debug("Watch cancelled owing to inactivity")
-                    break
+    def _read_events(self, event_stream, event_queue):
+        """Read watch events from EVENT_STREAM into EVENT_QUEUE.
 
-                # An event at this point has a form like
-                #
-                # {'kv': {
-                #     'mod_revision': '4',
-                #     'value': '...',
-                #     'create_revision': '4',
-                #     'version': '1',
-                #     'key': '/calico/felix/v1/host/ubuntu-xenial...'
-                # }}
-                #
-                # when a key/value pair is created or updated, and like
-                #
-                # {'type': 'DELETE',
-                #  'kv': {
-                #     'mod_revision': '88',
-                #     'key': '/calico/felix/v1/host/ubuntu-xenial-...'
-                # }}
-                #
-                # when a key/value pair is deleted.
-                #
-                # Convert that to the form that the dispatcher expects;
-                # namely a response object, with:
-                # - response.key giving the etcd key
-                # - response.action being "set" or "delete"
-                # - whole response being passed on to the handler method.
-                # Handler methods here expect
-                # - response.key
-                # - response.value
-                key = event['kv']['key'].decode()
-                mod_revision = int(event['kv'].get('mod_revision', '0'))
+        Runs in its own greenlet.  Queues _END_OF_STREAM at the end of the
+        stream, or the exception that ended it.
+        """
+        try:
+            for event in event_stream:
+                if event_queue.full():
+                    self.event_queue_full_waits += 1
+                    LOG.debug("Event queue full, waiting")
+                event_queue.put(event)
+                self.event_queue_max_depth = max(self.event_queue_max_depth,
+                                                 event_queue.qsize())
+        except Exception as e:
+            event_queue.put(e)
+        else:
+            event_queue.put(_END_OF_STREAM)
+
+    def _event_batches(self, event_queue):
+        """Yield lists of the events in EVENT_QUEUE, until the end of stream.
+
+        Key/value events that are queued together are yielded together, up
+        to MAX_EVENT_BATCH of them.  Any other event is yielded on its own.
+        """
+        event = event_queue.get()
+        while event is not _END_OF_STREAM:
+            if isinstance(event, Exception):
+                raise event
+            events = [event]
+            event = _NO_EVENT
+            if _is_kv_event(events[0]):
+                while (len(events) < MAX_EVENT_BATCH and
+                       not event_queue.empty()):
+                    event = event_queue.get_nowait()
+                    if not _is_kv_event(event):
+                        break
+                    events.append(event)
+                    event = _NO_EVENT
+            yield events
+            if event is _NO_EVENT:
+                event = event_queue.get()
+
+    def _dispatch_snapshot_deletions(self, new_key_revisions, revision):
+        """Finish a snapshot in snapshot_changes_only mode.
+
+        Dispatches a delete for each key that we previously dispatched but
+        that is not in the snapshot, then remembers the snapshot's keys.
+        Returns the number of deletes.
+        """
+        num_deleted = 0
+        for key in self._key_revisions:
+            if key not in new_key_revisions:
                 response = Response(
-                    action=event.get('type', 'SET').lower(),
+                    action='delete',
                     key=key,
-                    value=event['kv'].get('value', b'').decode(),
-                    mod_revision=mod_revision,
+                    value='',
+                    mod_revision=revision,
                 )
-                LOG.info("Event: %s", response)
+                LOG.debug("status event: %s", response)
                 self.dispatcher.handle_event(response)
+                num_deleted += 1
+        self._key_revisions = new_key_revisions
+        return num_deleted
 
-                # Update last known revision.
-                if mod_revision > last_revision:
-                    last_revision = mod_revision
-                    LOG.debug("Last known revision is now %d",
-                              last_revision)
+    def _checks_watch(self):
+        """Whether we check that the watch is working, by either method.
+
+        If not, a watch with no events is assumed to be idle, not broken.
+        """
+        return (self.round_trip_suffix is not None or
+                bool(self.progress_notify_interval))
 
     def stop(self):
         LOG.info("Stop watching status tree")
         self._stopped = True
 
 
+def _is_kv_event(event):
+    return isinstance(event, dict) and 'kv' in event
+
+
+def _event_to_response(event):
+    # A key/value event has a form like
+    #
+    # {'kv': {
+    #     'mod_revision': '4',
+    #     'value': '...',
+    #     'create_revision': '4',
+    #     'version': '1',
+    #     'key': '/calico/felix/v1/host/ubuntu-xenial...'
+    # }}
+    #
+    # when a key/value pair is created or updated, and like
+    #
+    # {'type': 'DELETE',
+    #  'kv': {
+    #     'mod_revision': '88',
+    #     'key': '/calico/felix/v1/host/ubuntu-xenial-...'
+    # }}
+    #
+    # when a key/value pair is deleted.
+    #
+    # Convert that to the form that the dispatcher expects; namely a
+    # response object, with:
+    # - response.key giving the etcd key
+    # - response.action being "set" or "delete"
+    # - whole response being passed on to the handler method.
+    # Handler methods here expect
+    # - response.key
+    # - response.value
+    return Response(
+        action=event.get('type', 'SET').lower(),
+        key=event['kv']['key'].decode(),
+        value=event['kv'].get('value', b'').decode(),
+        mod_revision=int(event['kv'].get('mod_revision', '0')),
+    )
+
+
 def intern_dict(d):
     """intern_dict
 
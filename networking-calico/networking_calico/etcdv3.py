@@ -13,12 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import eventlet
+from eventlet import queue
+from eventlet import semaphore
 import functools
+from http import client as http_client
+import json
+import os
+import socket
+import ssl
+from urllib import parse
 
 from etcd3gw.client import Etcd3Client
 from etcd3gw.exceptions import Etcd3Exception
+from etcd3gw.exceptions import WatchTimedOut
 from etcd3gw.lease import Lease
 
+from etcd3gw.utils import _decode
 from etcd3gw.utils import _encode
 from etcd3gw.utils import _increment_last_byte
 
@@ -33,15 +44,37 @@ from networking_calico.compat import log
 
 LOG = log.getLogger(__name__)
 
-# Limit on number of keys we get from etcd.  We found that the etcd gateway
-# has limits on the size of responses that kick in at 3000+ keys so make sure
-# we leave plenty of headroom.
+# Limit on number of keys we get from etcd in the first chunk of a ranged
+# read.  For subsequent chunks we adapt the limit according to the size of the
+# data seen so far, within CHUNK_SIZE_MIN and CHUNK_SIZE_MAX.  We found that
+# the etcd gateway has limits on the size of responses that kick in at 3000+
+# keys so make sure we leave plenty of headroom.
 CHUNK_SIZE_LIMIT = 200
+CHUNK_SIZE_MIN = 10
+CHUNK_SIZE_MAX = 2000
+
+# Approximate size in bytes of the metadata for each key in a ranged read
+# response, in addition to the key and value.
+CHUNK_ITEM_OVERHEAD_BYTES = 100
+
+# Limit on the number of buckets that we count when partitioning a range of
+# keys for a parallel get_prefix.  This allows for the whole of printable
+# ASCII; Calico resource names are restricted to lower case alphanumeric
+# characters and a little punctuation, which span 75 code points from '-'
+# to 'z'.
+PARTITION_BUCKETS_LIMIT = 128
 
 # Indicates that a put operation must update an existing resource and not
 # create a new resource.
 MUST_UPDATE = "MUST_UPDATE"
 
+# Limits on the number of operations, and on the approximate size in bytes,
+# of each etcd transaction that we build when writing or deleting many keys at
+# once.  etcd rejects transactions with more than 128 operations (by default),
+# or larger than 1.5MiB, so make sure we leave plenty of headroom.
+TXN_OPS_LIMIT = 100
+TXN_SIZE_LIMIT = 512 * 1024
+
 
 class KeyNotFound(Etcd3Exception):
     pass
@@ -82,7 +115,8 @@ def get(key, with_lease=False):
         return value, item['mod_revision']
 
 
-def put(key, value, mod_revision=None, lease=None, existing_value=None):
+def put(key, value, mod_revision=None, lease=None, existing_value=None,
+        with_revision=False):
     """Write a key/value pair to etcdv3.
 
     - key (string): The key to write.
@@ -99,15 +133,42 @@ def put(key, value, mod_revision=None, lease=None, existing_value=None):
     - existing_value (string): If specified, indicates that the write should
       only proceed if replacing that existing value.
 
-    Returns True if the write happened successfully; False if not.
+    - with_revision (boolean): Indicates also to return the etcdv3 revision
+      of the write.
+
+    Returns True if the write happened successfully; False if not.  Or, if
+    with_revision is True, returns (succeeded, revision) where revision is the
+    new mod_revision of the key if the write happened, or else None.
     """
     client = _get_client()
     LOG.debug("etcdv3 put key=%s value=%s mod_revision=%r",
               key, value, mod_revision)
-    txn = {}
+    txn = _put_txn(key, value, mod_revision=mod_revision, lease=lease,
+                   existing_value=existing_value)
+    revision = None
+    if txn['compare'] or with_revision:
+        result = client.transaction(txn)
+        LOG.debug("transaction result %s", result)
+        succeeded = result.get('succeeded', False)
+        if succeeded:
+            revision = result.get('header', {}).get('revision')
+    else:
+        succeeded = client.put(key, value, lease=lease)
+    if with_revision:
+        return succeeded, revision
+    return succeeded
+
+
+def _put_txn(key, value, mod_revision=None, lease=None, existing_value=None):
+    """Build the etcd transaction for a single, possibly guarded, put.
+
+    Arguments are as for put().  If the put is not guarded, the returned
+    transaction has an empty 'compare' list.
+    """
+    base64_key = _encode(key)
+    txn = {'compare': []}
     if mod_revision == 0:
         # Write operation must _create_ the KV entry.
-        base64_key = _encode(key)
         txn['compare'] = [{
             'key': base64_key,
             'result': 'EQUAL',
@@ -116,7 +177,6 @@ def put(key, value, mod_revision=None, lease=None, existing_value=None):
         }]
     elif mod_revision == MUST_UPDATE:
         # Write operation must update and _not_ create the KV entry.
-        base64_key = _encode(key)
         txn['compare'] = [{
             'key': base64_key,
             'result': 'NOT_EQUAL',
@@ -126,7 +186,6 @@ def put(key, value, mod_revision=None, lease=None, existing_value=None):
     elif mod_revision is not None:
         # Write operation must _replace_ a KV entry with the specified
         # revision.
-        base64_key = _encode(key)
         txn['compare'] = [{
             'key': base64_key,
             'result': 'EQUAL',
@@ -135,7 +194,6 @@ def put(key, value, mod_revision=None, lease=None, existing_value=None):
         }]
     elif existing_value is not None:
         # Write operation must _replace_ a KV entry with the specified value.
-        base64_key = _encode(key)
         base64_existing = _encode(existing_value)
         txn['compare'] = [{
             'key': base64_key,
@@ -143,23 +201,16 @@ def put(key, value, mod_revision=None, lease=None, existing_value=None):
             'target': 'VALUE',
             'value': base64_existing,
         }]
-    if txn:
-        base64_value = _encode(value)
-        txn['success'] = [{
-            'request_put': {
-                'key': base64_key,
-                'value': base64_value,
-            },
-        }]
-        txn['failure'] = []
-        if lease is not None:
-            txn['success'][0]['request_put']['lease'] = lease.id
-        result = client.transaction(txn)
-        LOG.debug("transaction result %s", result)
-        succeeded = result.get('succeeded', False)
-    else:
-        succeeded = client.put(key, value, lease=lease)
-    return succeeded
+    txn['success'] = [{
+        'request_put': {
+            'key': base64_key,
+            'value': _encode(value),
+        },
+    }]
+    txn['failure'] = []
+    if lease is not None:
+        txn['success'][0]['request_put']['lease'] = lease.id
+    return txn
 
 
 def delete(key, existing_value=None, mod_revision=None):
@@ -177,42 +228,9 @@ def delete(key, existing_value=None, mod_revision=None):
     """
     client = _get_client()
     LOG.debug("etcdv3 delete key=%s", key)
-    if mod_revision is not None:
-        base64_key = _encode(key)
-        txn = {
-            'compare': [{
-                'key': base64_key,
-                'result': 'EQUAL',
-                'target': 'MOD',
-                'mod_revision': mod_revision,
-            }],
-            'success': [{
-                'request_delete_range': {
-                    'key': base64_key,
-                },
-            }],
-            'failure': [],
-        }
-        result = client.transaction(txn)
-        LOG.debug("transaction result %s", result)
-        deleted = result.get('succeeded', False)
-    elif existing_value is not None:
-        base64_key = _encode(key)
-        base64_existing = _encode(existing_value)
-        txn = {
-            'compare': [{
-                'key': base64_key,
-                'result': 'EQUAL',
-                'target': 'VALUE',
-                'value': base64_existing,
-            }],
-            'success': [{
-                'request_delete_range': {
-                    'key': base64_key,
-                },
-            }],
-            'failure': [],
-        }
+    txn = _delete_txn(key, existing_value=existing_value,
+                      mod_revision=mod_revision)
+    if txn['compare']:
         result = client.transaction(txn)
         LOG.debug("transaction result %s", result)
         deleted = result.get('succeeded', False)
@@ -222,6 +240,139 @@ def delete(key, existing_value=None, mod_revision=None):
     return deleted
 
 
+def _delete_txn(key, existing_value=None, mod_revision=None):
+    """Build the etcd transaction for a single, possibly guarded, delete.
+
+    Arguments are as for delete().  If the delete is not guarded, the returned
+    transaction has an empty 'compare' list.
+    """
+    base64_key = _encode(key)
+    txn = {'compare': []}
+    if mod_revision is not None:
+        txn['compare'] = [{
+            'key': base64_key,
+            'result': 'EQUAL',
+            'target': 'MOD',
+            'mod_revision': mod_revision,
+        }]
+    elif existing_value is not None:
+        txn['compare'] = [{
+            'key': base64_key,
+            'result': 'EQUAL',
+            'target': 'VALUE',
+            'value': _encode(existing_value),
+        }]
+    txn['success'] = [{
+        'request_delete_range': {
+            'key': base64_key,
+        },
+    }]
+    txn['failure'] = []
+    return txn
+
+
+def put_many(writes, with_revision=False):
+    """Write many key/value pairs to etcdv3, in as few requests as possible.
+
+    - writes: an iterable of dicts, each holding the keyword arguments for one
+      call to put(), i.e. 'key' and 'value' and optionally 'mod_revision',
+      'lease' and 'existing_value'.  Each key may only appear once.
+
+    - with_revision (boolean): Indicates also to return the etcdv3 revision
+      of each write.
+
+    Each write is guarded independently, in the same way as for put(), so some
+    writes can succeed while others fail.
+
+    Returns a dict mapping each key to True if its write happened
+    successfully, or False if not.  Or, if with_revision is True, a dict
+    mapping each key to (succeeded, revision) as for put().
+    """
+    txns = []
+    for write in writes:
+        LOG.debug("etcdv3 put_many key=%s mod_revision=%r",
+                  write['key'], write.get('mod_revision'))
+        txns.append((write['key'], _put_txn(**write)))
+    results = _transact_many(txns)
+    if with_revision:
+        return results
+    return dict((key, succeeded)
+                for key, (succeeded, _) in results.items())
+
+
+def delete_many(deletes):
+    """Delete many key/value pairs from etcdv3, in as few requests as possible.
+
+    - deletes: an iterable of dicts, each holding the keyword arguments for
+      one call to delete(), i.e. 'key' and optionally 'mod_revision' or
+      'existing_value'.  Each key may only appear once.
+
+    Returns a dict mapping each key to True if its deletion was successful,
+    or False if not.
+    """
+    txns = []
+    for delete_args in deletes:
+        LOG.debug("etcdv3 delete_many key=%s mod_revision=%r",
+                  delete_args['key'], delete_args.get('mod_revision'))
+        txns.append((delete_args['key'], _delete_txn(**delete_args)))
+    return dict((key, deleted)
+                for key, (deleted, _) in _transact_many(txns).items())
+
+
+def _transact_many(txns):
+    """Execute many single-key transactions, batched into few etcd requests.
+
+    - txns: a list of (key, txn) pairs, where each txn is as built by
+      _put_txn() or _delete_txn().
+
+    Each single-key transaction is nested within an outer transaction that
+    has no compare of its own, so that etcd evaluates each nested compare
+    independently and reports a result for each of them.  The outer
+    transactions are limited to TXN_OPS_LIMIT nested transactions, and
+    roughly TXN_SIZE_LIMIT bytes of request data.
+
+    Returns a dict mapping each key to (succeeded, revision), where
+    succeeded is True if its transaction succeeded, or False if not; and
+    revision is the etcdv3 revision of the outer transaction if the key's
+    transaction succeeded, or else None.
+    """
+    client = _get_client()
+    results = {}
+    batch = []
+    batch_size = 0
+
+    def flush():
+        outer = {
+            'compare': [],
+            'success': [{'request_txn': txn} for _, txn in batch],
+            'failure': [],
+        }
+        result = client.transaction(outer)
+        LOG.debug("batched transaction result %s", result)
+        responses = result.get('responses', [])
+        revision = result.get('header', {}).get('revision')
+        for i, (key, _) in enumerate(batch):
+            succeeded = False
+            if i < len(responses):
+                succeeded = responses[i].get(
+                    'response_txn', {}
+                ).get('succeeded', False)
+            results[key] = (succeeded, revision if succeeded else None)
+
+    for key, txn in txns:
+        txn_size = len(json.dumps(txn))
+        if batch and (len(batch) >= TXN_OPS_LIMIT or
+                      batch_size + txn_size > TXN_SIZE_LIMIT):
+            flush()
+            batch = []
+            batch_size = 0
+        batch.append((key, txn))
+        batch_size += txn_size
+    if batch:
+        flush()
+    return results
+
+
 def delete_prefix(prefix):
     """Best effort deletion of all keys beginning with PREFIX."""
     LOG.debug("etcdv3 delete_prefix prefix=%s", prefix)
@@ -247,6 +398,10 @@ def get_prefix(prefix, revision=None):
     - mod_revision is the revision at which that key was last modified (an
       integer represented as a string).
 
+    The tuples are in descending key order.  When the etcd_read_parallelism
+    option is more than 1, the prefix is split into that many sub-ranges,
+    which are read concurrently at the same revision.
+
     Note: this entrypoint is only used for data outside the Calico v3 data
     model; specifically for legacy Calico v1 status notifications.  This
     entrypoint should be removed once those status notifications have been
@@ -258,42 +413,194 @@ def get_prefix(prefix, revision=None):
         _, revision = get_status()
         LOG.debug("Doing get at current revision: %r", revision)
 
+    range_end = _increment_last_byte(prefix)
+    if _read_parallelism > 1:
+        # Split the prefix into sub-ranges and read those concurrently, all
+        # at the same revision.
+        boundaries = _partition_range(client, prefix, range_end, revision,
+                                      _read_parallelism)
+    else:
+        boundaries = []
+    ranges = list(zip([prefix] + boundaries, boundaries + [range_end]))
+    if len(ranges) > 1:
+        LOG.debug("etcdv3 get_prefix %s in %s ranges", prefix, len(ranges))
+        pool = eventlet.GreenPool(len(ranges))
+        range_results = list(pool.imap(
+            lambda r: list(_iter_range(client, r[0], r[1], revision)),
+            ranges
+        ))
+        # Each range's results are in descending key order, so concatenating
+        # them from the last range to the first gives all of the results in
+        # descending key order, just as for a serial read.
+        tuples = []
+        for results in reversed(range_results):
+            tuples.extend(results)
+    else:
+        tuples = list(_iter_range(client, prefix, range_end, revision))
+    LOG.debug("etcdv3 get_prefix %s results=%s", prefix, len(tuples))
+    return tuples
+
+
+def _iter_range(client, range_start, range_end, revision,
+                sort_order='descend'):
+    # Iterate through all etcdv3 data with range_start <= key < range_end, at
+    # the specified revision, yielding (key, value, mod_revision) tuples in
+    # the specified key order.
+    #
     # The JSON gateway can only return a certain number of bytes in a single
-    # response so we chunk up the read into blocks.
+    # response so we chunk up the read into blocks, adapting the number of
+    # keys in each block so as to stay within _read_chunk_bytes.
     #
     # Since etcd's get protocol has an inclusive range_start and an exclusive
-    # range_end, we load the keys in reverse order.  That way, we can use the
-    # final key in each chunk as the next range_end.
-    range_end = _encode(_increment_last_byte(prefix))
-    results = []
+    # range_end, when loading the keys in reverse order we can use the final
+    # key in each chunk as the next range_end.  When loading in forward order,
+    # we start each chunk from just beyond the final key in the previous
+    # chunk.
+    range_end = _encode(range_end)
+    limit = CHUNK_SIZE_LIMIT
     while True:
         # Note: originally, we included the sort_target parameter here but
         # etcdgw has a bug (https://github.com/dims/etcd3-gateway/issues/18),
         # which prevents that from working.  In any case, sort-by-key is the
         # default, which is what we want.
-        chunk = client.get(prefix,
+        chunk = client.get(range_start,
                            metadata=True,
                            range_end=range_end,
-                           sort_order='descend',
-                           limit=CHUNK_SIZE_LIMIT,
+                           sort_order=sort_order,
+                           limit=limit,
                            revision=str(revision))
-        results.extend(chunk)
-        if len(chunk) < CHUNK_SIZE_LIMIT:
+        for value, item in chunk:
+            yield (item['key'].decode(), value.decode(), item['mod_revision'])
+        if len(chunk) < limit:
             # Partial (or empty) chunk signals that we're done.
             break
         _, data = chunk[-1]
-        range_end = _encode(data["key"])
-
-    LOG.debug("etcdv3 get_prefix %s results=%s", prefix, len(results))
-    tuples = []
-    for result in results:
-        value, item = result
-        t = (item['key'].decode(), value.decode(), item['mod_revision'])
-        tuples.append(t)
-    return tuples
+        if sort_order == 'descend':
+            range_end = _encode(data['key'])
+        else:
+            range_start = data['key'].decode() + '\0'
+        limit = _next_chunk_limit(chunk, limit)
+
+
+def _next_chunk_limit(chunk, limit):
+    # Choose the limit for the next chunk read, given the previous chunk and
+    # its limit, so that - if the next keys and values are similar in size to
+    # those in the previous chunk - the next response will be about
+    # _read_chunk_bytes in size.  We allow the limit to double at most, so as
+    # not to overshoot when sizes vary across the range, but it can shrink as
+    # much as needed.
+    response_bytes = sum(
+        # Keys and values are base64-encoded in the response, and each item
+        # also has some metadata.
+        (len(item['key']) + len(value)) * 4 // 3 + CHUNK_ITEM_OVERHEAD_BYTES
+        for value, item in chunk
+    )
+    bytes_per_item = max(1, response_bytes // len(chunk))
+    return max(CHUNK_SIZE_MIN,
+               min(CHUNK_SIZE_MAX,
+                   2 * limit,
+                   _read_chunk_bytes // bytes_per_item))
+
+
+def _partition_range(client, range_start, range_end, revision, n):
+    # Choose up to n-1 boundary keys that split range_start <= key < range_end
+    # into sub-ranges with similar numbers of keys, without reading all of the
+    # keys.  Returns the boundaries in ascending order.
+    #
+    # We find the first and last keys in the range; the keys in between must
+    # share the longest common prefix of those two keys, and can be bucketed
+    # by the character that follows that common prefix.  Then we count the
+    # keys in each bucket, and group adjacent buckets so as to balance the
+    # counts.  For example, for WorkloadEndpoints, the buckets are typically
+    # determined by the first character of each compute host name.
+    first = client.get(range_start,
+                       metadata=True,
+                       range_end=_encode(range_end),
+                       sort_order='ascend',
+                       limit=1,
+                       revision=str(revision))
+    last = client.get(range_start,
+                      metadata=True,
+                      range_end=_encode(range_end),
+                      sort_order='descend',
+                      limit=1,
+                      revision=str(revision))
+    if not first or not last:
+        return []
+    first_key = first[0][1]['key'].decode()
+    last_key = last[0][1]['key'].decode()
+    common = os.path.commonprefix([first_key, last_key])
+    if len(common) == len(last_key):
+        # There can only be one key in the range.
+        return []
+    low = ord(first_key[len(common)]) if len(first_key) > len(common) else 0
+    high = ord(last_key[len(common)])
+    if high - low >= PARTITION_BUCKETS_LIMIT:
+        LOG.info("Keys from %s to %s span too many characters to partition; "
+                 "reading them serially", first_key, last_key)
+        return []
+
+    # Count the keys in each bucket, concurrently.
+    buckets = [common + chr(c) for c in range(low, high + 1)]
+    pool = eventlet.GreenPool(n)
+    counts = list(pool.imap(
+        lambda b: _count_range(client, b, _increment_last_byte(b), revision),
+        buckets
+    ))
+
+    # Group adjacent buckets greedily, starting a new group whenever the
+    # groups so far contain a fair share of the total number of keys.
+    total = sum(counts)
+    if not total:
+        return []
+    boundaries = []
+    so_far = 0
+    for bucket, count in zip(buckets, counts):
+        if (len(boundaries) < n - 1 and
+                so_far * n >= total * (len(boundaries) + 1)):
+            boundaries.append(bucket)
+        so_far += count
+    LOG.debug("Partitioned %s keys into %s ranges", total, len(boundaries) + 1)
+    return boundaries
+
+
+def _count_range(client, range_start, range_end, revision):
+    # Return the number of keys with range_start <= key < range_end, at the
+    # specified revision.  (We can't use client.get here because it discards
+    # the count in the response.)
+    result = client.post(client.get_url("/kv/range"),
+                         json={"key": _encode(range_start),
+                               "range_end": _encode(range_end),
+                               "count_only": True,
+                               "revision": str(revision)})
+    return int(result.get('count', 0))
+
+
+def iter_prefix(prefix, revision=None):
+    """Iterate through all etcdv3 data whose key begins with a given prefix.
+
+    - prefix (string): The prefix.
 
+    - revision: The revision to do the get at.  If not specified then the
+      current revision is used.
 
-def watch_subtree(prefix, start_revision):
+    This is a generator version of get_prefix, that yields the same (key,
+    value, mod_revision) tuples, but in ascending key order, and reading them
+    from etcd one chunk at a time as the caller iterates.
+    """
+    client = _get_client()
+
+    if revision is None:
+        _, revision = get_status()
+        LOG.debug("Doing get at current revision: %r", revision)
+
+    range_end = _increment_last_byte(prefix)
+    for t in _iter_range(client, prefix, range_end, revision,
+                         sort_order='ascend'):
+        yield t
+
+
+def watch_subtree(prefix, start_revision, progress_notify=False):
     """Watch for changes to etcdv3 data whose key begins with a given prefix.
 
     - prefix (string): The prefix.
@@ -302,6 +609,14 @@ def watch_subtree(prefix, start_revision):
       start watching from.  Events will be reported beginning from, and
       including, this revision.
 
+    - progress_notify (bool): Whether to ask etcd for periodic progress
+      notifications on the watch, which are reported as events like
+
+      {'type': 'PROGRESS',
+       'header': {'revision': <string>}}
+
+      meaning that all events up to that revision have been reported.
+
     Returns a tuple (event_stream, cancel), in which:
 
     - event_stream is a generator that returns the next reported event, or None
@@ -319,6 +634,13 @@ def watch_subtree(prefix, start_revision):
        'kv': {'key': <key>,
               'mod_revision': <string>}}
 
+      If etcd cancels the watch - for example because start_revision has
+      been compacted - the last event is like
+
+      {'type': 'CANCELED',
+       'compact_revision': <string, if the cause was compaction>,
+       'cancel_reason': <string, if etcd gave a reason>}
+
     - cancel is a thunk that can be called to cancel the watch and cause the
       event_stream to return None.
 
@@ -329,8 +651,15 @@ def watch_subtree(prefix, start_revision):
     """
     LOG.debug("Watch subtree %s from revision %r", prefix, start_revision)
     client = _get_client()
+    if cfg.CONF.calico.etcd_watch_multiplexing:
+        return _get_watch_multiplexer().watch(prefix,
+                                              _increment_last_byte(prefix),
+                                              start_revision,
+                                              progress_notify=progress_notify)
+    kwargs = {'progress_notify': True} if progress_notify else {}
     event_stream, cancel = client.watch_prefix(prefix,
-                                               start_revision=start_revision)
+                                               start_revision=start_revision,
+                                               **kwargs)
     return event_stream, cancel
 
 
@@ -345,6 +674,26 @@ def get_status():
     return status['header']['cluster_id'], status['header']['revision']
 
 
+def revision_compacted(key, revision):
+    """Check whether etcd has compacted away a given revision.
+
+    - key (string): a key to read at that revision; it need not exist.
+    - revision (int): the revision to check.
+
+    Returns True if etcd reports that the revision has been compacted, and
+    so can no longer be read or watched from; False otherwise.
+    """
+    client = _get_client()
+    try:
+        client.get(key, count_only=True, revision=str(revision))
+    except Etcd3Exception as e:
+        if 'compacted' in (e.detail_text or ''):
+            LOG.info("Revision %d has been compacted", revision)
+            return True
+        raise
+    return False
+
+
 def request_compaction(revision):
     """Request compaction at the specified revision."""
     client = _get_client()
@@ -364,9 +713,282 @@ def watch_once(key, timeout=None, **kwargs):
     client = _get_client()
     LOG.debug("etcdv3 watch_once %s timeout %r kwargs %r",
               key, timeout, kwargs)
+    if (cfg.CONF.calico.etcd_watch_multiplexing and
+            set(kwargs) <= set(['start_revision'])):
+        return _get_watch_multiplexer().watch_once(key, timeout=timeout,
+                                                   **kwargs)
     return client.watch_once(key, timeout=timeout, **kwargs)
 
 
+class WatchMultiplexer(object):
+    """Watches that share a single etcd watch stream.
+
+    etcd's gRPC gateway reads a sequence of watch requests from the body of
+    a /watch POST, and each watch that they create is identified by a watch
+    ID in the responses.  So one HTTP stream can carry all of a process's
+    watches, instead of each watch having its own connection.
+
+    The request body stays open (see _WatchStream), so adding a watch sends
+    one more create request on the open stream, and removing a watch sends
+    a cancel request for it; the other watches are not affected.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._lock = semaphore.Semaphore()
+
+        # The _MuxWatches that the current stream is for.
+        self._watches = []
+
+        # Watches whose create requests we have sent, in order, for matching
+        # with the 'created' responses; and then the watches by watch ID.
+        self._uncreated = []
+        self._watches_by_id = {}
+
+        # The current stream, and a counter that changes each time that we
+        # replace it, so that a superseded stream's reader knows to stop.
+        self._stream = None
+        self._generation = 0
+
+    def watch(self, key, range_end, start_revision, progress_notify=False):
+        """Watch keys from KEY up to RANGE_END, from START_REVISION.
+
+        RANGE_END may be None to watch just KEY.  Returns (event_stream,
+        cancel) with the same meaning as for watch_subtree.
+        """
+        watch = self._add(key, range_end, start_revision, progress_notify)
+        return watch.events(), lambda: self._remove(watch)
+
+    def watch_once(self, key, timeout=None, start_revision=None):
+        """Wait for and return the next event for KEY."""
+        watch = self._add(key, None, start_revision)
+        try:
+            event = watch.queue.get(timeout=timeout)
+        except queue.Empty:
+            raise WatchTimedOut()
+        finally:
+            self._remove(watch)
+        if event is None:
+            raise Etcd3Exception(detail_text="Watch stream ended")
+        if event.get('type') == 'CANCELED':
+            raise Etcd3Exception(detail_text="Watch cancelled: %s" % event)
+        return event
+
+    def _add(self, key, range_end, start_revision, progress_notify=False):
+        watch = _MuxWatch(key, range_end, start_revision, progress_notify)
+        with self._lock:
+            self._watches.append(watch)
+            try:
+                if self._stream is None:
+                    self._open()
+                self._stream.send({'create_request': watch.create_request()})
+            except Exception:
+                self._end_all()
+                raise
+            self._uncreated.append(watch)
+        return watch
+
+    def _remove(self, watch):
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+                if not self._watches:
+                    self._close()
+                elif watch.watch_id is not None:
+                    self._cancel(watch.watch_id)
+                # Otherwise we cancel the watch when etcd reports that it
+                # has been created.
+            watch.end()
+
+    def _open(self):
+        # Must be called with self._lock held.
+        LOG.debug("Open watch stream")
+        self._stream = _WatchStream(self._client)
+        eventlet.spawn_n(self._read, self._stream, self._generation)
+
+    def _cancel(self, watch_id):
+        # Must be called with self._lock held.
+        del self._watches_by_id[watch_id]
+        try:
+            self._stream.send({'cancel_request': {'watch_id': watch_id}})
+        except Exception:
+            LOG.exception("Failed to cancel watch %s", watch_id)
+            self._end_all()
+
+    def _close(self):
+        # Must be called with self._lock held.
+        self._generation += 1
+        self._uncreated = []
+        self._watches_by_id = {}
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def _end_all(self):
+        # Must be called with self._lock held.
+        for watch in self._watches:
+            watch.end()
+        self._watches = []
+        self._close()
+
+    def _read(self, stream, generation):
+        try:
+            for line in stream.iter_lines():
+                if not line:
+                    continue
+                payload = json.loads(line.decode('utf-8'))
+                if 'result' not in payload:
+                    raise Etcd3Exception(detail_text=line.decode('utf-8'))
+                with self._lock:
+                    if generation != self._generation:
+                        return
+                    self._handle_result(payload['result'])
+        except Exception:
+            LOG.exception("Error reading watch stream")
+        with self._lock:
+            if generation == self._generation:
+                LOG.warning("Watch stream ended")
+                self._end_all()
+
+    def _handle_result(self, result):
+        # Must be called with self._lock held.  Note that etcd omits the
+        # watch ID when it is 0.
+        watch_id = result.get('watch_id', '0')
+        if result.get('created'):
+            watch = self._uncreated.pop(0)
+            watch.watch_id = watch_id
+            self._watches_by_id[watch_id] = watch
+            if watch.ended:
+                # Removed while its create request was outstanding.
+                self._cancel(watch_id)
+                return
+        watch = self._watches_by_id.get(watch_id)
+        if watch is None or watch.ended:
+            return
+        if result.get('canceled') or 'compact_revision' in result:
+            # For example, because the revision to watch from has been
+            # compacted.  etcd may report that with just compact_revision
+            # and no 'canceled' field, but the watch still gets no more
+            # events.
+            LOG.info("Watch for %s cancelled: %s",
+                     watch.key, result.get('cancel_reason') or
+                     'compacted at %s' % result.get('compact_revision'))
+            self._watches.remove(watch)
+            del self._watches_by_id[watch_id]
+            cancellation = {'type': 'CANCELED'}
+            for field in ('compact_revision', 'cancel_reason'):
+                if field in result:
+                    cancellation[field] = result[field]
+            watch.queue.put(cancellation)
+            watch.end()
+            return
+        if 'events' not in result:
+            if watch.progress_notify and not result.get('created'):
+                # A progress notification: all events up to the header's
+                # revision have been reported.
+                revision = result.get('header', {}).get('revision')
+                if revision is None:
+                    return
+                watch.queue.put({'type': 'PROGRESS',
+                                 'header': {'revision': str(revision)}})
+            return
+        for event in result['events']:
+            event['kv']['key'] = _decode(event['kv']['key'])
+            if 'value' in event['kv']:
+                event['kv']['value'] = _decode(event['kv']['value'])
+            watch.queue.put(event)
+
+
+class _MuxWatch(object):
+    """One of the watches in a WatchMultiplexer."""
+
+    def __init__(self, key, range_end, start_revision, progress_notify=False):
+        self.key = key
+        self.range_end = range_end
+        self.start_revision = start_revision
+        self.progress_notify = progress_notify
+        self.watch_id = None
+        self.queue = queue.LightQueue()
+        self.ended = False
+
+    def create_request(self):
+        create_watch = {'key': _encode(self.key)}
+        if self.range_end is not None:
+            create_watch['range_end'] = _encode(self.range_end)
+        if self.start_revision is not None:
+            create_watch['start_revision'] = str(self.start_revision)
+        if self.progress_notify:
+            create_watch['progress_notify'] = True
+        return create_watch
+
+    def end(self):
+        if not self.ended:
+            self.ended = True
+            self.queue.put(None)
+
+    def events(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            yield event
+
+
+class _WatchStream(object):
+    """A /watch POST whose request body stays open.
+
+    requests sends the whole request body before returning the response,
+    so we use http.client directly, with the etcd client's session headers
+    (including any Authorization) and TLS settings, and send the body in
+    chunks, one watch request per chunk, while reading the responses.
+    """
+
+    def __init__(self, client):
+        session = client.session
+        url = parse.urlsplit(client.get_url('/watch'))
+        if url.scheme == 'https':
+            context = ssl.create_default_context(
+                cafile=(session.verify
+                        if isinstance(session.verify, str) else None))
+            if session.verify is False:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            if session.cert:
+                context.load_cert_chain(*session.cert)
+            self._conn = http_client.HTTPSConnection(url.hostname,
+                                                     url.port,
+                                                     context=context)
+        else:
+            self._conn = http_client.HTTPConnection(url.hostname, url.port)
+        self._conn.putrequest('POST', url.path, skip_accept_encoding=True)
+        for name, value in session.headers.items():
+            if name.lower() not in ('accept-encoding', 'content-length'):
+                self._conn.putheader(name, value)
+        self._conn.putheader('Content-Type', 'application/json')
+        self._conn.putheader('Transfer-Encoding', 'chunked')
+        self._conn.endheaders()
+
+    def send(self, request):
+        data = (json.dumps(request) + '\n').encode('utf-8')
+        self._conn.send(b'%x\r\n%s\r\n' % (len(data), data))
+
+    def iter_lines(self):
+        response = self._conn.getresponse()
+        if response.status != 200:
+            raise Etcd3Exception(detail_text=response.read().decode('utf-8'))
+        for line in response:
+            yield line.rstrip(b'\r\n')
+
+    def close(self):
+        # As in etcd3gw.watch.Watcher.stop: shut down the socket so that the
+        # reader wakes up, and then close the connection.
+        try:
+            self._conn.sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        self._conn.close()
+
+
 def get_lease(ttl):
     """Get a lease for the specified TTL (in seconds)."""
     client = _get_client()
@@ -389,6 +1011,19 @@ def logging_exceptions(fn):
 # Internals.
 _client = None
 
+# WatchMultiplexer for the watches of this process, when the [calico]
+# etcd_watch_multiplexing option is set.
+_watch_multiplexer = None
+
+# Number of concurrent requests to use when reading all of the keys under a
+# prefix.  Set from the [calico] etcd_read_parallelism option when we create
+# the etcd client.
+_read_parallelism = 1
+
+# Target size in bytes for each chunk of a ranged read.  Set from the [calico]
+# etcd_read_chunk_bytes option when we create the etcd client.
+_read_chunk_bytes = 1024 * 1024
+
 
 # Possible API paths for connecting to an etcd server.  Defined as a variable
 # here so that test code can override it after importing this file.
@@ -399,12 +1034,13 @@ _possible_etcd_api_paths = ['/v3/', '/v3beta/', '/v3alpha/']
 # Authorization header to the session headers.
 #
 # All of networking-calico's etcd operations go through either (1)
-# etcd3gw.client.Etcd3Client.post, or (2) etcd3gw.watch.Watcher.
-# Here, we hook (1) so as to authenticate when the normal POST request
-# fails; then we add the returned auth token as an Authorization
-# header on the underlying session.  Adding that header to the session
-# means that it will apply to etcd3gw.watch.Watcher, as well as to
-# POST requests for all non-watch operations.
+# etcd3gw.client.Etcd3Client.post, or (2) a watch POST with the session
+# headers, by etcd3gw.watch.Watcher or our WatchMultiplexer.  Here, we
+# hook (1) so as to authenticate when the normal POST request fails;
+# then we add the returned auth token as an Authorization header on the
+# underlying session.  Adding that header to the session means that it
+# will apply to watches, as well as to POST requests for all non-watch
+# operations.
 #
 # The question arises what happens if we do a watch operation before
 # there is correct Authorization on the session?  Firstly this is
@@ -487,6 +1123,16 @@ class Etcd3AuthClient(Etcd3Client):
         # method.
         self.session.headers['Authorization'] = response['token']
 
+    def watch_prefix(self, key_prefix, **kwargs):
+        # Watch using our own code for reading the watch stream, instead of
+        # etcd3gw's, so that the caller also sees progress notifications and
+        # the watch being cancelled by etcd.
+        return WatchMultiplexer(self).watch(
+            key_prefix,
+            _increment_last_byte(key_prefix),
+            kwargs.get('start_revision'),
+            progress_notify=kwargs.get('progress_notify', False))
+
     def post(self, *args, **kwargs):
         # Impose a maximum timeout, according to the [calico]
         # etcd_timeout config parameter.  Imposing a timeout is
@@ -519,8 +1165,12 @@ class Etcd3AuthClient(Etcd3Client):
 
 def _get_client():
     global _client
+    global _read_parallelism
+    global _read_chunk_bytes
     if not _client:
         calico_cfg = cfg.CONF.calico
+        _read_parallelism = calico_cfg.etcd_read_parallelism
+        _read_chunk_bytes = calico_cfg.etcd_read_chunk_bytes
         tls_config_params = [
             calico_cfg.etcd_key_file,
             calico_cfg.etcd_cert_file,
@@ -545,3 +1195,10 @@ def _get_client():
                                       username=calico_cfg.etcd_username,
                                       password=calico_cfg.etcd_password)
     return _client
+
+
+def _get_watch_multiplexer():
+    global _watch_multiplexer
+    if not _watch_multiplexer:
+        _watch_multiplexer = WatchMultiplexer(_get_client())
+    return _watch_multiplexer
@@ -128,6 +128,33 @@ class WorkloadEndpointSyncer(ResourceSyncer):
                                    name,
                                    mod_revision=mod_revision)
 
+    def create_many_in_etcd(self, creates):
+        return datamodel_v3.put_many(self.resource_kind,
+                                     self.namespace,
+                                     [{'name': name,
+                                       'spec': spec,
+                                       'labels': labels,
+                                       'annotations': annotations,
+                                       'mod_revision': 0}
+                                      for name, (spec, labels, annotations)
+                                      in creates])
+
+    def update_many_in_etcd(self, updates):
+        return datamodel_v3.put_many(self.resource_kind,
+                                     self.namespace,
+                                     [{'name': name,
+                                       'spec': spec,
+                                       'labels': labels,
+                                       'annotations': annotations,
+                                       'mod_revision': mod_revision}
+                                      for name, (spec, labels, annotations),
+                                      mod_revision in updates])
+
+    def delete_many_from_etcd(self, deletes):
+        return datamodel_v3.delete_many(self.resource_kind,
+                                        self.namespace,
+                                        deletes)
+
     def get_all_from_neutron(self, context):
         # TODO(lukasa): We could reduce the amount of data we load from Neutron
         # here by filtering in the get_ports call.
@@ -135,6 +162,22 @@ class WorkloadEndpointSyncer(ResourceSyncer):
                     for port in self.db.get_ports(context)
                     if _port_is_endpoint_port(port))
 
+    def get_names_and_ids_from_neutron(self, context):
+        # Load only the fields that we need to construct endpoint names.
+        return [(endpoint_name(port), port['id'])
+                for port in self.db.get_ports(context, fields=[
+                    'id', 'device_owner', 'device_id', 'binding:host_id'
+                ])
+                if _port_is_endpoint_port(port)]
+
+    def get_some_from_neutron(self, context, port_ids):
+        return self.db.get_ports(context, filters={'id': port_ids})
+
+    def iter_all_from_etcd(self):
+        return datamodel_v3.iter_all(self.resource_kind,
+                                     self.namespace,
+                                     with_labels_and_annotations=True)
+
     def neutron_to_etcd_write_data(self, port, context, reread=False):
         if reread:
             try:
@@ -146,6 +189,28 @@ class WorkloadEndpointSyncer(ResourceSyncer):
                 endpoint_labels(port, self.namespace),
                 endpoint_annotations(port))
 
+    def neutron_to_etcd_write_data_many(self, items, context, reread=False):
+        ports_by_name = dict(items)
+        if reread:
+            port_ids = [port['id'] for port in ports_by_name.values()]
+            current_ports = dict(
+                (port['id'], port)
+                for port in self.db.get_ports(context,
+                                              filters={'id': port_ids})
+            )
+            for name, port in list(ports_by_name.items()):
+                if port['id'] in current_ports:
+                    ports_by_name[name] = current_ports[port['id']]
+                else:
+                    # Gone; ResourceSyncer reports this.
+                    del ports_by_name[name]
+        self.add_extra_ports_information(context,
+                                         list(ports_by_name.values()))
+        return dict((name, (endpoint_spec(port),
+                            endpoint_labels(port, self.namespace),
+                            endpoint_annotations(port)))
+                    for name, port in ports_by_name.items())
+
     def write_endpoint(self, port, context, must_update=False):
         # Reread the current port. This protects against concurrent writes
         # breaking our state.
@@ -243,6 +308,149 @@ class WorkloadEndpointSyncer(ResourceSyncer):
 
         return port
 
+    def get_security_groups_for_ports(self, context, port_ids):
+        """Bulk version of get_security_groups_for_port.
+
+        Returns a dict mapping each port ID to a list of security group IDs.
+        """
+        sgids_by_port = dict((port_id, []) for port_id in port_ids)
+        bindings = self.db._get_port_security_group_bindings(
+            context, filters={'port_id': port_ids}
+        )
+        for binding in bindings:
+            sgids_by_port[binding['port_id']].append(
+                binding['security_group_id']
+            )
+        return sgids_by_port
+
+    def get_fixed_ips_for_ports(self, context, port_ids):
+        """Bulk version of get_fixed_ips_for_port.
+
+        Returns a dict mapping each port ID to a list of fixed IPs.
+        """
+        fixed_ips_by_port = dict((port_id, []) for port_id in port_ids)
+        for ip in context.session.query(
+            models_v2.IPAllocation
+        ).filter(
+            models_v2.IPAllocation.port_id.in_(port_ids)
+        ):
+            fixed_ips_by_port[ip['port_id']].append(
+                {'subnet_id': ip['subnet_id'],
+                 'ip_address': ip['ip_address']}
+            )
+        return fixed_ips_by_port
+
+    def get_floating_ips_for_ports(self, context, port_ids):
+        """Bulk version of get_floating_ips_for_port.
+
+        Returns a dict mapping each port ID to a list of floating IPs.
+        """
+        floating_ips_by_port = dict((port_id, []) for port_id in port_ids)
+        for ip in context.session.query(
+            FloatingIP
+        ).filter(
+            FloatingIP.fixed_port_id.in_(port_ids)
+        ):
+            floating_ips_by_port[ip['fixed_port_id']].append(
+                {'int_ip': ip['fixed_ip_address'],
+                 'ext_ip': ip['floating_ip_address']}
+            )
+        return floating_ips_by_port
+
+    def add_extra_ports_information(self, context, ports):
+        """add_extra_ports_information
+
+        Bulk version of add_extra_port_information, for use when processing
+        many ports at once, as in a resync.  This reads the extra information
+        for all of the given ports with a small number of Neutron DB queries,
+        instead of several queries per port.
+        """
+        if not ports:
+            return ports
+        port_ids = [port['id'] for port in ports]
+        fixed_ips = self.get_fixed_ips_for_ports(context, port_ids)
+        floating_ips = self.get_floating_ips_for_ports(context, port_ids)
+        security_groups = self.get_security_groups_for_ports(context,
+                                                             port_ids)
+        for port in ports:
+            port['fixed_ips'] = fixed_ips[port['id']]
+            port['floating_ips'] = floating_ips[port['id']]
+            port['security_groups'] = security_groups[port['id']]
+            self.add_port_interface_name(port)
+        self.add_ports_gateways(ports, context)
+        self.add_ports_project_data(ports)
+        self.add_ports_sg_names(ports, context)
+
+        return ports
+
+    def add_ports_gateways(self, ports, context):
+        """add_ports_gateways
+
+        Bulk version of add_port_gateways.
+        """
+        subnet_ids = set(ip['subnet_id']
+                         for port in ports
+                         for ip in port['fixed_ips'])
+        gateways = dict(
+            (subnet['id'], subnet['gateway_ip'])
+            for subnet in self.db.get_subnets(
+                context, filters={'id': list(subnet_ids)}
+            )
+        )
+        for port in ports:
+            for ip in port['fixed_ips']:
+                if ip['subnet_id'] not in gateways:
+                    # Not expected, but handle in the same way as for a
+                    # single port.
+                    subnet = self.db.get_subnet(context, ip['subnet_id'])
+                    gateways[ip['subnet_id']] = subnet['gateway_ip']
+                ip['gateway'] = gateways[ip['subnet_id']]
+
+    def add_ports_sg_names(self, ports, context):
+        """add_ports_sg_names
+
+        Bulk version of add_port_sg_names.
+        """
+        sgids = set(sgid
+                    for port in ports
+                    for sgid in port['security_groups'])
+        sg_names = {}
+        filters = {'id': list(sgids)}
+        for sg in self.db.get_security_groups(context, filters=filters,
+                                              default_sg=True):
+            sg_names[sg['id']] = datamodel_v3.sanitize_label_name_value(
+                sg['name'],
+                SG_NAME_MAX_LENGTH
+            )
+        for port in ports:
+            port[PORT_KEY_SG_NAMES] = dict(
+                (sgid, sg_names[sgid])
+                for sgid in port['security_groups']
+                if sgid in sg_names
+            )
+
+    def add_ports_project_data(self, ports):
+        """add_ports_project_data
+
+        Bulk version of add_port_project_data.  This queries Keystone at most
+        once, however many of the ports' projects are not yet cached.
+        """
+        proj_ids = set(port.get('project_id', port.get('tenant_id'))
+                       for port in ports)
+        proj_ids.discard(None)
+        if any(proj_id not in self.proj_data_cache for proj_id in proj_ids):
+            self.cache_port_project_data()
+        for port in ports:
+            proj_id = port.get('project_id', port.get('tenant_id'))
+            if proj_id is None:
+                LOG.warning("Port with no project ID: %r", port)
+                continue
+            proj_data = self.proj_data_cache.get(proj_id)
+            if proj_data is None:
+                LOG.warning("Unable to find project data for port: %r", port)
+                continue
+            port[PORT_KEY_PROJ_DATA] = proj_data
+
     def add_port_gateways(self, port, context):
         """add_port_gateways
 
@@ -26,6 +26,7 @@
 # It is implemented as a Neutron/ML2 mechanism driver.
 import contextlib
 from functools import wraps
+import heapq
 import inspect
 import os
 import re
@@ -52,7 +53,9 @@ try:
 except ImportError:
     # Neutron code prior to a2c36d7e (10th November 2017).
     from neutron.plugins.ml2 import driver_api as api
+from neutron.db import models_v2
 from neutron.plugins.ml2.drivers import mech_agent
+from neutron.plugins.ml2 import models as ml2_models
 from sqlalchemy import exc as sa_exc
 
 # Monkeypatch import
@@ -99,6 +102,26 @@ calico_opts = [
     cfg.IntOpt('num_port_status_threads', default=4,
                help="Number of threads to use for writing port status "
                     "updates to the database."),
+    cfg.IntOpt('port_status_batch_size', default=1, min=1,
+               help="Maximum number of port status updates that each port "
+                    "status thread writes to the database in a single "
+                    "transaction.  With the default of 1, each update is "
+                    "written using the ML2 plugin's update_port_status(). "
+                    "With a larger value, pending updates are written in "
+                    "batches by setting the status of each port directly, "
+                    "which is much faster when there are many updates, "
+                    "as at start of day, but does not generate the ML2 "
+                    "plugin's port update callbacks; and the status is "
+                    "only written if it was reported for the host that "
+                    "the port is bound to."),
+    cfg.IntOpt('etcd_progress_notify_interval', default=0, min=0,
+               help="If non-zero, the interval in seconds at which the etcd "
+                    "server sends watch progress notifications, as set by "
+                    "its --experimental-watch-progress-notify-interval "
+                    "flag.  Then the Neutron server uses those notifications "
+                    "to check that its watch of the Felix status tree is "
+                    "working, instead of regularly writing a round-trip key "
+                    "into that tree."),
     cfg.IntOpt('etcd_compaction_period_mins', default=60,
                help="Interval in minutes between periodic etcd compactions. "
                     "A setting of 0 tells this Calico driver not to request "
@@ -111,6 +134,11 @@ calico_opts = [
                     "of the previous etcd_compaction_period_mins interval."),
     cfg.IntOpt('project_name_cache_max', default=100,
                help="The maximum allowed size of our cache of project names."),
+    cfg.BoolOpt('resync_streaming', default=False,
+                help="Whether periodic resyncs should stream through the "
+                     "etcd and Neutron data in name order, instead of "
+                     "loading all of it into memory at once.  This bounds "
+                     "the memory used by a resync in a large deployment."),
 ]
 cfg.CONF.register_opts(calico_opts, 'calico')
 
@@ -129,6 +157,10 @@ PORT_STATUS_MAPPING = {
     datamodel_v1.ENDPOINT_STATUS_DOWN: constants.PORT_STATUS_DOWN,
     datamodel_v1.ENDPOINT_STATUS_ERROR: constants.PORT_STATUS_ERROR,
 }
+# And the reverse mapping, from neutron's port status to our endpoint status.
+CALICO_STATUS_FOR_PORT_STATUS = dict(
+    (v, k) for k, v in PORT_STATUS_MAPPING.items()
+)
 
 # The interval between period resyncs, in seconds.
 # TODO(nj): Increase this to a longer interval for product code.
@@ -181,6 +213,50 @@ def requires_state(f):
     return wrapper
 
 
+class CoalescingPriorityQueue(PriorityQueue):
+    """Priority queue of (priority, key) items, holding at most one per key.
+
+    Putting an item whose key is already queued does not add another item
+    for that key.  Instead, if the new priority is better (i.e. lower) than
+    the queued one, the queued item is upgraded in place, so that it will be
+    got sooner; otherwise the put has no effect.  This suits queueing work
+    where getting a key means "process the latest state for that key", as for
+    port status updates, because the processing for several puts of the same
+    key can be done just once.
+
+    qsize() returns the number of distinct keys that are queued, and each of
+    them is one unfinished task for task_done() and join().
+    """
+
+    def _init(self, maxsize):
+        super(CoalescingPriorityQueue, self)._init(maxsize)
+        # Mapping from each queued key to its current priority.  When an item
+        # is upgraded we push a new heap entry for it, leaving the old entry
+        # in the heap, and discard the old entry when it reaches the top of
+        # the heap.
+        self._priorities = {}
+
+    def qsize(self):
+        return len(self._priorities)
+
+    def _put(self, item, *args):
+        priority, key = item
+        queued_priority = self._priorities.get(key)
+        if queued_priority is None or priority < queued_priority:
+            self._priorities[key] = priority
+            heapq.heappush(self.queue, item)
+            if queued_priority is None:
+                # A newly queued key, rather than an upgrade.
+                self._put_bookkeeping()
+
+    def _get(self, *args):
+        while True:
+            priority, key = heapq.heappop(self.queue)
+            if self._priorities.get(key) == priority:
+                del self._priorities[key]
+                return priority, key
+
+
 class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
     """Neutron/ML2 mechanism driver for Project Calico.
 
@@ -211,13 +287,20 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         # hostname is included to disambiguate between multiple copies of a
         # port, which may exist during a migration or a re-schedule.
         self._port_status_cache = {}
+        # Keys that we seeded into _port_status_cache from the Neutron DB,
+        # and that no status report from etcd has confirmed yet.
+        self._seeded_port_status_keys = set()
         # Queue used to fan out port status updates to worker threads.  Notes:
         # * we don't recreate the queue in _post_fork_init() so that we can't
         #   possibly lose updates that had already been queued.
         # * the queue contains tuples (priority, <status key>); we use a
         #   higher priority for events and a lower priority for snapshot
         #   keys, so that current data skips the queue.
-        self._port_status_queue = PriorityQueue()
+        # * the queue holds at most one entry for each status key, whose
+        #   priority is upgraded if the key is queued again at a higher
+        #   priority; the writer threads always write the latest status from
+        #   _port_status_cache, so one entry per key is enough.
+        self._port_status_queue = CoalescingPriorityQueue()
         self._port_status_queue_too_long = False
 
         # RPC client for fanning out agent state reports.
@@ -418,6 +501,10 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
                     LOG.error("StatusWatcher %s died", self._etcd_watcher)
                     self._etcd_watcher.stop()
                     self._etcd_watcher = None
+                # Report the number of ports with pending status updates.
+                qsize = self._port_status_queue.qsize()
+                if qsize:
+                    LOG.info("Port status update queue depth: %s", qsize)
             else:
                 if self._etcd_watcher is not None:
                     LOG.warning("No longer master, stopping StatusWatcher")
@@ -472,8 +559,9 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         # sync in the resync case too; however,
         #
         # - the impact on the database of sending port status updates to
-        #   Neutron for all ports is significant (we do have to do it as
-        #   start-of-day, because our cache is empty)
+        #   Neutron for all ports is significant (which is why, at
+        #   start-of-day, we seed our cache from the statuses that the
+        #   Neutron DB already has)
         #
         # - the impact of an incorrect port status for a normal, live VM is
         #   minimal (and it shouldn't get out of sync unless another component
@@ -484,6 +572,7 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         #   is that the VM (re)build fails; but if we're doing a resync then
         #   we must have been disconnected from the datastore and that means
         #   the (re)build is already likely to fail due to the disconnection.
+        self._seeded_port_status_keys.discard(port_status_key)
         if (priority == "high" or
                 self._port_status_cache.get(port_status_key) != calico_status):
             LOG.info("Status of port %s on host %s changed to %s",
@@ -531,15 +620,156 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
                 LOG.warning("Port status update queue back to normal: %s",
                             qsize)
 
+    def seed_port_status_cache(self):
+        """Seed our port status cache with the statuses in the Neutron DB.
+
+        Called by the StatusWatcher before it processes its first snapshot,
+        so that snapshot statuses that Neutron already has are not written
+        again.  We read the status and bound host of all endpoint ports in a
+        single query, and add cache entries for any (hostname, port-id) keys
+        that aren't already cached.  Once the snapshot is complete,
+        prune_port_status_cache() removes the entries that it didn't
+        confirm.
+        """
+        admin_context = ctx.get_admin_context()
+        seeded = 0
+        try:
+            with self._txn_from_context(admin_context,
+                                        tag="seed-port-statuses"):
+                rows = admin_context.session.query(
+                    models_v2.Port.id,
+                    models_v2.Port.status,
+                    models_v2.Port.device_owner,
+                    ml2_models.PortBinding.host
+                ).join(
+                    ml2_models.PortBinding,
+                    ml2_models.PortBinding.port_id == models_v2.Port.id
+                )
+                for port_id, status, device_owner, host in rows:
+                    if not _port_is_endpoint_port(
+                            {'device_owner': device_owner}):
+                        continue
+                    calico_status = CALICO_STATUS_FOR_PORT_STATUS.get(status)
+                    if calico_status is None or not host:
+                        continue
+                    port_status_key = (intern_string(host), port_id)
+                    if port_status_key not in self._port_status_cache:
+                        self._port_status_cache[port_status_key] = \
+                            intern_string(calico_status)
+                        self._seeded_port_status_keys.add(port_status_key)
+                        seeded += 1
+        except Exception:
+            # Seeding is only an optimization, so carry on without it.
+            LOG.exception("Failed to seed port status cache")
+        else:
+            LOG.info("Seeded port status cache with %s statuses", seeded)
+
+    def prune_port_status_cache(self):
+        """Remove seeded port statuses that etcd has not reported.
+
+        Called by the StatusWatcher after its first complete snapshot, which
+        reports every port status in etcd; so any seeded entry that is still
+        unconfirmed is for a port that Felix has no status for, and we
+        shouldn't keep it.
+        """
+        for port_status_key in self._seeded_port_status_keys:
+            self._port_status_cache.pop(port_status_key, None)
+        LOG.info("Pruned %s unconfirmed statuses from port status cache",
+                 len(self._seeded_port_status_keys))
+        self._seeded_port_status_keys = set()
+
     @logging_exceptions(LOG)
     def _loop_writing_port_statuses(self, expected_epoch):
         LOG.info("Port status write thread started epoch=%s", expected_epoch)
         admin_context = ctx.get_admin_context()
+        batch_size = cfg.CONF.calico.port_status_batch_size
         while self._epoch == expected_epoch:
             # Wait for work to do.
             _, port_status_key = self._port_status_queue.get()
-            # Actually do the update.
-            self._try_to_update_port_status(admin_context, port_status_key)
+            if batch_size > 1:
+                # Take as many more updates as are already pending, up to the
+                # batch size, and write them all together.
+                port_status_keys = [port_status_key]
+                while (len(port_status_keys) < batch_size and
+                       self._port_status_queue.qsize()):
+                    _, port_status_key = self._port_status_queue.get()
+                    port_status_keys.append(port_status_key)
+                self._try_to_update_port_statuses(admin_context,
+                                                  port_status_keys)
+            else:
+                # Actually do the update.
+                self._try_to_update_port_status(admin_context,
+                                                port_status_key)
+
+    def _try_to_update_port_statuses(self, admin_context, port_status_keys):
+        """Attempts to update many port statuses in a single transaction.
+
+        :param admin_context: Admin context to pass to Neutron.  Should be
+               unique for each thread.
+        :param port_status_keys: list of tuples of hostname, port_id.
+
+        If the batched write fails, falls back to updating each port status
+        individually, with retries, as _try_to_update_port_status does.
+        """
+        # Map each status key to the Neutron status that we want to write.
+        neutron_statuses = {}
+        for port_status_key in port_status_keys:
+            calico_status = self._port_status_cache.get(port_status_key)
+            if calico_status:
+                neutron_statuses[port_status_key] = \
+                    PORT_STATUS_MAPPING[calico_status]
+            else:
+                # Report deletion as error, as in _try_to_update_port_status.
+                neutron_statuses[port_status_key] = \
+                    constants.PORT_STATUS_ERROR
+        port_ids = set(port_id for _, port_id in port_status_keys)
+        LOG.info("Updating status of %s ports", len(port_ids))
+
+        try:
+            with self._txn_from_context(admin_context,
+                                        tag="update-port-statuses"):
+                # Read the ports, and the hosts that they are bound to, in a
+                # single query.  Only the active binding counts: during a
+                # live migration, a port also has an inactive binding to
+                # the destination host, and a status from there must not
+                # overwrite the port's status before the cutover.  Note that
+                # we set the status of each port through the ORM, rather
+                # than with a bulk UPDATE, so that Neutron's Nova notifier
+                # still sees the status changes.
+                rows = admin_context.session.query(
+                    models_v2.Port,
+                    ml2_models.PortBinding.host
+                ).join(
+                    ml2_models.PortBinding,
+                    ml2_models.PortBinding.port_id == models_v2.Port.id
+                ).filter(
+                    models_v2.Port.id.in_(port_ids),
+                    ml2_models.PortBinding.status == constants.ACTIVE
+                )
+                updated = set()
+                for port, host in rows:
+                    port_status_key = (host, port.id)
+                    neutron_status = neutron_statuses.get(port_status_key)
+                    if neutron_status is None:
+                        continue
+                    updated.add(port_status_key)
+                    if port.status != neutron_status:
+                        LOG.debug("Updating port %s status to %s",
+                                  port.id, neutron_status)
+                        port.status = neutron_status
+        except (db_exc.DBError, sa_exc.SQLAlchemyError) as e:
+            LOG.warning("Failed to update port statuses for %s ports due to "
+                        "%r; falling back to individual updates.",
+                        len(port_ids), e)
+            for port_status_key in port_status_keys:
+                self._try_to_update_port_status(admin_context,
+                                                port_status_key)
+        else:
+            for port_status_key in set(port_status_keys) - updated:
+                # Either the port has been deleted, or it is not (or no
+                # longer) bound to the host that reported this status.
+                LOG.debug("Skipped status update for %s", port_status_key)
+            LOG.debug("Updated status of %s ports", len(updated))
 
     def _try_to_update_port_status(self, admin_context, port_status_key):
         """Attempts to update the given port status.
@@ -78,10 +78,45 @@ class PolicySyncer(ResourceSyncer):
                                    name,
                                    mod_revision=mod_revision)
 
+    def create_many_in_etcd(self, creates):
+        return datamodel_v3.put_many(self.resource_kind,
+                                     self.namespace,
+                                     [{'name': name,
+                                       'spec': spec,
+                                       'mod_revision': 0}
+                                      for name, spec in creates])
+
+    def update_many_in_etcd(self, updates):
+        return datamodel_v3.put_many(self.resource_kind,
+                                     self.namespace,
+                                     [{'name': name,
+                                       'spec': spec,
+                                       'mod_revision': mod_revision}
+                                      for name, spec, mod_revision in updates])
+
+    def delete_many_from_etcd(self, deletes):
+        return datamodel_v3.delete_many(self.resource_kind,
+                                        self.namespace,
+                                        deletes)
+
     def get_all_from_neutron(self, context):
         return dict((SG_NAME_PREFIX + sg['id'], sg)
                     for sg in self.db.get_security_groups(context))
 
+    def get_names_and_ids_from_neutron(self, context):
+        return [(SG_NAME_PREFIX + sg['id'], sg['id'])
+                for sg in self.db.get_security_groups(context,
+                                                      fields=['id'])]
+
+    def get_some_from_neutron(self, context, sgids):
+        return self.db.get_security_groups(context, filters={'id': sgids})
+
+    def iter_all_from_etcd(self):
+        for r in datamodel_v3.iter_all(self.resource_kind, self.namespace):
+            name, _, _ = r
+            if name.startswith(SG_NAME_PREFIX):
+                yield r
+
     def neutron_to_etcd_write_data(self, sg, context, reread=False):
         if reread:
             # We don't need to reread the SG row itself here, because we don't
@@ -98,9 +133,10 @@ class PolicySyncer(ResourceSyncer):
         rules = self.db.get_security_group_rules(
             context, filters={'security_group_id': sgids}
         )
-        for sgid in sgids:
-            self.update_in_etcd(SG_NAME_PREFIX + sgid,
-                                policy_spec(sgid, rules))
+        self.update_many_in_etcd([(SG_NAME_PREFIX + sgid,
+                                   policy_spec(sgid, rules),
+                                   None)
+                                  for sgid in sgids])
 
 
 def policy_spec(sgid, rules):
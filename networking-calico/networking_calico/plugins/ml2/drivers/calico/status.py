@@ -22,7 +22,9 @@ import collections
 import json
 
 from networking_calico.common import config as calico_config
+from networking_calico.compat import cfg
 from networking_calico.compat import log
+from networking_calico import datamodel_v1
 from networking_calico import datamodel_v2
 from networking_calico import etcdutils
 
@@ -63,14 +65,26 @@ class StatusWatcher(etcdutils.EtcdWatcher):
     def __init__(self, calico_driver):
         self.region_string = calico_config.get_region_string()
         status_path = datamodel_v2.felix_status_dir(self.region_string)
-        super(StatusWatcher, self).__init__(status_path, "/round-trip-check")
+        progress_notify_interval = (
+            cfg.CONF.calico.etcd_progress_notify_interval)
+        if progress_notify_interval:
+            # Check our watch using etcd's progress notifications.
+            super(StatusWatcher, self).__init__(
+                status_path,
+                progress_notify_interval=progress_notify_interval,
+                snapshot_changes_only=True)
+        else:
+            super(StatusWatcher, self).__init__(status_path,
+                                                "/round-trip-check",
+                                                snapshot_changes_only=True)
         self.calico_driver = calico_driver
 
         self.processing_snapshot = False
 
-        # Track the set of endpoints that are on each host so we can spot
-        # removed endpoints during a resync.
-        self._endpoints_by_host = collections.defaultdict(set)
+        # Whether we have seeded the driver's port status cache yet, and
+        # whether it still needs pruning after a complete snapshot.
+        self._port_status_cache_seeded = False
+        self._port_status_cache_needs_prune = False
 
         # Map of live Felix notifications: hostname -> the latest mod_revision
         # that we have handled for that host.  We track mod_revision because
@@ -90,32 +104,28 @@ class StatusWatcher(etcdutils.EtcdWatcher):
         LOG.info("StatusWatcher created")
 
     def _pre_snapshot_hook(self):
-        # Save off current endpoint status, then reset current state, so we
-        # will be able to identify any changes in the new snapshot.
-        old_endpoints_by_host = self._endpoints_by_host
-        self._endpoints_by_host = collections.defaultdict(set)
+        # Before the first snapshot, seed the driver's port status cache from
+        # the Neutron DB, so that the driver only writes statuses that differ
+        # from what Neutron already has.
+        if not self._port_status_cache_seeded:
+            self.calico_driver.seed_port_status_cache()
+            self._port_status_cache_seeded = True
+            self._port_status_cache_needs_prune = True
+
+        # A snapshot only dispatches the endpoints that have changed, or
+        # been deleted, since the previous one, so there is nothing else to
+        # reconcile here.
         self.processing_snapshot = True
-        return old_endpoints_by_host
-
-    def _post_snapshot_hook(self, old_endpoints_by_host):
-        # Look for previous endpoints that are no longer present...
-        for hostname, ep_ids in old_endpoints_by_host.items():
-            LOG.info("host: %s", hostname)
-            # Avoid self._endpoints_by_host[hostname] since that would
-            # auto-create the entry in the new dict, which would cause a
-            # leak.
-            new_ep_ids = self._endpoints_by_host.get(hostname, set())
-            # Check for particular endpoints that have disappeared, and
-            # signal those.
-            for ep_id in ep_ids.difference(new_ep_ids):
-                LOG.info("signal None for %s", ep_id.endpoint)
-                self.calico_driver.on_port_status_changed(
-                    hostname,
-                    ep_id.endpoint,
-                    None,
-                    priority="low")
+
+    def _post_snapshot_hook(self, _):
         self.processing_snapshot = False
 
+        # The first complete snapshot has now reported every port status in
+        # etcd, so the driver can drop seeded statuses that it didn't report.
+        if self._port_status_cache_needs_prune:
+            self.calico_driver.prune_port_status_cache()
+            self._port_status_cache_needs_prune = False
+
     def _on_status_set(self, response, hostname):
         """Called when a felix uptime report is inserted/updated."""
         try:
@@ -149,15 +159,12 @@ class StatusWatcher(etcdutils.EtcdWatcher):
     def _on_ep_set(self, response, hostname, workload, endpoint):
         """Called when the status key for a particular endpoint is updated.
 
-        Reports the status to the driver and caches the existence of the
-        endpoint.
+        Reports the status to the driver.
         """
-        ep_id = datamodel_v2.get_endpoint_id_from_key(self.region_string,
-                                                      response.key)
-        if not ep_id:
-            LOG.error("Failed to extract endpoint ID from: %s.  Ignoring "
-                      "update!", response.key)
-            return
+        ep_id = datamodel_v1.WloadEndpointId(hostname,
+                                             "openstack",
+                                             workload,
+                                             endpoint)
         self._report_status(ep_id, response.value)
 
     def _report_status(self, endpoint_id, raw_json):
@@ -166,11 +173,6 @@ class StatusWatcher(etcdutils.EtcdWatcher):
         except (ValueError, TypeError):
             LOG.error("Bad JSON data for %s: %s", endpoint_id, raw_json)
             status = None  # Report as error
-            self._endpoints_by_host[endpoint_id.host].discard(endpoint_id)
-            if not self._endpoints_by_host[endpoint_id.host]:
-                del self._endpoints_by_host[endpoint_id.host]
-        else:
-            self._endpoints_by_host[endpoint_id.host].add(endpoint_id)
         LOG.debug("Port %s updated to status %s", endpoint_id, status)
         self.calico_driver.on_port_status_changed(
             endpoint_id.host,
@@ -186,11 +188,6 @@ class StatusWatcher(etcdutils.EtcdWatcher):
         the deletion to the driver.
         """
         LOG.debug("Port %s/%s/%s deleted", hostname, workload, endpoint)
-        endpoint_id = datamodel_v2.get_endpoint_id_from_key(self.region_string,
-                                                            response.key)
-        self._endpoints_by_host[hostname].discard(endpoint_id)
-        if not self._endpoints_by_host[hostname]:
-            del self._endpoints_by_host[hostname]
         self.calico_driver.on_port_status_changed(
             hostname,
             endpoint,
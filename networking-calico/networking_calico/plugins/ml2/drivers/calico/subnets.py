@@ -49,6 +49,20 @@ class SubnetSyncer(ResourceSyncer):
                     for subnet in self.db.get_subnets(context)
                     if subnet['enable_dhcp'])
 
+    def get_names_and_ids_from_neutron(self, context):
+        return [(datamodel_v2.key_for_subnet(subnet['id'],
+                                             self.region_string),
+                 subnet['id'])
+                for subnet in self.db.get_subnets(context,
+                                                  fields=['id', 'enable_dhcp'])
+                if subnet['enable_dhcp']]
+
+    def get_some_from_neutron(self, context, subnet_ids):
+        return self.db.get_subnets(context, filters={'id': subnet_ids})
+
+    def iter_all_from_etcd(self):
+        return etcdv3.iter_prefix(datamodel_v2.subnet_dir(self.region_string))
+
     def neutron_to_etcd_write_data(self, subnet, context, reread=False):
         if reread:
             subnets = self.db.get_subnets(context,
@@ -67,6 +81,20 @@ class SubnetSyncer(ResourceSyncer):
     def delete_from_etcd(self, key, mod_revision=None):
         return etcdv3.delete(key, mod_revision=mod_revision)
 
+    def create_many_in_etcd(self, creates):
+        return etcdv3.put_many([{'key': key, 'value': value, 'mod_revision': 0}
+                                for key, value in creates])
+
+    def update_many_in_etcd(self, updates):
+        return etcdv3.put_many([{'key': key,
+                                 'value': value,
+                                 'mod_revision': mod_revision}
+                                for key, value, mod_revision in updates])
+
+    def delete_many_from_etcd(self, deletes):
+        return etcdv3.delete_many([{'key': key, 'mod_revision': mod_revision}
+                                   for key, mod_revision in deletes])
+
     @etcdv3.logging_exceptions
     def subnet_created(self, subnet, context):
         """Write data to etcd to describe a DHCP-enabled subnet."""
@@ -13,15 +13,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from networking_calico.compat import cfg
 from networking_calico.compat import log
+from networking_calico import etcdv3
 
 LOG = log.getLogger(__name__)
 
+# Maximum number of resources whose Neutron data we translate within a single
+# Neutron DB transaction, when comparing against existing etcd data during a
+# resync.
+NEUTRON_BATCH_SIZE = 1000
+
 
 class ResourceGone(Exception):
     pass
 
 
+class _OutOfOrder(Exception):
+    pass
+
+
+def _check_order(resources, source):
+    # Pass through an iteration of resources, whose first element is the
+    # resource name, checking that the names are strictly increasing.
+    last_name = None
+    for resource in resources:
+        if last_name is not None and resource[0] <= last_name:
+            raise _OutOfOrder("%s resource %s after %s" %
+                              (source, resource[0], last_name))
+        last_name = resource[0]
+        yield resource
+
+
 class ResourceSyncer(object):
     """Logic for syncing one kind of Calico resource to etcd.
 
@@ -64,14 +87,14 @@ class ResourceSyncer(object):
     periodic resyncing can take a relatively long time in a non-trivial
     deployment.
 
-    When writing a resource that was missing in etcd, it:
+    When writing resources that were missing in etcd, it:
 
     - holds a transaction on the Neutron DB
 
-    - rereads the relevant Neutron object, and jumps out if it no longer exists
+    - rereads the relevant Neutron objects, and skips any that no longer exist
 
-    - submits an etcd transaction to write corresponding Calico data only if
-      that _creates_ the relevant etcd key
+    - submits etcd transactions to write corresponding Calico data, each only
+      if that _creates_ the relevant etcd key
 
     - releases the Neutron DB transaction.
 
@@ -83,6 +106,15 @@ class ResourceSyncer(object):
     When deleting a stale etcd resource, it uses an etcd transaction that only
     deletes if the mod_revision of the relevant etcd key is still what it was
     when the syncer read the incorrect data.
+
+    Writes and deletions are batched, so that many of the per-resource etcd
+    transactions described above can be submitted in a single request; but
+    each resource is still guarded independently.
+
+    When the resync_streaming option is set, the resync instead iterates
+    through the etcd and Neutron resources in name order, merging the two
+    streams, so that it never needs to hold all of the data for a resource
+    type in memory at once.
     """
     def __init__(self, db, txn_from_context, resource_kind):
         self.db = db
@@ -90,6 +122,27 @@ class ResourceSyncer(object):
         self.resource_kind = resource_kind
 
     def resync(self, context):
+        if cfg.CONF.calico.resync_streaming:
+            try:
+                self._resync_streaming(context)
+            except _OutOfOrder as e:
+                # Not expected, but can be handled by falling back to a
+                # non-streaming resync.  Any writes that we have already made
+                # are guarded, so will not be repeated.
+                LOG.warning("Streaming resync for %s failed (%s); falling "
+                            "back to non-streaming resync",
+                            self.resource_kind, e)
+                self._resync(context)
+        else:
+            self._resync(context)
+
+        # Delete any legacy etcd data for this kind of resource.  (For example,
+        # how this resource was represented in a previous release.)
+        self.delete_legacy_etcd_data()
+
+        LOG.info("Resync for %s; done.", self.resource_kind)
+
+    def _resync(self, context):
         LOG.info("Starting resync for %s; getting data from etcd...",
                  self.resource_kind)
 
@@ -109,84 +162,294 @@ class ResourceSyncer(object):
         # already compared the existing etcd data against Neutron.
         names_compared = set()
 
+        # Deletions that are needed, as a list of (name, mod_revision) pairs.
+        # We collect these so that they can be batched into a small number of
+        # etcd transactions.
+        deletes = []
+
         LOG.info("Resync for %s; got neutron data (%s items), look for "
                  "incorrect data...", self.resource_kind, len(neutron_map))
+        etcd_resources_to_compare = []
         for etcd_resource in etcd_resources:
             name, data, mod_revision = etcd_resource
             if name in neutron_map:
                 # Note that we're looking at this name, so we don't try to add
                 # etcd data again for it below.
                 names_compared.add(name)
-
-                # Translate the Neutron resource to what we would write into
-                # etcd.  Take a transaction here in case the subclass method
-                # needs more Neutron DB reads.
-                with self.txn_from_context(context,
-                                           "update-" + self.resource_kind):
-                    write_data = self.neutron_to_etcd_write_data(
-                        neutron_map[name],
-                        context,
-                        reread=False
-                    )
-
-                # Compare that against what we already have in etcd.
-                if self.etcd_write_data_matches_existing(write_data, data):
-                    LOG.debug("etcd data good for %s %s",
-                              self.resource_kind, name)
-                else:
-                    # There's a difference, so do the write.
-                    LOG.warning("etcd rewrite needed for %s %s",
-                                self.resource_kind, name)
-                    if not self.update_in_etcd(name, write_data, mod_revision):
-                        LOG.warning("failed etcd write for %s %s; presume" +
-                                    " data updated by another writer",
-                                    self.resource_kind, name)
+                etcd_resources_to_compare.append(
+                    (name, data, mod_revision, neutron_map[name])
+                )
             else:
                 # This name is in etcd but now has nothing corresponding in
                 # Neutron, so remember it for deletion from etcd.
                 LOG.warning("etcd deletion needed for %s %s",
                             self.resource_kind, name)
-                if not self.delete_from_etcd(name, mod_revision):
-                    LOG.warning("failed etcd delete for %s %s; presume" +
-                                " data updated by another writer",
-                                self.resource_kind, name)
+                deletes.append((name, mod_revision))
+
+        for i in range(0, len(etcd_resources_to_compare), NEUTRON_BATCH_SIZE):
+            self._update_incorrect(
+                context,
+                etcd_resources_to_compare[i:i + NEUTRON_BATCH_SIZE]
+            )
+        self._delete_stale(deletes)
 
         LOG.info("Resync for %s; got etcd data, look for deletions...",
                  self.resource_kind)
-        for name, neutron_data in neutron_map.items():
-            # Skip this name if we already handled it above - i.e. if we
-            # already had data for it in etcd.
-            if name in names_compared:
-                continue
+        # Skip names that we already handled above - i.e. if we already had
+        # data for them in etcd.
+        names_to_create = [name for name in neutron_map
+                           if name not in names_compared]
+        for i in range(0, len(names_to_create), etcdv3.TXN_OPS_LIMIT):
+            self._create_missing(
+                context,
+                [(name, neutron_map[name])
+                 for name in names_to_create[i:i + etcdv3.TXN_OPS_LIMIT]]
+            )
+
+    def _resync_streaming(self, context):
+        """Resync by merging sorted streams of etcd and Neutron resources.
+
+        Unlike _resync, this does not hold all of the etcd and Neutron data in
+        memory at once.  Instead it iterates through both in name order,
+        comparing, writing and deleting in batches as it goes, so that peak
+        memory use is bounded by the batch sizes.
+        """
+        LOG.info("Starting streaming resync for %s", self.resource_kind)
+        etcd_iter = _check_order(self.iter_all_from_etcd(), "etcd")
+        neutron_iter = _check_order(self.iter_all_from_neutron(context),
+                                    "Neutron")
+        etcd_resource = next(etcd_iter, None)
+        neutron_resource = next(neutron_iter, None)
+
+        to_compare = []
+        deletes = []
+        to_create = []
+        while etcd_resource is not None or neutron_resource is not None:
+            if (neutron_resource is None or
+                    (etcd_resource is not None and
+                     etcd_resource[0] < neutron_resource[0])):
+                # This name is in etcd but has nothing corresponding in
+                # Neutron, so it needs deleting from etcd.
+                name, _, mod_revision = etcd_resource
+                LOG.warning("etcd deletion needed for %s %s",
+                            self.resource_kind, name)
+                deletes.append((name, mod_revision))
+                etcd_resource = next(etcd_iter, None)
+            elif (etcd_resource is None or
+                    neutron_resource[0] < etcd_resource[0]):
+                # This name is in Neutron but not in etcd, so it needs
+                # creating in etcd.
+                to_create.append(neutron_resource)
+                neutron_resource = next(neutron_iter, None)
+            else:
+                # This name is in both, so compare them.
+                name, data, mod_revision = etcd_resource
+                to_compare.append((name, data, mod_revision,
+                                   neutron_resource[1]))
+                etcd_resource = next(etcd_iter, None)
+                neutron_resource = next(neutron_iter, None)
+
+            if len(to_compare) >= NEUTRON_BATCH_SIZE:
+                self._update_incorrect(context, to_compare)
+                to_compare = []
+            if len(deletes) >= etcdv3.TXN_OPS_LIMIT:
+                self._delete_stale(deletes)
+                deletes = []
+            if len(to_create) >= etcdv3.TXN_OPS_LIMIT:
+                self._create_missing(context, to_create)
+                to_create = []
+
+        self._update_incorrect(context, to_compare)
+        self._delete_stale(deletes)
+        self._create_missing(context, to_create)
+
+    def _update_incorrect(self, context, resources):
+        # Compare a batch of resources that exist in both etcd and Neutron,
+        # where 'resources' is a list of (name, etcd_data, mod_revision,
+        # neutron_data) tuples, and rewrite the etcd data for any that differ.
+        if not resources:
+            return
+
+        # Translate the Neutron resources to what we would write into etcd.
+        # Take a transaction here in case the subclass method needs more
+        # Neutron DB reads.
+        with self.txn_from_context(context, "update-" + self.resource_kind):
+            write_data_map = self.neutron_to_etcd_write_data_many(
+                [(name, neutron_data)
+                 for name, _, _, neutron_data in resources],
+                context,
+                reread=False
+            )
+
+        updates = []
+        for name, data, mod_revision, _ in resources:
+            write_data = write_data_map[name]
+
+            # Compare that against what we already have in etcd.
+            if self.etcd_write_data_matches_existing(write_data, data):
+                LOG.debug("etcd data good for %s %s",
+                          self.resource_kind, name)
+            else:
+                # There's a difference, so we need to do the write.
+                LOG.warning("etcd rewrite needed for %s %s",
+                            self.resource_kind, name)
+                updates.append((name, write_data, mod_revision))
 
-            with self.txn_from_context(context,
-                                       "create-" + self.resource_kind):
-                try:
-                    # Reread the Neutron resource and translate it to what we
-                    # would write into etcd.
-                    write_data = self.neutron_to_etcd_write_data(neutron_data,
-                                                                 context,
-                                                                 reread=True)
-                    # Create etcd resource with that data.
-                    if not self.create_in_etcd(name, write_data):
-                        LOG.warning("failed etcd write for %s %s; presume" +
-                                    " data created by another writer",
-                                    self.resource_kind, name)
-                except ResourceGone:
+        if updates:
+            results = self.update_many_in_etcd(updates)
+            for name, succeeded in results.items():
+                if not succeeded:
+                    LOG.warning("failed etcd write for %s %s; presume" +
+                                " data updated by another writer",
+                                self.resource_kind, name)
+
+    def _delete_stale(self, deletes):
+        # Delete etcd resources that have nothing corresponding in Neutron,
+        # where 'deletes' is a list of (name, mod_revision) pairs.
+        if not deletes:
+            return
+        results = self.delete_many_from_etcd(deletes)
+        for name, deleted in results.items():
+            if not deleted:
+                LOG.warning("failed etcd delete for %s %s; presume" +
+                            " data updated by another writer",
+                            self.resource_kind, name)
+
+    def _create_missing(self, context, resources):
+        # Create etcd resources for a batch of Neutron resources that are
+        # missing in etcd, where 'resources' is a list of (name, neutron_data)
+        # pairs.
+        if not resources:
+            return
+        with self.txn_from_context(context, "create-" + self.resource_kind):
+            # Reread the Neutron resources and translate them to what we would
+            # write into etcd.
+            write_data_map = self.neutron_to_etcd_write_data_many(
+                resources,
+                context,
+                reread=True
+            )
+            for name, _ in resources:
+                if name not in write_data_map:
                     LOG.warning("Neutron resource gone for %s %s; presume" +
                                 " deleted by another writer",
                                 self.resource_kind, name)
+            creates = list(write_data_map.items())
+
+            # Create etcd resources with that data, while still holding the
+            # Neutron transaction.
+            if creates:
+                results = self.create_many_in_etcd(creates)
+                for name, succeeded in results.items():
+                    if not succeeded:
+                        LOG.warning("failed etcd write for %s %s; presume" +
+                                    " data created by another writer",
+                                    self.resource_kind, name)
 
-        # Delete any legacy etcd data for this kind of resource.  (For example,
-        # how this resource was represented in a previous release.)
-        self.delete_legacy_etcd_data()
+    def iter_all_from_etcd(self):
+        """Iterate through all resources of this type in etcd.
 
-        LOG.info("Resync for %s; done.", self.resource_kind)
+        Yields the same (name, data, mod_revision) tuples as
+        get_all_from_etcd, in name order.  By default this just sorts the
+        result of get_all_from_etcd, but subclasses may override to read the
+        resources from etcd incrementally.
+        """
+        return iter(sorted(self.get_all_from_etcd(), key=lambda r: r[0]))
+
+    def iter_all_from_neutron(self, context):
+        """Iterate through all Neutron resources of this type.
+
+        Yields (name, neutron_data) pairs, as for the items of the dict that
+        get_all_from_neutron returns, in name order.  Only the names, and
+        Neutron IDs, of all resources are held in memory at once; the
+        complete Neutron data is read in batches of NEUTRON_BATCH_SIZE.
+        """
+        with self.txn_from_context(context, "get-all-" + self.resource_kind):
+            names_and_ids = sorted(self.get_names_and_ids_from_neutron(
+                context
+            ))
+        for i in range(0, len(names_and_ids), NEUTRON_BATCH_SIZE):
+            batch = names_and_ids[i:i + NEUTRON_BATCH_SIZE]
+            with self.txn_from_context(context,
+                                       "get-some-" + self.resource_kind):
+                neutron_data_by_id = dict(
+                    (neutron_data['id'], neutron_data)
+                    for neutron_data in self.get_some_from_neutron(
+                        context,
+                        [neutron_id for _, neutron_id in batch]
+                    )
+                )
+            for name, neutron_id in batch:
+                # Skip resources that have been deleted since we read the
+                # names; any corresponding etcd data will be deleted.
+                if neutron_id in neutron_data_by_id:
+                    yield name, neutron_data_by_id[neutron_id]
 
     def delete_legacy_etcd_data(self):
         # By default this is a no-op, but subclasses may override.
         pass
 
+    def neutron_to_etcd_write_data_many(self, items, context, reread=False):
+        """Translate many Neutron resources to what we would write into etcd.
+
+        - items: a list of (name, neutron_data) pairs.
+
+        Returns a dict mapping each name to its write data, omitting any
+        resource that is found, on rereading, no longer to exist.  By default
+        this calls neutron_to_etcd_write_data for each resource in turn, but
+        subclasses may override to read Neutron data for many resources at
+        once.
+        """
+        write_data_map = {}
+        for name, neutron_data in items:
+            try:
+                write_data_map[name] = self.neutron_to_etcd_write_data(
+                    neutron_data,
+                    context,
+                    reread=reread
+                )
+            except ResourceGone:
+                # The caller reports the resources that we omit.
+                pass
+        return write_data_map
+
+    def create_many_in_etcd(self, creates):
+        """Create many resources in etcd.
+
+        - creates: a list of (name, write_data) pairs.
+
+        Returns a dict mapping each name to True if its resource was created,
+        or False if not.  By default this calls create_in_etcd for each
+        resource in turn, but subclasses may override to batch the writes.
+        """
+        return dict((name, self.create_in_etcd(name, write_data))
+                    for name, write_data in creates)
+
+    def update_many_in_etcd(self, updates):
+        """Update many resources in etcd.
+
+        - updates: a list of (name, write_data, mod_revision) tuples.
+
+        Returns a dict mapping each name to True if its resource was written,
+        or False if not.  By default this calls update_in_etcd for each
+        resource in turn, but subclasses may override to batch the writes.
+        """
+        return dict((name, self.update_in_etcd(name, write_data,
+                                               mod_revision))
+                    for name, write_data, mod_revision in updates)
+
+    def delete_many_from_etcd(self, deletes):
+        """Delete many resources from etcd.
+
+        - deletes: a list of (name, mod_revision) pairs.
+
+        Returns a dict mapping each name to True if its resource was deleted,
+        or False if not.  By default this calls delete_from_etcd for each
+        resource in turn, but subclasses may override to batch the deletions.
+        """
+        return dict((name, self.delete_from_etcd(name, mod_revision))
+                    for name, mod_revision in deletes)
+
     def etcd_write_data_matches_existing(self, write_data, existing):
         """Test whether data that we would write is the same as existing.
 
@@ -133,6 +133,13 @@ class NoResultFound(Exception):
 m_sqlalchemy.orm.exc.NoResultFound = NoResultFound
 
 
+class SQLAlchemyError(Exception):
+    pass
+
+
+m_sqlalchemy.exc.SQLAlchemyError = SQLAlchemyError
+
+
 class PortNotFound(Exception):
 
     def __init__(self, port_id=None):
@@ -239,6 +246,9 @@ class Lib(object):
         self.db_context.session.query.return_value.filter_by.side_effect = (
             self.port_query
         )
+        self.db_context.session.query.return_value.filter.side_effect = (
+            self.port_bulk_query
+        )
 
         # Arrange what the DB's get_ports will return.
         self.db.get_ports.side_effect = self.get_ports
@@ -516,7 +526,7 @@ class Lib(object):
         except IndexError:
             raise mech_calico.n_exc.PortNotFound(port_id=port_id)
 
-    def get_ports(self, context, filters=None):
+    def get_ports(self, context, filters=None, fields=None):
         if filters is None:
             return self.osdb_ports
 
@@ -534,7 +544,7 @@ class Lib(object):
         else:
             return {'gateway_ip': '10.65.0.1'}
 
-    def get_subnets(self, context, filters=None):
+    def get_subnets(self, context, filters=None, fields=None):
         if filters:
             self.assertTrue('id' in filters)
             matches = [s for s in self.osdb_subnets
@@ -591,6 +601,25 @@ class Lib(object):
 
         return None
 
+    def port_bulk_query(self, criterion):
+        # The criterion is the result of "<column>.in_(<port IDs>)", so work
+        # out which column that was for.
+        ip_port_id_in = endpoints.models_v2.IPAllocation.port_id.in_
+        fip_port_id_in = endpoints.FloatingIP.fixed_port_id.in_
+        if criterion is ip_port_id_in.return_value:
+            port_ids = set(ip_port_id_in.call_args[0][0])
+            return [dict(ip, port_id=port['id'])
+                    for port in self.osdb_ports
+                    if port['id'] in port_ids
+                    for ip in port['fixed_ips']]
+        elif criterion is fip_port_id_in.return_value:
+            port_ids = set(fip_port_id_in.call_args[0][0])
+            return [fip for fip in floating_ports
+                    if fip['fixed_port_id'] in port_ids]
+        else:
+            raise Exception("port_bulk_query doesn't know how to handle %r" %
+                            criterion)
+
 
 class FixedUUID(object):
 
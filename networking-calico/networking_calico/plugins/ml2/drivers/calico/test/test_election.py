@@ -49,8 +49,13 @@ class TestElection(unittest.TestCase):
         # Mock calls to sys.exit.
         self.sys_exit_p = mock.patch("sys.exit")
         self.sys_exit_p.start()
+        # Use the stub etcd client for watches.
+        self.cfg_p = mock.patch.object(etcdv3, "cfg")
+        m_cfg = self.cfg_p.start()
+        m_cfg.CONF.calico.etcd_watch_multiplexing = False
 
     def tearDown(self):
+        self.cfg_p.stop()
         self.sys_exit_p.stop()
         self.print_exc_patch.stop()
         eventlet.sleep = self._real_sleep
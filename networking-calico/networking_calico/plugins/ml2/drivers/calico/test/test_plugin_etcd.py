@@ -31,13 +31,15 @@ import mock
 import networking_calico.plugins.ml2.drivers.calico.test.lib as lib
 
 from networking_calico.common import config as calico_config
-from networking_calico import datamodel_v1
 from networking_calico import datamodel_v2
+from networking_calico import datamodel_v3
 from networking_calico import etcdv3
 from networking_calico.monotonic import monotonic_time
+from networking_calico.plugins.ml2.drivers.calico import endpoints
 from networking_calico.plugins.ml2.drivers.calico import mech_calico
 from networking_calico.plugins.ml2.drivers.calico import policy
 from networking_calico.plugins.ml2.drivers.calico import status
+from networking_calico.plugins.ml2.drivers.calico import syncer
 
 _log = logging.getLogger(__name__)
 logging.getLogger().addHandler(logging.NullHandler())
@@ -52,6 +54,9 @@ class _TestEtcdBase(lib.Lib, unittest.TestCase):
         # Start with an empty etcd database.
         self.etcd_data = {}
 
+        # The mod_revision that a ranged get reports for every key.
+        self.etcd_mod_revision = '10'
+
         # Insinuate a mock etcd3gw client.
         etcdv3._client = self.clientv3 = mock.Mock()
         self.clientv3.put.side_effect = self.etcd3gw_client_put
@@ -184,7 +189,8 @@ class _TestEtcdBase(lib.Lib, unittest.TestCase):
             keys_in_range = [k for k in keys if key <= k < decoded_end]
             for k in keys_in_range:
                 result.append((self.etcd_data[k].encode(),
-                               {'key': k.encode(), 'mod_revision': '10'}))
+                               {'key': k.encode(),
+                                'mod_revision': self.etcd_mod_revision}))
                 if limit is not None and len(result) >= limit:
                     break
             return result
@@ -231,6 +237,14 @@ class _TestEtcdBase(lib.Lib, unittest.TestCase):
                 self.recent_deletes.add(key)
 
     def etcd3gw_client_transaction(self, txn):
+        if txn['success'] and 'request_txn' in txn['success'][0]:
+            # Batched transaction, with a nested transaction for each key.
+            assert not txn['compare']
+            responses = []
+            for op in txn['success']:
+                result = self.etcd3gw_client_transaction(op['request_txn'])
+                responses.append({'response_txn': result})
+            return {'succeeded': True, 'responses': responses}
         for txc in txn['compare']:
             _log.info("etcd3 txn compare = %r", txc)
             if txc['target'] == 'VERSION' and txc['version'] == 0:
@@ -318,6 +332,8 @@ class _TestEtcdBase(lib.Lib, unittest.TestCase):
 
 class TestPluginEtcdBase(_TestEtcdBase):
 
+    resync_streaming = False
+
     def setUp_region(self):
         self.region = None
         self.region_string = "no-region"
@@ -347,11 +363,15 @@ class TestPluginEtcdBase(_TestEtcdBase):
         lib.m_compat.cfg.CONF.calico.etcd_ca_cert_file = None
         lib.m_compat.cfg.CONF.calico.etcd_key_file = None
         lib.m_compat.cfg.CONF.calico.num_port_status_threads = 4
+        lib.m_compat.cfg.CONF.calico.etcd_watch_multiplexing = False
+        lib.m_compat.cfg.CONF.calico.etcd_progress_notify_interval = 0
         lib.m_compat.cfg.CONF.calico.etcd_compaction_period_mins = 0
         lib.m_compat.cfg.CONF.calico.project_name_cache_max = 0
         lib.m_compat.cfg.CONF.calico.openstack_region = self.region
+        lib.m_compat.cfg.CONF.calico.resync_streaming = self.resync_streaming
         calico_config._reset_globals()
         datamodel_v2._reset_globals()
+        datamodel_v3._reset_globals()
 
         # This value needs to be a string:
         lib.m_compat.cfg.CONF.keystone_authtoken.auth_url = ""
@@ -934,6 +954,45 @@ class TestPluginEtcd(TestPluginEtcdBase):
 
         self.assertEtcdWrites(self.initial_etcd3_writes)
 
+    def test_start_two_ports_bulk_queries(self):
+        """Startup resync reads port information in bulk, not per port."""
+        self.osdb_ports = [lib.port1, lib.port2]
+        self.db_context.session.query.return_value.filter_by.reset_mock()
+        self.db._get_port_security_group_bindings.reset_mock()
+
+        with lib.FixedUUID('uuid-start-two-ports'):
+            self.give_way()
+            self.simulated_time_advance(31)
+
+        query = self.db_context.session.query.return_value
+        query.filter_by.assert_not_called()
+        self.db._get_port_security_group_bindings.assert_called_once_with(
+            mock.ANY,
+            filters={'port_id': ['DEADBEEF-1234-5678', 'FACEBEEF-1234-5678']}
+        )
+
+    def test_resync_port_gone(self):
+        """A port that is deleted before it can be written is logged once."""
+        with lib.FixedUUID('uuid-start-no-ports'):
+            self.give_way()
+            self.simulated_time_advance(31)
+
+        self.osdb_ports = [lib.port1]
+        endpoint_syncer = self.driver.endpoint_syncer
+        with mock.patch.object(endpoint_syncer, "create_many_in_etcd",
+                               return_value={}) as m_create, \
+                mock.patch.object(syncer.LOG, "warning") as m_warning, \
+                mock.patch.object(endpoints.LOG, "warning") as m_ep_warning:
+            endpoint_syncer._create_missing(self.db_context, [
+                ("name-1", lib.port1),
+                ("name-2", lib.port2),
+            ])
+        self.assertEqual(["name-1"],
+                         [name for name, _ in m_create.call_args[0][0]])
+        m_warning.assert_called_once_with(mock.ANY, "WorkloadEndpoint",
+                                          "name-2")
+        m_ep_warning.assert_not_called()
+
     def test_etcd_reset(self):
         for n in range(1, 20):
             _log.info("Reset etcd data after %s reads/writes/deletes", n)
@@ -1427,6 +1486,12 @@ class TestPluginEtcd(TestPluginEtcdBase):
         ]))
 
 
+class TestPluginEtcdStreamingResync(TestPluginEtcd):
+    """Rerun the TestPluginEtcd tests with streaming resyncs."""
+
+    resync_streaming = True
+
+
 class TestPluginEtcdRegion(TestPluginEtcdBase):
 
     def setUp_region(self):
@@ -1495,6 +1560,7 @@ class TestDriverStatusReporting(lib.Lib, unittest.TestCase):
         # Mock out config.
         lib.m_compat.cfg.CONF.calico.etcd_host = "localhost"
         lib.m_compat.cfg.CONF.calico.etcd_port = 4001
+        lib.m_compat.cfg.CONF.calico.port_status_batch_size = 1
 
     def test_felix_agent_state(self):
         self.assertEqual(
@@ -1641,6 +1707,41 @@ class TestDriverStatusReporting(lib.Lib, unittest.TestCase):
                 m_queue.put.mock_calls
             )
 
+    def test_port_status_queue_coalesces(self):
+        queue = mech_calico.CoalescingPriorityQueue()
+        queue.put(((1, 1), ("host", "p1")))
+        queue.put(((1, 2), ("host", "p2")))
+        # Requeueing p1 at the same or lower priority has no effect.
+        queue.put(((1, 3), ("host", "p1")))
+        queue.put(((2, 4), ("host", "p1")))
+        self.assertEqual(2, queue.qsize())
+        # Requeueing p2 at a higher priority moves it ahead of p1.
+        queue.put(((0, 5), ("host", "p2")))
+        self.assertEqual(2, queue.qsize())
+        self.assertEqual(((0, 5), ("host", "p2")), queue.get())
+        self.assertEqual(((1, 1), ("host", "p1")), queue.get())
+        self.assertEqual(0, queue.qsize())
+        # Once got, a key can be queued again.
+        queue.put(((1, 6), ("host", "p1")))
+        self.assertEqual(((1, 6), ("host", "p1")), queue.get())
+        self.assertTrue(queue.empty())
+
+    def test_port_status_queue_join(self):
+        queue = mech_calico.CoalescingPriorityQueue()
+        queue.put(((1, 1), ("host", "p1")))
+        queue.put(((1, 2), ("host", "p2")))
+        queue.put(((0, 3), ("host", "p1")))
+        # One unfinished task for each queued key.
+        self.assertEqual(2, queue.unfinished_tasks)
+        queue.get()
+        queue.task_done()
+        self.assertEqual(1, queue.unfinished_tasks)
+        queue.get()
+        queue.task_done()
+        # So join() doesn't block once each key has been got and done.
+        with eventlet.Timeout(1):
+            queue.join()
+
     def test_loop_writing_port_statuses(self):
         with mock.patch.object(self.driver, "_port_status_queue") as m_queue:
             with mock.patch.object(self.driver,
@@ -1657,6 +1758,147 @@ class TestDriverStatusReporting(lib.Lib, unittest.TestCase):
             m_try_upd.mock_calls
         )
 
+    def test_loop_writing_port_statuses_batched(self):
+        lib.m_compat.cfg.CONF.calico.port_status_batch_size = 2
+        with mock.patch.object(self.driver, "_port_status_queue") as m_queue:
+            with mock.patch.object(
+                    self.driver,
+                    "_try_to_update_port_statuses") as m_try_upd:
+                m_queue.get.side_effect = iter([
+                    ((1, mock.ANY), ("host", "p1")),
+                    ((1, mock.ANY), ("host", "p2")),
+                    ((1, mock.ANY), ("host", "p3")),
+                ])
+                m_queue.qsize.return_value = 1
+                self.assertRaises(StopIteration,
+                                  self.driver._loop_writing_port_statuses,
+                                  self.driver._epoch)
+        self.assertEqual(
+            [
+                mock.call(mock.ANY, [("host", "p1"), ("host", "p2")]),
+            ],
+            m_try_upd.mock_calls
+        )
+
+    def test_try_to_update_port_statuses(self):
+        self.driver._port_status_cache[("host", "p1")] = "up"
+        self.driver._port_status_cache[("host", "p2")] = "up"
+        p1 = mock.Mock(id="p1", status=mech_calico.constants.PORT_STATUS_DOWN)
+        p2 = mock.Mock(id="p2", status=mech_calico.constants.PORT_STATUS_DOWN)
+        context = mock.Mock()
+        query = context.session.query.return_value.join.return_value
+        # p2 is now bound to a different host, and p3 no longer exists.
+        query.filter.return_value = [(p1, "host"), (p2, "otherhost")]
+        with mock.patch.object(self.driver, "_txn_from_context"), \
+                mock.patch.object(self.driver,
+                                  "_try_to_update_port_status") as m_try_upd:
+            self.driver._try_to_update_port_statuses(
+                context,
+                [("host", "p1"), ("host", "p2"), ("host", "p3")]
+            )
+        self.assertEqual(mech_calico.constants.PORT_STATUS_ACTIVE, p1.status)
+        self.assertEqual(mech_calico.constants.PORT_STATUS_DOWN, p2.status)
+        self.assertEqual([], m_try_upd.mock_calls)
+
+    def test_try_to_update_port_statuses_migrating(self):
+        # During a live migration, p1 has an active binding to the source
+        # host and an inactive binding to the destination host, whose Felix
+        # reports the port as down before the cutover.
+        self.driver._port_status_cache[("source", "p1")] = "up"
+        self.driver._port_status_cache[("dest", "p1")] = "down"
+        p1 = mock.Mock(id="p1", status=mech_calico.constants.PORT_STATUS_BUILD)
+        bindings = [
+            (p1, "source", mech_calico.constants.ACTIVE),
+            (p1, "dest", mech_calico.constants.INACTIVE),
+        ]
+
+        # Filter the bindings as the DB would.
+        m_status = mock.MagicMock()
+        m_status.__eq__.side_effect = lambda value: ("status ==", value)
+
+        def filter(*criteria):
+            return [(port, host) for port, host, status in bindings
+                    if ("status ==", status) in criteria or
+                    not any(isinstance(c, tuple) for c in criteria)]
+
+        context = mock.Mock()
+        query = context.session.query.return_value.join.return_value
+        query.filter.side_effect = filter
+        with mock.patch.object(self.driver, "_txn_from_context"), \
+                mock.patch.object(mech_calico.ml2_models.PortBinding,
+                                  "status", m_status), \
+                mock.patch.object(self.driver,
+                                  "_try_to_update_port_status") as m_try_upd:
+            self.driver._try_to_update_port_statuses(
+                context,
+                [("source", "p1"), ("dest", "p1")]
+            )
+        self.assertEqual(mech_calico.constants.PORT_STATUS_ACTIVE, p1.status)
+        self.assertEqual([], m_try_upd.mock_calls)
+
+    def test_try_to_update_port_statuses_fail(self):
+        context = mock.Mock()
+        context.session.query.side_effect = lib.DBError()
+        with mock.patch.object(self.driver, "_txn_from_context"), \
+                mock.patch.object(self.driver,
+                                  "_try_to_update_port_status") as m_try_upd:
+            self.driver._try_to_update_port_statuses(
+                context,
+                [("host", "p1"), ("host", "p2")]
+            )
+        # Falls back to individual updates.
+        self.assertEqual(
+            [
+                mock.call(context, ("host", "p1")),
+                mock.call(context, ("host", "p2")),
+            ],
+            m_try_upd.mock_calls
+        )
+
+    def test_seed_port_status_cache(self):
+        self.driver._port_status_cache[("host", "p1")] = "down"
+        m_context = mock.Mock()
+        m_context.session.query.return_value.join.return_value = [
+            # Already cached, so not overwritten.
+            ("p1", mech_calico.constants.PORT_STATUS_ACTIVE, "compute:nova",
+             "host"),
+            ("p2", mech_calico.constants.PORT_STATUS_ACTIVE, "compute:nova",
+             "host"),
+            ("p3", mech_calico.constants.PORT_STATUS_DOWN, "compute:nova",
+             "host2"),
+            # Not an endpoint port.
+            ("p4", mech_calico.constants.PORT_STATUS_ACTIVE, "network:dhcp",
+             "host"),
+            # No corresponding Calico status.
+            ("p5", "BUILD", "compute:nova", "host"),
+        ]
+        with mock.patch.object(self.driver, "_txn_from_context"), \
+                mock.patch.object(mech_calico.ctx, "get_admin_context",
+                                  return_value=m_context):
+            self.driver.seed_port_status_cache()
+        self.assertEqual(
+            {
+                ("host", "p1"): "down",
+                ("host", "p2"): "up",
+                ("host2", "p3"): "down",
+            },
+            self.driver._port_status_cache
+        )
+
+        # The snapshot confirms p3's status, but has no status for p2; so
+        # pruning removes p2.
+        self.driver.on_port_status_changed("host2", "p3",
+                                           {"status": "down"},
+                                           priority="low")
+        self.driver.prune_port_status_cache()
+        self.assertEqual(
+            {
+                ("host", "p1"): "down",
+                ("host2", "p3"): "down",
+            },
+            self.driver._port_status_cache
+        )
+
     def test_try_to_update_port_status(self):
         # New OpenStack releases have a host parameter.
         self.driver._get_db()
@@ -1729,9 +1971,12 @@ class TestStatusWatcherBase(_TestEtcdBase):
         lib.m_compat.cfg.CONF.calico.etcd_key_file = None
         lib.m_compat.cfg.CONF.calico.etcd_cert_file = None
         lib.m_compat.cfg.CONF.calico.etcd_ca_cert_file = None
+        lib.m_compat.cfg.CONF.calico.etcd_watch_multiplexing = False
+        lib.m_compat.cfg.CONF.calico.etcd_progress_notify_interval = 0
         lib.m_compat.cfg.CONF.calico.openstack_region = self.region
         calico_config._reset_globals()
         datamodel_v2._reset_globals()
+        datamodel_v3._reset_globals()
 
         super(TestStatusWatcherBase, self).setUp()
         self.driver = mock.Mock(spec=mech_calico.CalicoMechanismDriver)
@@ -1746,10 +1991,6 @@ class TestStatusWatcherBase(_TestEtcdBase):
         )
         m_port_status_node.value = '{"status": "up"}'
         self.watcher._on_ep_set(m_port_status_node, "hostname", "wlid", "ep1")
-        ep_id = datamodel_v1.WloadEndpointId("hostname", "openstack",
-                                             "wlid", "ep1")
-        self.assertEqual({"hostname": set([ep_id])},
-                         self.watcher._endpoints_by_host)
         return m_port_status_node
 
 
@@ -1795,6 +2036,8 @@ class TestStatusWatcher(TestStatusWatcherBase):
         def _iterator():
             for e in watch_events:
                 yield e
+            # Let the watcher dispatch those events before stopping it.
+            eventlet.sleep()
             _log.info("Stop watcher now")
             self.watcher.stop()
             yield None
@@ -1808,6 +2051,10 @@ class TestStatusWatcher(TestStatusWatcherBase):
         # when it tries to watch for further changes.
         self.watcher.start()
 
+        # The driver's port status cache is seeded before the snapshot, and
+        # pruned after it.
+        self.driver.seed_port_status_cache.assert_called_once_with()
+        self.driver.prune_port_status_cache.assert_called_once_with()
         self.driver.on_felix_alive.assert_called_once_with("hostname",
                                                            new=True)
         self.driver.on_port_status_changed.assert_has_calls([
@@ -1815,30 +2062,28 @@ class TestStatusWatcher(TestStatusWatcherBase):
             mock.call("hostname", "ep1", {"status": "up"}, priority="low"),
         ], any_order=True)
 
-        # Start the watcher again, with the same etcd data.  We should see the
-        # same status callbacks.
+        # Start the watcher again, with the same etcd data.  Nothing has
+        # changed, so there are no status callbacks.
         self.driver.on_felix_alive.reset_mock()
         self.driver.on_port_status_changed.reset_mock()
         self.clientv3.watch_prefix.return_value = _iterator(), _cancel
         self.watcher.start()
         self.driver.on_felix_alive.assert_not_called()
-        self.driver.on_port_status_changed.assert_has_calls([
-            mock.call("unknown", "ep2", {"status": "up"}, priority="low"),
-            mock.call("hostname", "ep1", {"status": "up"}, priority="low"),
-        ], any_order=True)
+        self.driver.on_port_status_changed.assert_not_called()
+        self.driver.seed_port_status_cache.assert_called_once_with()
+        self.driver.prune_port_status_cache.assert_called_once_with()
 
         # Resync after deleting the unknown host endpoint.  We should see that
-        # endpoint reported with status None.
+        # endpoint reported with status None, and nothing for ep1.
         del self.etcd_data[ep_on_unknown_host_key]
         self.driver.on_felix_alive.reset_mock()
         self.driver.on_port_status_changed.reset_mock()
         self.clientv3.watch_prefix.return_value = _iterator(), _cancel
         self.watcher.start()
         self.driver.on_felix_alive.assert_not_called()
-        self.driver.on_port_status_changed.assert_has_calls([
+        self.assertEqual([
             mock.call("unknown", "ep2", None, priority="low"),
-            mock.call("hostname", "ep1", {"status": "up"}, priority="low"),
-        ], any_order=True)
+        ], self.driver.on_port_status_changed.mock_calls)
 
         # Resync after deleting the Felix status.  This does not affect the
         # status of ep1.
@@ -1848,9 +2093,17 @@ class TestStatusWatcher(TestStatusWatcherBase):
         self.clientv3.watch_prefix.return_value = _iterator(), _cancel
         self.watcher.start()
         self.driver.on_felix_alive.assert_not_called()
-        self.driver.on_port_status_changed.assert_has_calls([
+        self.driver.on_port_status_changed.assert_not_called()
+
+        # Resync after ep1's status has been rewritten at a later revision.
+        # We should see ep1 reported again.
+        self.etcd_mod_revision = '15'
+        self.driver.on_port_status_changed.reset_mock()
+        self.clientv3.watch_prefix.return_value = _iterator(), _cancel
+        self.watcher.start()
+        self.assertEqual([
             mock.call("hostname", "ep1", {"status": "up"}, priority="low"),
-        ], any_order=True)
+        ], self.driver.on_port_status_changed.mock_calls)
 
         # Resync with some follow-on events; checks that the priority goes
         # back to high after the snapshot.
@@ -1884,7 +2137,6 @@ class TestStatusWatcher(TestStatusWatcherBase):
                 mock.call("hostname", "ep1", None, priority="high"),
             ],
             self.driver.on_port_status_changed.mock_calls)
-        self.assertEqual({}, self.watcher._endpoints_by_host)
 
     def test_endpoint_status_add_bad_json(self):
         m_port_status_node = mock.Mock()
@@ -1898,17 +2150,18 @@ class TestStatusWatcher(TestStatusWatcherBase):
                 mock.call("hostname", "ep1", None, priority="high"),
             ],
             self.driver.on_port_status_changed.mock_calls)
-        self.assertEqual({}, self.watcher._endpoints_by_host)
 
     def test_endpoint_status_add_bad_id(self):
+        # A key without an endpoint ID doesn't reach the endpoint handler,
+        # which takes the endpoint ID from the dispatcher's captures.
         m_port_status_node = mock.Mock()
+        m_port_status_node.action = "set"
         m_port_status_node.key = "/calico/felix/v2/no-region/host/hostname/workload/" \
                                  "openstack/wlid/endpoint"
-        self.watcher._on_ep_set(m_port_status_node, "hostname", "wlid", "ep1")
+        self.watcher.dispatcher.handle_event(m_port_status_node)
         self.assertEqual(
             [],
             self.driver.on_port_status_changed.mock_calls)
-        self.assertEqual({}, self.watcher._endpoints_by_host)
 
     def test_status_bad_json(self):
         for value in ["{", 10, "foo"]:
@@ -1961,7 +2214,6 @@ class TestMultiRegionStatusWatcher(TestStatusWatcherBase):
                 mock.call("hostname", "ep1", None, priority="high"),
             ],
             self.driver.on_port_status_changed.mock_calls)
-        self.assertEqual({}, self.watcher._endpoints_by_host)
 
     def test_handle_port_this_region(self):
         # Simulate status update for a workload in this region.
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+networking_calico.tests.bench_etcdutils
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Microbenchmark for PathDispatcher, using the paths that StatusWatcher
+registers and realistic Felix status keys.  Run with
+
+    python -m networking_calico.tests.bench_etcdutils [num_hosts]
+"""
+
+import sys
+import timeit
+
+from networking_calico import datamodel_v1
+from networking_calico import datamodel_v2
+from networking_calico.etcdutils import PathDispatcher
+from networking_calico.etcdutils import Response
+
+ENDPOINTS_PER_HOST = 20
+REPEATS = 5
+
+
+def make_events(num_hosts):
+    status_path = datamodel_v2.felix_status_dir()
+    events = []
+    for h in range(num_hosts):
+        hostname = "compute-%04d.example.org" % h
+        events.append(Response(action="set",
+                               key="%s/%s/status" % (status_path, hostname),
+                               value='{"uptime": 10}',
+                               mod_revision=1))
+        for e in range(ENDPOINTS_PER_HOST):
+            key = ("%s/%s/workload/openstack/"
+                   "%08x-1c2d-4e5f-8a9b-0c1d2e3f4a5b/endpoint/"
+                   "%08x-6a7b-4c8d-9e0f-1a2b3c4d5e6f" %
+                   (status_path, hostname, h * 1000 + e, h * 1000 + e))
+            events.append(Response(action="set",
+                                   key=key,
+                                   value='{"status": "up"}',
+                                   mod_revision=1))
+    return events
+
+
+def make_dispatcher():
+    # The same paths and handler signatures as StatusWatcher.
+    def on_status(response, hostname):
+        pass
+
+    def on_ep(response, hostname, workload, endpoint):
+        datamodel_v1.WloadEndpointId(hostname, "openstack", workload,
+                                     endpoint)
+
+    status_path = datamodel_v2.felix_status_dir()
+    dispatcher = PathDispatcher()
+    dispatcher.register(status_path + "/<hostname>/status",
+                        on_set=on_status, on_del=on_status)
+    dispatcher.register(status_path + "/<hostname>/workload/openstack/"
+                        "<workload>/endpoint/<endpoint>",
+                        on_set=on_ep, on_del=on_ep)
+    return dispatcher
+
+
+def main(num_hosts=500):
+    events = make_events(num_hosts)
+    dispatcher = make_dispatcher()
+
+    def dispatch_all():
+        for event in events:
+            dispatcher.handle_event(event)
+
+    best = min(timeit.repeat(dispatch_all, number=1, repeat=REPEATS))
+    print("%d events in %.3fs: %.0f events/s" %
+          (len(events), best, len(events) / best))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
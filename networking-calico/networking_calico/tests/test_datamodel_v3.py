@@ -13,10 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import logging
+import mock
 import unittest
 
 from networking_calico import datamodel_v3
+from networking_calico import etcdv3
 
 
 # Logger
@@ -54,3 +57,131 @@ class TestDatamodelV3(unittest.TestCase):
 
         s = datamodel_v3.sanitize_label_name_value("_-+.934abc%_-", 10)
         self.assertEqual(s, "934abc")
+
+
+WEP_KEY = ('/calico/resources/v3/projectcalico.org/workloadendpoints/'
+           'openstack/wep1')
+WEP_METADATA = {
+    'name': 'wep1',
+    'namespace': 'openstack',
+    'uid': 'a6b1c2d3',
+    'creationTimestamp': '2019-01-01T00:00:00Z',
+}
+
+
+@mock.patch.object(etcdv3, 'get')
+@mock.patch.object(etcdv3, 'put')
+@mock.patch.object(etcdv3, 'get_prefix')
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMetadataCache, self).setUp()
+        datamodel_v3._reset_globals()
+
+    def tearDown(self):
+        datamodel_v3._reset_globals()
+        super(TestMetadataCache, self).tearDown()
+
+    def _load_snapshot(self, m_get_prefix):
+        m_get_prefix.return_value = [(
+            WEP_KEY,
+            json.dumps({'metadata': WEP_METADATA, 'spec': {}}),
+            '10',
+        )]
+        datamodel_v3.get_all('WorkloadEndpoint', 'openstack')
+
+    def _written_metadata(self, m_put):
+        return json.loads(m_put.mock_calls[-1][1][1])['metadata']
+
+    def test_write_at_known_revision_skips_read(self, m_get_prefix, m_put,
+                                                m_get):
+        self._load_snapshot(m_get_prefix)
+        m_put.return_value = (True, '11')
+
+        self.assertTrue(datamodel_v3.put('WorkloadEndpoint', 'openstack',
+                                         'wep1', {'x': 1},
+                                         mod_revision='10'))
+
+        m_get.assert_not_called()
+        m_put.assert_called_once_with(WEP_KEY, mock.ANY, mod_revision='10',
+                                      with_revision=True)
+        self.assertEqual(WEP_METADATA, self._written_metadata(m_put))
+
+        # The write itself is now cached, so a MUST_UPDATE write also skips
+        # the read, and is conditional on the revision of that write.
+        datamodel_v3.put('WorkloadEndpoint', 'openstack', 'wep1', {'x': 2},
+                         mod_revision=etcdv3.MUST_UPDATE)
+        m_get.assert_not_called()
+        self.assertEqual(m_put.mock_calls[-1],
+                         mock.call(WEP_KEY, mock.ANY, mod_revision='11',
+                                   with_revision=True))
+
+    def test_write_at_other_revision_reads(self, m_get_prefix, m_put, m_get):
+        self._load_snapshot(m_get_prefix)
+        m_put.return_value = (True, '13')
+        m_get.return_value = (json.dumps({'metadata': WEP_METADATA,
+                                          'spec': {}}), '12')
+
+        datamodel_v3.put('WorkloadEndpoint', 'openstack', 'wep1', {'x': 1},
+                         mod_revision='12')
+
+        m_get.assert_called_once_with(WEP_KEY)
+        m_put.assert_called_once_with(WEP_KEY, mock.ANY, mod_revision='12',
+                                      with_revision=True)
+
+    def test_stale_cache_falls_back_to_read(self, m_get_prefix, m_put, m_get):
+        self._load_snapshot(m_get_prefix)
+        new_metadata = dict(WEP_METADATA, uid='e4f5a6b7')
+        m_get.return_value = (json.dumps({'metadata': new_metadata,
+                                          'spec': {}}), '12')
+        m_put.side_effect = [(False, None), (True, '13')]
+
+        self.assertTrue(datamodel_v3.put('WorkloadEndpoint', 'openstack',
+                                         'wep1', {'x': 1},
+                                         mod_revision=etcdv3.MUST_UPDATE))
+
+        m_get.assert_called_once_with(WEP_KEY)
+        self.assertEqual(m_put.mock_calls, [
+            mock.call(WEP_KEY, mock.ANY, mod_revision='10',
+                      with_revision=True),
+            mock.call(WEP_KEY, mock.ANY, mod_revision=etcdv3.MUST_UPDATE,
+                      with_revision=True),
+        ])
+        self.assertEqual(new_metadata, self._written_metadata(m_put))
+
+    def test_create_skips_read(self, m_get_prefix, m_put, m_get):
+        m_put.return_value = (False, None)
+
+        self.assertFalse(datamodel_v3.put('WorkloadEndpoint', 'openstack',
+                                          'wep1', {'x': 1}, mod_revision=0))
+
+        m_get.assert_not_called()
+        m_put.assert_called_once_with(WEP_KEY, mock.ANY, mod_revision=0,
+                                      with_revision=True)
+
+    @mock.patch.object(etcdv3, 'iter_prefix')
+    def test_iter_all_bounds_cache(self, m_iter_prefix, m_get_prefix, m_put,
+                                   m_get):
+        # wep1 and wep3 are cached; wep3 has since been deleted.
+        m_put.return_value = (True, '11')
+        for name in ('wep1', 'wep3'):
+            datamodel_v3.put('WorkloadEndpoint', 'openstack', name, {},
+                             mod_revision=0)
+        wep_prefix = WEP_KEY[:-len('wep1')]
+        m_iter_prefix.return_value = iter([
+            (wep_prefix + name,
+             json.dumps({'metadata': dict(WEP_METADATA, name=name),
+                         'spec': {}}),
+             '12')
+            for name in ('wep1', 'wep2')
+        ])
+
+        self.assertEqual(
+            ['wep1', 'wep2'],
+            [name for name, _, _ in
+             datamodel_v3.iter_all('WorkloadEndpoint', 'openstack')])
+
+        # wep1's cached metadata is refreshed, wep2 isn't added to the cache,
+        # and wep3's is discarded.
+        self.assertEqual({WEP_KEY: ('12', dict(WEP_METADATA, name='wep1'))},
+                         datamodel_v3._metadata_cache)
@@ -15,24 +15,37 @@
 
 from collections import namedtuple
 import eventlet
+import fixtures
 import json
 import logging
 import mock
+import os
 import socket
+import struct
 
+from neutron.agent.dhcp.agent import NetworkCache
 from neutron.agent.dhcp_agent import register_options
 from neutron.agent.linux import dhcp
 from neutron.tests import base
 
+from networking_calico.agent.dhcp_agent import ALL_NETWORKS_ID
 from networking_calico.agent.dhcp_agent import CalicoDhcpAgent
+from networking_calico.agent.dhcp_agent import CalicoEtcdWatcher
+from networking_calico.agent.dhcp_agent import combined_network
+from networking_calico.agent.dhcp_agent import DnsmasqUpdater
 from networking_calico.agent.dhcp_agent import FakePlugin
+from networking_calico.agent.dhcp_agent import make_net_model
+from networking_calico.agent.dhcp_agent import MTUWatcher
+from networking_calico.agent.linux import rtnetlink
 from networking_calico.agent.linux.dhcp import DnsmasqRouted
 from networking_calico.common import config as calico_config
 from networking_calico.compat import cfg
 from networking_calico.compat import DHCPV6_STATEFUL
 from networking_calico import datamodel_v1
 from networking_calico import datamodel_v2
+from networking_calico import datamodel_v3
 from networking_calico.etcdutils import EtcdWatcher
+from networking_calico.etcdutils import Response
 
 LOG = logging.getLogger(__name__)
 
@@ -73,7 +86,8 @@ class TestDhcpAgent(base.BaseTestCase):
     def setUp(self):
         super(TestDhcpAgent, self).setUp()
         register_options(cfg.CONF)
-        calico_config.register_options(cfg.CONF)
+        calico_config.register_options(
+            cfg.CONF, additional_options=calico_config.DHCP_AGENT_OPTS)
         self.mock_makedirs_p = mock.patch("os.makedirs")
         self.mock_makedirs = self.mock_makedirs_p.start()
         self.hostname = socket.gethostname()
@@ -358,6 +372,506 @@ class TestDhcpAgent(base.BaseTestCase):
         calico_config._reset_globals()
 
 
+class _CalicoEtcdWatcherTestCase(base.BaseTestCase):
+    def setUp(self):
+        super(_CalicoEtcdWatcherTestCase, self).setUp()
+        register_options(cfg.CONF)
+        calico_config.register_options(
+            cfg.CONF, additional_options=calico_config.DHCP_AGENT_OPTS)
+        self.agent = mock.Mock()
+        self.agent.cache = NetworkCache()
+        self.addCleanup(self.agent.cache.cleanup_loop.stop)
+        self.watcher = CalicoEtcdWatcher(self.agent, socket.gethostname())
+        self.watcher.mtu_watcher = mock.Mock()
+        self.watcher.mtu_watcher.get_mtu.return_value = 1500
+        self.watcher.dnsmasq_updater = mock.Mock()
+        self.watcher.subnet_watcher.on_subnet_set(
+            EtcdResponse(value=json.dumps({
+                'cidr': '10.28.0.0/24',
+                'gateway_ip': '10.28.0.1',
+            })),
+            'v4subnet-1'
+        )
+
+    def snapshot(self, endpoints):
+        self.watcher.dnsmasq_updater.reset_mock()
+        self.watcher._pre_snapshot_hook()
+        for n, ip in endpoints:
+            self.watcher.on_endpoint_set(
+                EtcdResponse(value=json.dumps({'spec': {
+                    'interfaceName': 'tap%d' % n,
+                    'mac': 'fe:16:65:12:33:%02d' % n,
+                    'ipNetworks': [ip + '/32'],
+                }})),
+                make_endpoint_name('endpoint-%d' % n))
+        self.watcher._post_snapshot_hook(None)
+        return self.watcher.dnsmasq_updater.update_network.mock_calls
+
+
+class TestCalicoEtcdWatcherSnapshot(_CalicoEtcdWatcherTestCase):
+    def test_snapshot_diff(self):
+        # Initial snapshot: the network is new, so needs updating.
+        self.assertEqual(
+            [mock.call('calico')],
+            self.snapshot([(1, '10.28.0.2'), (2, '10.28.0.3')]))
+
+        # Identical snapshot: no update.
+        self.assertEqual(
+            [], self.snapshot([(1, '10.28.0.2'), (2, '10.28.0.3')]))
+
+        # Changed IP: update.
+        self.assertEqual(
+            [mock.call('calico')],
+            self.snapshot([(1, '10.28.0.2'), (2, '10.28.0.4')]))
+
+        # Endpoint missing from snapshot: its port is removed.
+        self.assertEqual([mock.call('calico')],
+                         self.snapshot([(1, '10.28.0.2')]))
+        net = self.agent.cache.get_network_by_id('calico')
+        self.assertEqual(['endpoint-1'], [p.id for p in net.ports])
+        self.watcher.mtu_watcher.unwatch_port.assert_called_once_with(
+            'endpoint-2', 'tap2')
+        self.assertEqual({'endpoint-1'}, self.watcher.local_endpoint_ids)
+
+        # No endpoints left: update, with no ports or subnets.
+        self.assertEqual([mock.call('calico')], self.snapshot([]))
+        net = self.agent.cache.get_network_by_id('calico')
+        self.assertEqual([], net.ports)
+        self.assertEqual([], net.subnets)
+
+
+class TestCalicoEtcdWatcherBatch(_CalicoEtcdWatcherTestCase):
+    def test_handle_events(self):
+        # A batch of endpoint events on the same network asks for one
+        # Dnsmasq update, at the end of the batch.
+        responses = []
+        for n in range(3):
+            name = make_endpoint_name('endpoint-%d' % n)
+            responses.append(Response(
+                action='set',
+                key=datamodel_v3._build_key(
+                    "WorkloadEndpoint",
+                    datamodel_v3.get_namespace(self.watcher.region_string),
+                    name),
+                value=json.dumps({'spec': {
+                    'interfaceName': 'tap%d' % n,
+                    'mac': 'fe:16:65:12:33:%02d' % n,
+                    'ipNetworks': ['10.28.0.%d/32' % (n + 2)],
+                }}),
+                mod_revision=10 + n))
+        self.watcher.handle_events(responses)
+        self.assertEqual(
+            [mock.call('calico')],
+            self.watcher.dnsmasq_updater.update_network.mock_calls)
+        net = self.agent.cache.get_network_by_id('calico')
+        self.assertEqual(['endpoint-0', 'endpoint-1', 'endpoint-2'],
+                         sorted(p.id for p in net.ports))
+
+        # Outside a batch, each event asks for an update.
+        self.watcher.dnsmasq_updater.reset_mock()
+        self.watcher.on_endpoint_delete(None,
+                                        make_endpoint_name('endpoint-0'))
+        self.assertEqual(
+            [mock.call('calico')],
+            self.watcher.dnsmasq_updater.update_network.mock_calls)
+
+
+class TestCalicoEtcdWatcherWarmRestart(_CalicoEtcdWatcherTestCase):
+    def setUp(self):
+        super(TestCalicoEtcdWatcherWarmRestart, self).setUp()
+        self.state_file = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'state')
+        cfg.CONF.set_override('dhcp_state_file', self.state_file, 'calico')
+        self.watcher.state_file = self.state_file
+        self.snapshot([(1, '10.28.0.2'), (2, '10.28.0.3')])
+        self.watcher._new_revision_hook('1234', 20)
+        self.fingerprints = {'fp1', 'fp2'}
+        self.watcher.dnsmasq_updater.get_port_fingerprints.return_value = (
+            self.fingerprints)
+        with mock.patch('networking_calico.agent.dhcp_agent.'
+                        'get_running_dnsmasq',
+                        return_value=(42, ['dnsmasq', '--a'])):
+            self.watcher._save_state()
+
+    def restart(self, running_dnsmasq):
+        agent = mock.Mock()
+        agent.cache = NetworkCache()
+        self.addCleanup(agent.cache.cleanup_loop.stop)
+        watcher = CalicoEtcdWatcher(agent, socket.gethostname())
+        watcher.mtu_watcher = mock.Mock()
+        watcher.dnsmasq_updater = mock.Mock()
+        with mock.patch('networking_calico.agent.dhcp_agent.'
+                        'get_running_dnsmasq',
+                        return_value=running_dnsmasq):
+            resume_point = watcher._get_resume_point()
+        return agent, watcher, resume_point
+
+    def test_restore(self):
+        agent, watcher, resume_point = self.restart(
+            (42, ['dnsmasq', '--a']))
+        self.assertEqual(('1234', 19), resume_point)
+        net = agent.cache.get_network_by_id('calico')
+        self.assertEqual(['endpoint-1', 'endpoint-2'],
+                         sorted(p.id for p in net.ports))
+        self.assertEqual(['v4subnet-1'], [s.id for s in net.subnets])
+        self.assertEqual({'endpoint-1', 'endpoint-2'},
+                         watcher.local_endpoint_ids)
+
+        # Dnsmasq is kept, and monitored, and then checked for any needed
+        # update.
+        watcher.dnsmasq_updater.adopt.assert_called_once_with(
+            'calico', sorted(self.fingerprints))
+        agent.call_driver.assert_called_once_with('monitor_running_process',
+                                                  net)
+        watcher.dnsmasq_updater.update_network.assert_called_once_with(
+            'calico')
+
+    def test_restore_dnsmasq_changed(self):
+        agent, watcher, resume_point = self.restart(
+            (43, ['dnsmasq', '--b']))
+        self.assertEqual(('1234', 19), resume_point)
+        watcher.dnsmasq_updater.adopt.assert_not_called()
+        agent.call_driver.assert_not_called()
+        watcher.dnsmasq_updater.update_network.assert_called_once_with(
+            'calico')
+
+    def test_restore_part_of_revision(self):
+        # A txn at revision 30 creates endpoints 3 and 4, but the watcher
+        # handles their events in different batches, and our state is saved
+        # in between.
+        def endpoint_event(n, ip, revision):
+            return Response(
+                action='set',
+                key=datamodel_v3._build_key(
+                    "WorkloadEndpoint",
+                    datamodel_v3.get_namespace(self.watcher.region_string),
+                    make_endpoint_name('endpoint-%d' % n)),
+                value=json.dumps({'spec': {
+                    'interfaceName': 'tap%d' % n,
+                    'mac': 'fe:16:65:12:33:%02d' % n,
+                    'ipNetworks': [ip + '/32'],
+                }}),
+                mod_revision=revision)
+
+        self.watcher.handle_events([endpoint_event(3, '10.28.0.4', 30)])
+        self.watcher._new_revision_hook('1234', 30)
+        with mock.patch('networking_calico.agent.dhcp_agent.'
+                        'get_running_dnsmasq',
+                        return_value=(42, ['dnsmasq', '--a'])):
+            self.watcher._save_state()
+
+        # After a restart, the watch starts from revision 30 again, and so
+        # will report endpoint 4.
+        agent, watcher, resume_point = self.restart(
+            (42, ['dnsmasq', '--a']))
+        self.assertEqual(('1234', 29), resume_point)
+        net = agent.cache.get_network_by_id('calico')
+        self.assertEqual(['endpoint-1', 'endpoint-2', 'endpoint-3'],
+                         sorted(p.id for p in net.ports))
+
+    def test_restore_single_instance(self):
+        # Save state with a single Dnsmasq for all networks, whose DHCP port
+        # is in its combined network model.
+        cfg.CONF.set_override('dnsmasq_single_instance', True, 'calico')
+        self.watcher.single_instance = True
+        combined = make_net_model({
+            'id': ALL_NETWORKS_ID,
+            'subnets': [],
+            'ports': [{'id': 'dhcp-port',
+                       'network_id': ALL_NETWORKS_ID,
+                       'device_id': 'dhcp',
+                       'device_owner': 'network:dhcp',
+                       'fixed_ips': []}],
+            'tenant_id': 'calico',
+        })
+        updater = self.watcher.dnsmasq_updater
+        updater.get_single_instance_net.return_value = combined
+        with mock.patch('networking_calico.agent.dhcp_agent.'
+                        'get_running_dnsmasq',
+                        return_value=(50, ['dnsmasq', '--all'])):
+            self.watcher._save_state()
+
+        # The single Dnsmasq is kept, with its DHCP port, and monitored.
+        agent, watcher, resume_point = self.restart(
+            (50, ['dnsmasq', '--all']))
+        self.assertEqual(('1234', 19), resume_point)
+        watcher.dnsmasq_updater.adopt.assert_called_once_with(
+            'calico', sorted(self.fingerprints))
+        (net,), _ = watcher.dnsmasq_updater.adopt_single_instance.call_args
+        self.assertEqual(ALL_NETWORKS_ID, net.id)
+        self.assertEqual(['dhcp-port'], [p.id for p in net.ports])
+        agent.call_driver.assert_called_once_with('monitor_running_process',
+                                                  net)
+        watcher.dnsmasq_updater.update_network.assert_called_once_with(
+            'calico')
+
+        # Not if the single Dnsmasq has changed.
+        agent, watcher, resume_point = self.restart(
+            (51, ['dnsmasq', '--other']))
+        watcher.dnsmasq_updater.adopt.assert_not_called()
+        watcher.dnsmasq_updater.adopt_single_instance.assert_not_called()
+        agent.call_driver.assert_not_called()
+
+    def test_restore_bad_version(self):
+        with open(self.state_file, 'w') as f:
+            json.dump({'version': 0}, f)
+        agent, watcher, resume_point = self.restart(
+            (42, ['dnsmasq', '--a']))
+        self.assertIsNone(resume_point)
+        self.assertEqual([], list(agent.cache.get_network_ids()))
+
+
+def _link_message(msg_type, if_name, mtu=None):
+    """Build an rtnetlink message like those the kernel sends for links."""
+    attrs = b''
+    name = if_name.encode('utf-8') + b'\0'
+    attrs += struct.pack('=HH', 4 + len(name), rtnetlink.IFLA_IFNAME) + name
+    attrs += b'\0' * (-len(attrs) % 4)
+    if mtu is not None:
+        attrs += struct.pack('=HHI', 8, rtnetlink.IFLA_MTU, mtu)
+    body = struct.pack('=BxHiII', 0, 1, 5, 0, 0) + attrs
+    return struct.pack('=IHHII', 16 + len(body), msg_type, 0, 0, 0) + body
+
+
+class TestMTUWatcher(base.BaseTestCase):
+    def setUp(self):
+        super(TestMTUWatcher, self).setUp()
+        self.port_handler = mock.Mock()
+        self.watcher = MTUWatcher(mock.Mock(), self.port_handler)
+
+    def test_parse_link_messages(self):
+        data = (_link_message(rtnetlink.RTM_NEWLINK, 'tap1', 1500) +
+                _link_message(rtnetlink.RTM_NEWLINK, 'eth0') +
+                _link_message(rtnetlink.RTM_DELLINK, 'tap23456789-ab', 1400))
+        self.assertEqual([
+            (rtnetlink.RTM_NEWLINK, 'tap1', 1500),
+            (rtnetlink.RTM_NEWLINK, 'eth0', None),
+            (rtnetlink.RTM_DELLINK, 'tap23456789-ab', 1400),
+        ], list(rtnetlink.parse_link_messages(data)))
+
+    def test_process_data(self):
+        self.watcher.watch_port('port1', 'tap1')
+        self.watcher.process_data(
+            _link_message(rtnetlink.RTM_NEWLINK, 'tap1', 1500) +
+            _link_message(rtnetlink.RTM_NEWLINK, 'tap2', 1450) +
+            _link_message(rtnetlink.RTM_NEWLINK, 'eth0', 9000))
+        self.assertEqual(1500, self.watcher.get_mtu('tap1'))
+        self.assertEqual(1450, self.watcher.get_mtu('tap2'))
+        self.assertIsNone(self.watcher.get_mtu('eth0'))
+        self.port_handler.on_mtu_change.assert_called_once_with('port1',
+                                                                1500)
+
+        # Unchanged MTU is not reported again; a changed one is.
+        self.port_handler.reset_mock()
+        self.watcher.process_data(
+            _link_message(rtnetlink.RTM_NEWLINK, 'tap1', 1500))
+        self.port_handler.on_mtu_change.assert_not_called()
+        self.watcher.process_data(
+            _link_message(rtnetlink.RTM_NEWLINK, 'tap1', 1400))
+        self.port_handler.on_mtu_change.assert_called_once_with('port1',
+                                                                1400)
+
+        # Deleted interfaces are forgotten.
+        self.watcher.process_data(
+            _link_message(rtnetlink.RTM_DELLINK, 'tap2', 1450))
+        self.assertIsNone(self.watcher.get_mtu('tap2'))
+
+    @mock.patch('networking_calico.agent.linux.rtnetlink.open_link_socket')
+    def test_run_reopens_socket(self, m_open):
+        class ExpectedException(Exception):
+            pass
+
+        m_sock = mock.Mock()
+        m_sock.recv.side_effect = [
+            _link_message(rtnetlink.RTM_NEWLINK, 'tap1', 1500),
+            OSError(105, 'No buffer space available'),
+        ]
+        m_open.side_effect = [m_sock, ExpectedException()]
+        self.assertRaises(ExpectedException, self.watcher.run)
+        self.assertEqual(1500, self.watcher.get_mtu('tap1'))
+        m_sock.close.assert_called_once_with()
+
+
+class TestDnsmasqUpdater(base.BaseTestCase):
+    def setUp(self):
+        super(TestDnsmasqUpdater, self).setUp()
+        calico_config.register_options(
+            cfg.CONF, additional_options=calico_config.DHCP_AGENT_OPTS)
+        cfg.CONF.set_override('dnsmasq_update_concurrency', 2, 'calico')
+        self.updater = DnsmasqUpdater(mock.Mock())
+        self.updates = []
+        self.release = {}
+        self.updater.really_update_dnsmasq = self.fake_update
+        self.thread = eventlet.spawn(self.updater.start)
+        self.addCleanup(self.thread.kill)
+
+    def fake_update(self, network_id):
+        self.updates.append(network_id)
+        self.release[network_id] = eventlet.Event()
+        self.release[network_id].wait()
+
+    def run_threads(self):
+        # Let the updater's threads run until they block.
+        for _ in range(10):
+            eventlet.sleep()
+
+    def finish(self, network_id):
+        self.release.pop(network_id).send()
+        self.run_threads()
+
+    def test_parallel_updates(self):
+        for network_id in ['net1', 'net2', 'net3']:
+            self.updater.update_network(network_id)
+        self.run_threads()
+
+        # Two networks are updated concurrently; the third waits for a free
+        # slot.
+        self.assertEqual(['net1', 'net2'], self.updates)
+        self.finish('net2')
+        self.run_threads()
+        self.assertEqual(['net1', 'net2', 'net3'], self.updates)
+        self.finish('net1')
+        self.finish('net3')
+
+    def test_same_network_ordered_and_coalesced(self):
+        self.updater.update_network('net1')
+        self.run_threads()
+        self.assertEqual(['net1'], self.updates)
+
+        # Further updates for net1 wait for the current one, and are
+        # coalesced into a single update.
+        self.updater.update_network('net1')
+        self.updater.update_network('net1')
+        self.updater.update_network('net2')
+        self.run_threads()
+        self.assertEqual(['net1', 'net2'], self.updates)
+        self.finish('net1')
+        self.run_threads()
+        self.assertEqual(['net1', 'net2', 'net1'], self.updates)
+        self.finish('net1')
+        self.finish('net2')
+        self.run_threads()
+        self.assertEqual(['net1', 'net2', 'net1'], self.updates)
+
+
+def _net_with_ports(network_id, cidr, mtu, tap_names):
+    return make_net_model({
+        'id': network_id,
+        'subnets': [{'id': network_id + '-subnet',
+                     'cidr': cidr,
+                     'ip_version': 4,
+                     'enable_dhcp': True}],
+        'ports': [{'id': '%s-%s' % (network_id, tap_name),
+                   'network_id': network_id,
+                   'device_id': tap_name,
+                   'device_owner': 'compute:nova',
+                   'extra_dhcp_opts': [],
+                   'fixed_ips': []}
+                  for tap_name in tap_names],
+        'tenant_id': 'calico',
+        'mtu': mtu,
+    })
+
+
+class TestDnsmasqUpdaterSingleInstance(base.BaseTestCase):
+    def setUp(self):
+        super(TestDnsmasqUpdaterSingleInstance, self).setUp()
+        calico_config.register_options(
+            cfg.CONF, additional_options=calico_config.DHCP_AGENT_OPTS)
+        cfg.CONF.set_override('dnsmasq_single_instance', True, 'calico')
+        self.agent = mock.Mock()
+        self.agent.cache = NetworkCache()
+        self.addCleanup(self.agent.cache.cleanup_loop.stop)
+        self.updater = DnsmasqUpdater(self.agent)
+
+    def update(self, *network_ids):
+        self.agent.call_driver.reset_mock()
+        for network_id in network_ids:
+            self.updater._mark_dirty(network_id)
+        self.assertEqual([ALL_NETWORKS_ID], list(self.updater._dirty_since))
+        self.updater._dirty_since.clear()
+        self.updater.really_update_dnsmasq(ALL_NETWORKS_ID)
+        return self.agent.call_driver.mock_calls
+
+    def test_single_instance(self):
+        self.agent.cache.put(_net_with_ports('net1', '10.1.0.0/24', 1500,
+                                             ['tap1', 'tap2']))
+        self.agent.cache.put(_net_with_ports('net2', '10.2.0.0/24', 1450,
+                                             ['tap3']))
+        calls = self.update('net1', 'net2')
+        self.assertEqual(1, len(calls))
+        action, net = calls[0][1]
+        self.assertEqual('reload_or_restart', action)
+        self.assertEqual(ALL_NETWORKS_ID, net.id)
+        self.assertEqual(['tap1', 'tap2', 'tap3'],
+                         sorted(p.device_id for p in net.ports))
+
+        # No change: no update.
+        self.assertEqual([], self.update('net1'))
+
+        # One network goes away: Dnsmasq is updated for the other.
+        self.agent.cache.put(_net_with_ports('net2', '10.2.0.0/24', 1450,
+                                             []))
+        calls = self.update('net2')
+        action, net = calls[0][1]
+        self.assertEqual('reload_or_restart', action)
+        self.assertEqual(['tap1', 'tap2'],
+                         sorted(p.device_id for p in net.ports))
+        self.assertIsNone(self.agent.cache.get_network_by_id('net2'))
+
+        # No networks left: Dnsmasq is disabled.
+        self.agent.cache.put(_net_with_ports('net1', '10.1.0.0/24', 1500,
+                                             []))
+        calls = self.update('net1')
+        self.assertEqual('disable', calls[0][1][0])
+        self.assertEqual([], list(self.agent.cache.get_network_ids()))
+
+    def test_adopt(self):
+        self.agent.cache.put(_net_with_ports('net1', '10.1.0.0/24', 1500,
+                                             ['tap1']))
+        self.update('net1')
+        fingerprints = self.updater.get_port_fingerprints('net1')
+
+        # After a restart, a new updater adopts the running Dnsmasq, with
+        # the DHCP port that it set up.
+        self.updater = DnsmasqUpdater(self.agent)
+        self.updater.adopt('net1', fingerprints)
+        self.updater.adopt_single_instance(make_net_model({
+            'id': ALL_NETWORKS_ID,
+            'subnets': [],
+            'ports': [{'id': 'dhcp-port',
+                       'network_id': ALL_NETWORKS_ID,
+                       'device_id': 'dhcp',
+                       'device_owner': 'network:dhcp',
+                       'fixed_ips': []}],
+            'tenant_id': 'calico',
+        }))
+        self.assertEqual([], self.update('net1'))
+
+        # The DHCP port is kept when Dnsmasq is next updated.
+        self.agent.cache.put(_net_with_ports('net1', '10.1.0.0/24', 1500,
+                                             ['tap1', 'tap2']))
+        calls = self.update('net1')
+        action, net = calls[0][1]
+        self.assertEqual('reload_or_restart', action)
+        self.assertEqual(['dhcp', 'tap1', 'tap2'],
+                         sorted(p.device_id for p in net.ports))
+
+    def test_combined_network(self):
+        net = combined_network([
+            _net_with_ports('net1', '10.1.0.0/24', 1500, ['tap1']),
+            _net_with_ports('net2', '10.2.0.0/24', 1450, ['tap2']),
+        ])
+        self.assertEqual(0, net.mtu)
+        self.assertEqual({'net1-subnet': 1500, 'net2-subnet': 1450},
+                         dict(net.subnet_mtus))
+
+        # Each subnet is in a segment of its own network, so that it doesn't
+        # get routes to the other network's subnets.
+        self.assertEqual(['net1', 'net2'],
+                         [s.segment_id for s in net.subnets])
+
+
 commonutils = 'neutron.agent.linux.dhcp.commonutils'
 try:
     from neutron.agent.linux.dhcp import commonutils as xxx  # noqa
@@ -449,3 +963,170 @@ class TestDnsmasqRouted(base.BaseTestCase):
             '--interface=tap3',
             '--bridge-interface=ns-dhcp,tap1,tap2,tap3'],
             filtered_args)
+
+    def _reload_or_restart(self, running_cmd, active=True):
+        network = mock.Mock()
+        network.id = 'calico'
+        dhcp_driver = DnsmasqRouted(cfg.CONF,
+                                    network,
+                                    None,
+                                    plugin=FakePlugin())
+        m_pm = mock.Mock()
+        m_pm.active = active
+        m_pm.pid = 42
+        m_pm.get_pid_file_name.return_value = '/run/pid_file'
+        with mock.patch.object(dhcp_driver, '_get_process_manager',
+                               return_value=m_pm), \
+                mock.patch.object(dhcp_driver, '_build_cmdline_callback',
+                                  return_value=['dnsmasq', '',
+                                                '--interface=tap1']), \
+                mock.patch('networking_calico.agent.linux.dhcp.'
+                           '_get_cmdline_from_pid',
+                           return_value=running_cmd) as m_get_cmdline, \
+                mock.patch.object(dhcp_driver, 'reload_allocations') as m_rl, \
+                mock.patch.object(dhcp_driver, 'restart') as m_restart:
+            dhcp_driver.reload_or_restart()
+        if active:
+            m_get_cmdline.assert_called_once_with(42)
+        return m_rl, m_restart
+
+    @mock.patch('neutron.agent.linux.dhcp.DeviceManager')
+    def test_reload_when_cmdline_unchanged(self, device_mgr_cls):
+        m_rl, m_restart = self._reload_or_restart(
+            ['/usr/sbin/dnsmasq', '--interface=tap1', ''])
+        m_rl.assert_called_once_with()
+        self.assertFalse(m_restart.called)
+
+    @mock.patch('neutron.agent.linux.dhcp.DeviceManager')
+    def test_restart_when_cmdline_changed(self, device_mgr_cls):
+        m_rl, m_restart = self._reload_or_restart(
+            ['dnsmasq', '--interface=tap1', '--interface=tap2', ''])
+        m_restart.assert_called_once_with()
+        self.assertFalse(m_rl.called)
+
+    @mock.patch('neutron.agent.linux.dhcp.DeviceManager')
+    def test_restart_when_not_running(self, device_mgr_cls):
+        m_rl, m_restart = self._reload_or_restart(None, active=False)
+        m_restart.assert_called_once_with()
+        self.assertFalse(m_rl.called)
+
+    @mock.patch('neutron.agent.linux.dhcp.DeviceManager')
+    def test_monitor_running_process(self, device_mgr_cls):
+        network = mock.Mock()
+        network.id = 'calico'
+        m_monitor = mock.Mock()
+        dhcp_driver = DnsmasqRouted(cfg.CONF,
+                                    network,
+                                    m_monitor,
+                                    plugin=FakePlugin())
+        m_pm = mock.Mock()
+        with mock.patch.object(dhcp_driver, '_get_process_manager',
+                               return_value=m_pm) as m_get_pm:
+            dhcp_driver.monitor_running_process()
+        m_get_pm.assert_called_once_with(
+            cmd_callback=dhcp_driver._build_cmdline_callback)
+        m_monitor.register.assert_called_once_with(
+            uuid=m_pm.uuid,
+            service_name=dhcp.DNSMASQ_SERVICE_NAME,
+            monitored_process=m_pm)
+
+    @mock.patch('neutron.agent.linux.dhcp.DeviceManager')
+    def test_incremental_config_files(self, device_mgr_cls):
+        conf_dir = self.useFixture(fixtures.TempDir()).path
+        cfg.CONF.set_override('dhcp_confs', conf_dir)
+        # os.makedirs is mocked, so create the network's directory here.
+        os.mkdir(os.path.join(conf_dir, 'calico'))
+
+        def port(n, mtu=None):
+            return {
+                'id': 'port%d' % n,
+                'device_owner': 'calico',
+                'device_id': 'tap%d' % n,
+                'mac_address': '02:00:00:00:00:%02x' % n,
+                'fixed_ips': [{'subnet_id': 'v4subnet-1',
+                               'ip_address': '10.28.0.%d' % n}],
+                'extra_dhcp_opts': [
+                    {'opt_name': 'mtu', 'opt_value': str(mtu),
+                     'ip_version': 4}
+                ] if mtu else [],
+            }
+
+        def make_driver(ports):
+            network = dhcp.NetModel({
+                'id': 'calico',
+                'subnets': [{'id': 'v4subnet-1',
+                             'enable_dhcp': True,
+                             'ip_version': 4,
+                             'cidr': '10.28.0.0/24',
+                             'gateway_ip': '10.28.0.1',
+                             'dns_nameservers': [],
+                             'host_routes': []}],
+                'non_local_subnets': [],
+                'ports': ports,
+                'mtu': 0,
+            })
+            dhcp_driver = DnsmasqRouted(cfg.CONF,
+                                        network,
+                                        None,
+                                        plugin=FakePlugin())
+            dhcp_driver._get_ovn_metadata_port_ip = lambda subnet: None
+            return dhcp_driver
+
+        def read_files(dhcp_driver):
+            files = {}
+            for kind in ['host', 'addn_hosts', 'opts']:
+                with open(dhcp_driver.get_conf_file_name(kind)) as f:
+                    files[kind] = f.read()
+            return files
+
+        # Initial write generates lines for every port, and matches what
+        # Neutron's Dnsmasq driver would write.
+        dhcp_driver = make_driver([port(2, mtu=1400), port(3), port(4)])
+        with mock.patch.object(dhcp_driver, '_generate_port_lines',
+                               wraps=dhcp_driver._generate_port_lines) as gen:
+            dhcp_driver._output_config_files()
+        self.assertEqual(3, gen.call_count)
+        files = read_files(dhcp_driver)
+        self.assertIn('tag:port-port2,option:mtu,1400', files['opts'])
+        dhcp.Dnsmasq._output_config_files(dhcp_driver)
+        self.assertEqual(read_files(dhcp_driver), files)
+
+        # Changing one port only regenerates the lines for that port.
+        dhcp_driver = make_driver([port(2, mtu=1400), port(3, mtu=1450),
+                                   port(4)])
+        with mock.patch.object(dhcp_driver, '_generate_port_lines',
+                               wraps=dhcp_driver._generate_port_lines) as gen:
+            dhcp_driver._output_config_files()
+        self.assertEqual(1, gen.call_count)
+        files = read_files(dhcp_driver)
+        self.assertIn('tag:port-port3,option:mtu,1450', files['opts'])
+        dhcp.Dnsmasq._output_config_files(dhcp_driver)
+        self.assertEqual(read_files(dhcp_driver), files)
+
+        # Removing a port doesn't regenerate anything, but does remove that
+        # port's lines.
+        dhcp_driver = make_driver([port(2, mtu=1400), port(3, mtu=1450)])
+        with mock.patch.object(dhcp_driver, '_generate_port_lines',
+                               wraps=dhcp_driver._generate_port_lines) as gen:
+            dhcp_driver._output_config_files()
+        self.assertEqual(0, gen.call_count)
+        self.assertNotIn('10.28.0.4', read_files(dhcp_driver)['host'])
+
+        # Ports with client IDs, with and without other options, also match
+        # what Neutron's Dnsmasq driver would write.
+        client_id_port = port(5, mtu=1400)
+        client_id_port['extra_dhcp_opts'].append(
+            {'opt_name': 'client-id', 'opt_value': 'cid-5',
+             'ip_version': 4})
+        client_id_only_port = port(6)
+        client_id_only_port['extra_dhcp_opts'].append(
+            {'opt_name': 'client-id', 'opt_value': 'cid-6',
+             'ip_version': 4})
+        dhcp_driver = make_driver([port(2, mtu=1400), client_id_port,
+                                   client_id_only_port])
+        dhcp_driver._output_config_files()
+        files = read_files(dhcp_driver)
+        self.assertIn('id:cid-5', files['host'])
+        self.assertIn('id:cid-6', files['host'])
+        dhcp.Dnsmasq._output_config_files(dhcp_driver)
+        self.assertEqual(read_files(dhcp_driver), files)
@@ -27,6 +27,8 @@ from mock import call
 from mock import Mock
 from mock import patch
 
+from networking_calico.common import config as calico_config
+from networking_calico.compat import cfg
 from networking_calico.etcdutils import _is_string_instance
 from networking_calico.etcdutils import EtcdWatcher
 from networking_calico.etcdutils import PathDispatcher
@@ -188,6 +190,7 @@ def _rsp_to_tuple(rsp):
 class TestEtcdWatcher(unittest.TestCase):
     def setUp(self):
         super(TestEtcdWatcher, self).setUp()
+        calico_config.register_options(cfg.CONF)
         self.m_client = Mock()
         etcdv3._client = self.m_client
         self.watcher = EtcdWatcher("/calico")
@@ -249,6 +252,232 @@ class TestEtcdWatcher(unittest.TestCase):
         self.assertEqual(self.m_dispatcher.handle_event.mock_calls,
                          [call(rsp1)])
 
+    @patch("eventlet.spawn")
+    def test_resume_after_idle_watch(self, m_spawn):
+        # Set up 3 iterations through the watcher's main loop.
+        #
+        # 1. Snapshot at revision 10.  Watch is cancelled owing to
+        #    inactivity.
+        #
+        # 2. Nothing written since revision 10, so watch is resumed without
+        #    a snapshot.  Watch is cancelled owing to inactivity.
+        #
+        # 3. Revision 11 has been compacted, so try to take a new snapshot;
+        #    throw ExpectedException(), to exit.
+        self.m_client.status.side_effect = iter([
+            # Iteration 1.
+            {'header': {'cluster_id': '1234', 'revision': '10'}},
+            # Iteration 2.
+            {'header': {'cluster_id': '1234', 'revision': '10'}},
+            # Iteration 3.
+            {'header': {'cluster_id': '1234', 'revision': '15'}},
+            ExpectedException(),
+        ])
+        self.m_client.get.side_effect = iter([
+            [],
+            etcdv3.Etcd3Exception(
+                '{"error":"etcdserver: mvcc: required revision has been '
+                'compacted"}'),
+        ])
+        self.m_client.watch_prefix.side_effect = lambda *a, **kw: (
+            iter([None]), Mock())
+
+        with patch.object(self.watcher, "_pre_snapshot_hook",
+                          autospec=True) as m_pre:
+            m_pre.return_value = None
+            with patch.object(self.watcher, "_post_snapshot_hook",
+                              autospec=True) as m_post:
+                self.assertRaises(ExpectedException, self.watcher.start)
+
+        # Only one snapshot.
+        self.assertEqual(m_pre.mock_calls, [call()])
+        self.assertEqual(m_post.mock_calls, [call(None)])
+
+        # Watch created, and then resumed, from the same revision.
+        self.assertEqual(self.m_client.watch_prefix.mock_calls, [
+            call('/calico', start_revision='11'),
+            call('/calico', start_revision='11')
+        ])
+
+        # Compaction checked at the first unseen revision.
+        self.assertEqual(self.m_client.get.mock_calls[1],
+                         call('/calico', count_only=True, revision='11'))
+
+    def test_resume_from_saved_revision(self):
+        # The watcher starts with data as at revision 10 of cluster 1234,
+        # which hasn't been compacted, so it resumes watching from there
+        # without a snapshot.
+        self.m_client.status.side_effect = iter([
+            {'header': {'cluster_id': '1234', 'revision': '12'}},
+            ExpectedException(),
+        ])
+        self.m_client.get.side_effect = iter([[]])
+        self.m_client.watch_prefix.side_effect = etcdv3.KeyNotFound()
+
+        with patch.object(self.watcher, "_get_resume_point",
+                          autospec=True) as m_resume:
+            m_resume.return_value = ('1234', 10)
+            with patch.object(self.watcher, "_pre_snapshot_hook",
+                              autospec=True) as m_pre:
+                self.assertRaises(ExpectedException, self.watcher.start)
+
+        self.assertEqual(m_pre.mock_calls, [])
+        self.assertEqual(self.m_client.watch_prefix.mock_calls, [
+            call('/calico', start_revision='11'),
+        ])
+
+    def test_new_revision_hook(self):
+        status = {'header': {'cluster_id': '1234', 'revision': '10'}}
+        self.m_client.status.side_effect = iter([status, ExpectedException()])
+        self.m_client.get.side_effect = iter([[]])
+        self.m_client.watch_prefix.side_effect = etcdv3.KeyNotFound()
+
+        with patch.object(self.watcher, "_new_revision_hook",
+                          autospec=True) as m_hook:
+            self.assertRaises(ExpectedException, self.watcher.start)
+
+        # Called with the snapshot's revision, after the snapshot.
+        self.assertEqual(m_hook.mock_calls, [call('1234', 10)])
+
+    def test_progress_notifications(self):
+        self.watcher = EtcdWatcher("/calico", progress_notify_interval=30)
+        self.watcher.dispatcher = self.m_dispatcher
+        self.assertEqual(60, self.watcher.watch_timeout)
+        status = {'header': {'cluster_id': '1234', 'revision': '10'}}
+        self.m_client.status.side_effect = iter([status, ExpectedException()])
+        self.m_client.get.side_effect = iter([[]])
+
+        def events():
+            yield {'type': 'PROGRESS', 'header': {'revision': '15'}}
+
+        with patch.object(etcdv3, "watch_subtree",
+                          autospec=True) as m_watch:
+            m_watch.return_value = (events(), Mock())
+            with patch.object(self.watcher, "_new_revision_hook",
+                              autospec=True) as m_hook:
+                self.assertRaises(ExpectedException, self.watcher.start)
+
+        # The watch asks for progress notifications, and a notification
+        # advances the last known revision without any dispatch.
+        self.assertEqual(m_watch.mock_calls, [
+            call('/calico', '11', progress_notify=True),
+        ])
+        self.assertEqual(m_hook.mock_calls, [call('1234', 10),
+                                             call('1234', 15)])
+        self.assertEqual(self.m_dispatcher.handle_event.mock_calls, [])
+
+    def test_watch_cancelled(self):
+        # The first watch is cancelled by etcd because of compaction, so the
+        # watcher takes a new snapshot straightaway, without trying to resume.
+        status = {'header': {'cluster_id': '1234', 'revision': '10'}}
+        self.m_client.status.side_effect = iter([status, status])
+        self.m_client.get.side_effect = iter([[], ExpectedException()])
+        m_cancel = Mock()
+        self.m_client.watch_prefix.return_value = (
+            iter([{'type': 'CANCELED', 'compact_revision': '12'}]), m_cancel)
+
+        with patch.object(self.watcher, "_pre_snapshot_hook",
+                          autospec=True) as m_pre:
+            self.assertRaises(ExpectedException, self.watcher.start)
+
+        self.assertEqual(m_pre.mock_calls, [call(), call()])
+        m_cancel.assert_called_once_with()
+        self.assertEqual(1, self.watcher.watch_cancellations)
+
+    def test_snapshot_changes_only(self):
+        self.watcher = EtcdWatcher("/calico", snapshot_changes_only=True)
+        self.watcher.dispatcher = self.m_dispatcher
+
+        # Set up 3 iterations through the watcher's main loop.
+        #
+        # 1. Snapshot with foo and bar.  Watch reports a change to foo.
+        #
+        # 2. Snapshot with the changed foo, bar and a new baz.  Watch
+        #    reports nothing.
+        #
+        # 3. Snapshot with only foo.
+        status = {'header': {'cluster_id': '1234', 'revision': '20'}}
+        self.m_client.status.side_effect = iter([
+            status, status, status, ExpectedException()])
+        foo1 = Response(action='set', key='/calico/foo', value='1',
+                        mod_revision='12')
+        foo2 = Response(action='set', key='/calico/foo', value='2',
+                        mod_revision='13')
+        bar = Response(action='set', key='/calico/bar', value='3',
+                       mod_revision='12')
+        baz = Response(action='set', key='/calico/baz', value='4',
+                       mod_revision='14')
+        self.m_client.get.side_effect = iter([
+            [_rsp_to_tuple(foo1), _rsp_to_tuple(bar)],
+            [_rsp_to_tuple(foo2), _rsp_to_tuple(bar), _rsp_to_tuple(baz)],
+            [_rsp_to_tuple(foo2)],
+        ])
+
+        def events():
+            yield {'kv': {'key': b'/calico/foo', 'value': b'2',
+                          'mod_revision': '13'}}
+
+        with patch.object(etcdv3, "watch_subtree",
+                          autospec=True) as m_watch:
+            m_watch.side_effect = iter([(events(), Mock()),
+                                        (iter([]), Mock())])
+            self.assertRaises(ExpectedException, self.watcher.start)
+
+        # After the first snapshot, only changes are dispatched, including
+        # deletes for the keys that have gone.
+        self.assertEqual(self.m_dispatcher.handle_event.mock_calls, [
+            call(foo1),
+            call(bar),
+            call(foo2._replace(mod_revision=13)),
+            call(baz),
+            call(Response(action='delete', key='/calico/bar', value='',
+                          mod_revision=20)),
+            call(Response(action='delete', key='/calico/baz', value='',
+                          mod_revision=20)),
+        ])
+
+    @patch("networking_calico.etcdutils.EVENT_QUEUE_SIZE", 2)
+    def test_event_batches(self):
+        status = {'header': {'cluster_id': '1234', 'revision': '10'}}
+        self.m_client.status.side_effect = iter([status, ExpectedException()])
+        self.m_client.get.side_effect = iter([[]])
+
+        def events():
+            for i in range(3):
+                yield {'kv': {'key': b'/calico/k%d' % i, 'value': b'v',
+                              'mod_revision': str(11 + i)}}
+
+        with patch.object(etcdv3, "watch_subtree",
+                          autospec=True) as m_watch:
+            m_watch.return_value = (events(), Mock())
+            with patch.object(self.watcher, "handle_events",
+                              autospec=True) as m_handle:
+                with patch.object(self.watcher, "_new_revision_hook",
+                                  autospec=True) as m_hook:
+                    self.assertRaises(ExpectedException, self.watcher.start)
+
+        # The first two events fill the queue, so the reader waits and the
+        # handler gets them together; then the third event on its own.
+        def rsp(i):
+            return Response(action='set', key='/calico/k%d' % i, value='v',
+                            mod_revision=11 + i)
+        self.assertEqual(m_handle.mock_calls, [call([rsp(0), rsp(1)]),
+                                               call([rsp(2)])])
+        self.assertEqual(m_hook.mock_calls, [call('1234', 10),
+                                             call('1234', 12),
+                                             call('1234', 13)])
+        self.assertEqual(1, self.watcher.event_queue_full_waits)
+        self.assertEqual(2, self.watcher.event_queue_max_depth)
+
+    def test_handle_events(self):
+        rsp1 = Response(action='set', key='foo', value='bar',
+                        mod_revision=12)
+        rsp2 = Response(action='delete', key='foo', value='',
+                        mod_revision=13)
+        self.watcher.handle_events([rsp1, rsp2])
+        self.assertEqual(self.m_dispatcher.handle_event.mock_calls,
+                         [call(rsp1), call(rsp2)])
+
     def test_register(self):
         self.watcher.register_path("key", foo="bar")
         self.assertEqual(self.m_dispatcher.register.mock_calls,
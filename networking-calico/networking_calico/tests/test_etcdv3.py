@@ -12,8 +12,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import eventlet
+import json
 import logging
 import mock
+import socket
+import threading
 
 from neutron.tests import base
 
@@ -21,6 +25,9 @@ from networking_calico.compat import log
 from networking_calico import etcdv3
 
 from etcd3gw.exceptions import Etcd3Exception
+from etcd3gw.exceptions import WatchTimedOut
+from etcd3gw.utils import _decode
+from etcd3gw.utils import _encode
 
 
 LOG = logging.getLogger(__name__)
@@ -49,3 +56,378 @@ class TestEtcdv3(base.BaseTestCase):
                 e3e,
                 'from test_exception_detail_logging'
             )
+
+    @mock.patch.object(etcdv3, 'TXN_OPS_LIMIT', 2)
+    def test_put_many(self):
+        m_client = etcdv3._client = mock.Mock()
+        self.addCleanup(setattr, etcdv3, '_client', None)
+        m_client.transaction.side_effect = [
+            {'succeeded': True, 'responses': [
+                {'response_txn': {'succeeded': True}},
+                {'response_txn': {}},
+            ]},
+            {'succeeded': True, 'responses': [
+                {'response_txn': {'succeeded': True}},
+            ]},
+        ]
+
+        results = etcdv3.put_many([
+            {'key': '/a', 'value': 'A', 'mod_revision': 0},
+            {'key': '/b', 'value': 'B', 'mod_revision': '12'},
+            {'key': '/c', 'value': 'C'},
+        ])
+
+        self.assertEqual({'/a': True, '/b': False, '/c': True}, results)
+        self.assertEqual(2, len(m_client.transaction.mock_calls))
+        first_txn = m_client.transaction.mock_calls[0][1][0]
+        self.assertEqual([], first_txn['compare'])
+        self.assertEqual(
+            [etcdv3._put_txn('/a', 'A', mod_revision=0),
+             etcdv3._put_txn('/b', 'B', mod_revision='12')],
+            [op['request_txn'] for op in first_txn['success']])
+
+    def test_delete_many(self):
+        m_client = etcdv3._client = mock.Mock()
+        self.addCleanup(setattr, etcdv3, '_client', None)
+        m_client.transaction.return_value = {
+            'succeeded': True, 'responses': [
+                {'response_txn': {'succeeded': True}},
+                {'response_txn': {'succeeded': True}},
+            ]
+        }
+
+        results = etcdv3.delete_many([
+            {'key': '/a', 'mod_revision': '3'},
+            {'key': '/b', 'existing_value': 'B'},
+        ])
+
+        self.assertEqual({'/a': True, '/b': True}, results)
+        txn = m_client.transaction.mock_calls[0][1][0]
+        self.assertEqual(
+            [etcdv3._delete_txn('/a', mod_revision='3'),
+             etcdv3._delete_txn('/b', existing_value='B')],
+            [op['request_txn'] for op in txn['success']])
+
+    def _fake_client(self, data):
+        m_client = etcdv3._client = mock.Mock()
+        self.addCleanup(setattr, etcdv3, '_client', None)
+
+        def get(key, metadata=True, range_end=None, sort_order=None,
+                limit=None, revision=None):
+            self.assertEqual('5', revision)
+            range_end = _decode(range_end).decode()
+            keys = sorted((k for k in data if key <= k < range_end),
+                          reverse=(sort_order == 'descend'))[:limit]
+            return [(data[k].encode(), {'key': k.encode(),
+                                        'mod_revision': '4'})
+                    for k in keys]
+
+        def post(url, json=None):
+            self.assertTrue(json['count_only'])
+            key = _decode(json['key']).decode()
+            range_end = _decode(json['range_end']).decode()
+            return {'count': str(len([k for k in data
+                                      if key <= k < range_end]))}
+
+        m_client.get.side_effect = get
+        m_client.post.side_effect = post
+        return m_client
+
+    @mock.patch.object(etcdv3, 'CHUNK_SIZE_LIMIT', 2)
+    @mock.patch.object(etcdv3, '_read_parallelism', 3)
+    def test_get_prefix_parallel(self):
+        data = dict(('/p/%s%d' % (host, i), 'v') for host in 'abcxyz'
+                    for i in range(3))
+        m_client = self._fake_client(data)
+
+        results = etcdv3.get_prefix('/p/', revision=5)
+
+        self.assertEqual(sorted(data.keys(), reverse=True),
+                         [key for key, _, _ in results])
+        # A bucket for each character from 'a' to 'z' is counted.
+        self.assertEqual(26, len(m_client.post.mock_calls))
+        # The keys are read in 3 ranges of 6 keys each, each needing 2 chunked
+        # reads with limits 2 and then CHUNK_SIZE_MIN, in addition to the 2
+        # reads to find the first and last keys.
+        self.assertEqual(8, len(m_client.get.mock_calls))
+
+    @mock.patch.object(etcdv3, '_read_parallelism', 2)
+    def test_get_prefix_parallel_digits_and_letters(self):
+        # Host names starting with digits and with letters span '0' to 'z'.
+        data = dict(('/p/%s-host' % host, 'v')
+                    for host in ('0a', '1b', '9c', 'ab', 'kx', 'zz'))
+        m_client = self._fake_client(data)
+
+        results = etcdv3.get_prefix('/p/', revision=5)
+
+        self.assertEqual(sorted(data.keys(), reverse=True),
+                         [key for key, _, _ in results])
+        # The range is still partitioned: a bucket is counted for each
+        # character from '0' to 'z'.
+        self.assertEqual(ord('z') - ord('0') + 1,
+                         len(m_client.post.mock_calls))
+
+    @mock.patch.object(etcdv3, '_read_chunk_bytes', 20000)
+    def test_iter_prefix_adaptive_chunks(self):
+        m_client = etcdv3._client = mock.Mock()
+        self.addCleanup(setattr, etcdv3, '_client', None)
+        # 30 keys with small values, and then 400 keys with large values.
+        data = dict(('/p/a%03d' % i, 'v') for i in range(30))
+        data.update(('/p/b%03d' % i, 'v' * 300) for i in range(400))
+
+        def get(key, metadata=True, range_end=None, sort_order=None,
+                limit=None, revision=None):
+            self.assertEqual('ascend', sort_order)
+            range_end = _decode(range_end).decode()
+            keys = sorted(k for k in data if key <= k < range_end)[:limit]
+            return [(data[k].encode(), {'key': k.encode(),
+                                        'mod_revision': '4'})
+                    for k in keys]
+
+        m_client.get.side_effect = get
+
+        results = list(etcdv3.iter_prefix('/p/', revision=5))
+
+        self.assertEqual(sorted(data.keys()), [key for key, _, _ in results])
+        limits = [c[2]['limit'] for c in m_client.get.mock_calls]
+        # The first chunk uses the default limit; after that the limit shrinks
+        # so that each chunk is about 20000 bytes, i.e. about 40 of the large
+        # values (each of which is about 500 bytes when encoded).
+        self.assertEqual(etcdv3.CHUNK_SIZE_LIMIT, limits[0])
+        self.assertEqual([44, 39, 39, 39, 39, 39], limits[1:])
+
+
+class TestWatchStream(base.BaseTestCase):
+
+    def test_requests_while_reading(self):
+        # A server that answers each chunk of the request body as it
+        # arrives, so a second request can only be answered if it is sent
+        # after reading the response to the first.
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        headers = []
+
+        def serve():
+            conn, _ = server.accept()
+            rfile = conn.makefile('rb')
+            for line in iter(rfile.readline, b'\r\n'):
+                headers.append(line.decode().strip())
+            conn.sendall(b'HTTP/1.1 200 OK\r\n'
+                         b'Transfer-Encoding: chunked\r\n\r\n')
+            for size in iter(rfile.readline, b''):
+                data = rfile.read(int(size, 16))
+                rfile.readline()
+                line = json.dumps({'result': json.loads(data)}) + '\n'
+                conn.sendall(b'%x\r\n%s\r\n' % (len(line), line.encode()))
+            conn.close()
+
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        client = mock.Mock()
+        client.get_url.return_value = (
+            'http://127.0.0.1:%d/v3/watch' % server.getsockname()[1])
+        client.session.headers = {'Authorization': 'token'}
+
+        stream = etcdv3._WatchStream(client)
+        self.addCleanup(stream.close)
+        stream.send({'create_request': {'key': 'a'}})
+        lines = stream.iter_lines()
+        self.assertEqual({'result': {'create_request': {'key': 'a'}}},
+                         json.loads(next(lines)))
+        stream.send({'create_request': {'key': 'b'}})
+        self.assertEqual({'result': {'create_request': {'key': 'b'}}},
+                         json.loads(next(lines)))
+        self.assertIn('POST /v3/watch HTTP/1.1', headers)
+        self.assertIn('Authorization: token', headers)
+        self.assertIn('Transfer-Encoding: chunked', headers)
+
+
+class _FakeWatchStream(object):
+    """Open /watch stream, with response lines fed by the test."""
+
+    def __init__(self, client):
+        self.requests = []
+        self.lines = eventlet.queue.LightQueue()
+
+    def send(self, request):
+        self.requests.append(request)
+
+    def feed(self, result):
+        self.lines.put(json.dumps({'result': result}).encode())
+
+    def iter_lines(self):
+        while True:
+            line = self.lines.get()
+            if line is None:
+                return
+            yield line
+
+    def close(self):
+        self.lines.put(None)
+
+
+class TestWatchMultiplexer(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestWatchMultiplexer, self).setUp()
+        self.client = mock.Mock()
+        self.streams = []
+
+        def open_stream(client):
+            self.assertIs(self.client, client)
+            self.streams.append(_FakeWatchStream(client))
+            return self.streams[-1]
+
+        p = mock.patch.object(etcdv3, '_WatchStream', side_effect=open_stream)
+        p.start()
+        self.addCleanup(p.stop)
+        self.mux = etcdv3.WatchMultiplexer(self.client)
+
+    def event(self, key, revision):
+        return {'kv': {'key': _encode(key),
+                       'value': _encode('v'),
+                       'mod_revision': str(revision)}}
+
+    def next_event(self, event_stream):
+        event = next(event_stream)
+        return event['kv']['key'].decode(), event['kv']['mod_revision']
+
+    def test_shared_stream(self):
+        stream_a, cancel_a = self.mux.watch('/a/', '/a0', '5')
+        stream = self.streams[-1]
+        stream.feed({'created': True})
+        stream.feed({'events': [self.event('/a/x', 6)]})
+        eventlet.sleep()
+        self.assertEqual(('/a/x', '6'), self.next_event(stream_a))
+
+        # Events are demultiplexed by watch ID; etcd omits watch ID 0.
+        stream_b, cancel_b = self.mux.watch('/b/', '/b0', '3')
+        stream.feed({'created': True, 'watch_id': '1'})
+        stream.feed({'watch_id': '1', 'events': [self.event('/b/y', 8)]})
+        stream.feed({'events': [self.event('/a/z', 9)]})
+        eventlet.sleep()
+        self.assertEqual(('/b/y', '8'), self.next_event(stream_b))
+        self.assertEqual(('/a/z', '9'), self.next_event(stream_a))
+
+        # A watch that etcd cancels ends, with an event saying why, without
+        # affecting the other.
+        stream.feed({'watch_id': '1', 'canceled': True,
+                     'compact_revision': '10'})
+        eventlet.sleep()
+        self.assertEqual([{'type': 'CANCELED', 'compact_revision': '10'}],
+                         list(stream_b))
+        stream.feed({'events': [self.event('/a/w', 11)]})
+        eventlet.sleep()
+        self.assertEqual(('/a/w', '11'), self.next_event(stream_a))
+
+        # When the stream fails, all the watches end.
+        stream.close()
+        eventlet.sleep()
+        self.assertEqual([], list(stream_a))
+
+    def test_add_leaves_existing_watches(self):
+        stream_a, cancel_a = self.mux.watch('/a/', '/a0', '5')
+        stream = self.streams[-1]
+        stream.feed({'created': True})
+        eventlet.sleep()
+
+        # Adding a watch sends just its create request on the open stream,
+        # without recreating watch A.
+        stream_b, cancel_b = self.mux.watch('/b/', '/b0', '3')
+        self.assertEqual(1, len(self.streams))
+        self.assertEqual(
+            [{'create_request': {'key': _encode('/a/'),
+                                 'range_end': _encode('/a0'),
+                                 'start_revision': '5'}},
+             {'create_request': {'key': _encode('/b/'),
+                                 'range_end': _encode('/b0'),
+                                 'start_revision': '3'}}],
+            stream.requests)
+        stream.feed({'created': True, 'watch_id': '1'})
+        stream.feed({'events': [self.event('/a/x', 6)]})
+        eventlet.sleep()
+        self.assertEqual(('/a/x', '6'), self.next_event(stream_a))
+
+        # Removing a watch cancels just that watch.
+        cancel_b()
+        self.assertEqual([], list(stream_b))
+        self.assertEqual({'cancel_request': {'watch_id': '1'}},
+                         stream.requests[-1])
+        stream.feed({'watch_id': '1', 'canceled': True})
+        stream.feed({'events': [self.event('/a/y', 7)]})
+        eventlet.sleep()
+        self.assertEqual(('/a/y', '7'), self.next_event(stream_a))
+        self.assertEqual(3, len(stream.requests))
+        self.assertEqual(1, len(self.streams))
+
+    def test_remove_before_created(self):
+        stream_a, cancel_a = self.mux.watch('/a/', '/a0', '5')
+        stream_b, cancel_b = self.mux.watch('/b/', '/b0', '3')
+        stream = self.streams[-1]
+
+        # Watch B is cancelled once etcd tells us its watch ID.
+        cancel_b()
+        self.assertEqual(2, len(stream.requests))
+        stream.feed({'created': True})
+        stream.feed({'created': True, 'watch_id': '1'})
+        stream.feed({'watch_id': '1', 'events': [self.event('/b/y', 8)]})
+        stream.feed({'events': [self.event('/a/x', 9)]})
+        eventlet.sleep()
+        self.assertEqual({'cancel_request': {'watch_id': '1'}},
+                         stream.requests[-1])
+        self.assertEqual([], list(stream_b))
+        self.assertEqual(('/a/x', '9'), self.next_event(stream_a))
+
+    def test_watch_once(self):
+        stream_a, cancel_a = self.mux.watch('/a/', '/a0', '5')
+        stream = self.streams[-1]
+        stream.feed({'created': True})
+
+        def feed_event():
+            stream.feed({'created': True, 'watch_id': '1'})
+            stream.feed({'watch_id': '1',
+                         'events': [self.event('/k', 7)]})
+
+        eventlet.spawn_after(0.01, feed_event)
+        event = self.mux.watch_once('/k', timeout=1, start_revision=6)
+        self.assertEqual(b'/k', event['kv']['key'])
+        self.assertRaises(WatchTimedOut,
+                          self.mux.watch_once, '/k',
+                          timeout=0.01, start_revision=8)
+
+        # Cancelling the last watch closes the stream.
+        cancel_a()
+        self.assertEqual([], list(stream_a))
+        self.assertIsNone(self.mux._stream)
+
+    def test_progress_notify(self):
+        stream_a, cancel_a = self.mux.watch('/a/', '/a0', '5',
+                                            progress_notify=True)
+        stream = self.streams[-1]
+        self.assertTrue(
+            stream.requests[0]['create_request']['progress_notify'])
+        stream.feed({'created': True, 'header': {'revision': '5'}})
+        stream.feed({'header': {'revision': '9'}})
+        eventlet.sleep()
+        self.assertEqual({'type': 'PROGRESS', 'header': {'revision': '9'}},
+                         next(stream_a))
+
+    def test_compacted_without_canceled(self):
+        # etcd can report a compacted start revision with compact_revision
+        # but no 'canceled' field, and then sends nothing more for that
+        # watch.
+        stream_a, cancel_a = self.mux.watch('/a/', '/a0', '5',
+                                            progress_notify=True)
+        stream = self.streams[-1]
+        stream.feed({'created': True, 'header': {'revision': '33'}})
+        # (A result without a header revision is not a progress
+        # notification.)
+        stream.feed({'header': {'raft_term': '2'}})
+        stream.feed({'header': {'raft_term': '2'},
+                     'compact_revision': '32'})
+        eventlet.sleep()
+        self.assertEqual([{'type': 'CANCELED', 'compact_revision': '32'}],
+                         list(stream_a))
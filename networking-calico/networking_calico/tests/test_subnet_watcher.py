@@ -12,22 +12,36 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from collections import namedtuple
+import eventlet
+import json
 import logging
 import mock
+import time
 
 from neutron.tests import base
 
 from networking_calico.agent.dhcp_agent import SubnetWatcher
+from networking_calico.common import config as calico_config
+from networking_calico.compat import cfg
 from networking_calico.etcdutils import EtcdWatcher
+from networking_calico import etcdv3
 
 from etcd3gw.exceptions import Etcd3Exception
 
 
 LOG = logging.getLogger(__name__)
 
+EtcdResponse = namedtuple('EtcdResponse', ['value'])
+
 
 class TestSubnetWatcher(base.BaseTestCase):
 
+    def setUp(self):
+        super(TestSubnetWatcher, self).setUp()
+        calico_config.register_options(
+            cfg.CONF, additional_options=calico_config.DHCP_AGENT_OPTS)
+
     @mock.patch.object(EtcdWatcher, 'start')
     def test_exception_detail_logging(self, loop_fn):
 
@@ -50,3 +64,152 @@ class TestSubnetWatcher(base.BaseTestCase):
                 "Etcd3Exception in SubnetWatcher.start():\n%s",
                 'from test_exception_detail'
             )
+
+    def test_get_subnet_id_for_addr(self):
+        sw = SubnetWatcher(mock.Mock(), "/calico")
+
+        def set_subnet(subnet_id, cidr, network_id):
+            sw.on_subnet_set(EtcdResponse(value=json.dumps({
+                'cidr': cidr,
+                'gateway_ip': cidr.split('/')[0],
+                'network_id': network_id,
+            })), subnet_id)
+
+        set_subnet('wide', '10.0.0.0/8', 'net1')
+        set_subnet('narrow', '10.28.0.0/24', 'net2')
+        set_subnet('v6', '2001:db8:1::/64', 'net1')
+
+        # Longest prefix match across all networks.
+        self.assertEqual('narrow', sw.get_subnet_id_for_addr('10.28.0.3',
+                                                             None))
+        self.assertEqual('wide', sw.get_subnet_id_for_addr('10.29.0.3',
+                                                           None))
+        self.assertEqual('v6', sw.get_subnet_id_for_addr('2001:db8:1::3',
+                                                         None))
+        self.assertIsNone(sw.get_subnet_id_for_addr('11.0.0.1', None))
+
+        # Restricted to a given network.
+        self.assertEqual('wide', sw.get_subnet_id_for_addr('10.28.0.3',
+                                                           'net1'))
+        self.assertEqual('narrow', sw.get_subnet_id_for_addr('10.28.0.3',
+                                                             'net2'))
+        self.assertIsNone(sw.get_subnet_id_for_addr('10.29.0.3', 'net2'))
+        self.assertIsNone(sw.get_subnet_id_for_addr('10.28.0.3', 'net3'))
+
+        # Changing a subnet's CIDR moves it in the index.
+        set_subnet('narrow', '10.29.0.0/24', 'net2')
+        self.assertEqual('wide', sw.get_subnet_id_for_addr('10.28.0.3',
+                                                           None))
+        self.assertEqual('narrow', sw.get_subnet_id_for_addr('10.29.0.3',
+                                                             None))
+
+        # Deleting a subnet removes it from the index.
+        sw.on_subnet_del(EtcdResponse(value=None), 'narrow')
+        self.assertEqual('wide', sw.get_subnet_id_for_addr('10.29.0.3',
+                                                           None))
+        self.assertIsNone(sw.get_subnet_id_for_addr('10.29.0.3', 'net2'))
+        self.assertNotIn('net2', sw.cidr_index_by_network_id)
+
+    @mock.patch.object(etcdv3, 'get_prefix')
+    @mock.patch.object(etcdv3, 'get')
+    def test_on_demand(self, m_get, m_get_prefix):
+        cfg.CONF.set_override('subnets_on_demand', True, 'calico')
+        sw = SubnetWatcher(mock.Mock(), "/calico")
+
+        def subnet_json(cidr, network_id):
+            return json.dumps({'cidr': cidr,
+                               'gateway_ip': cidr.split('/')[0],
+                               'network_id': network_id})
+
+        # Looking up an address reads the subnet tree once, and keeps only
+        # the subnets for the relevant network.
+        m_get_prefix.return_value = [
+            ('/calico/s2', subnet_json('10.2.0.0/16', 'net2'), '5'),
+            ('/calico/s1', subnet_json('10.1.0.0/16', 'net1'), '4'),
+        ]
+        self.assertEqual('s1', sw.get_subnet_id_for_addr('10.1.0.1', 'net1'))
+        self.assertEqual(['s1'], list(sw.subnets_by_id))
+        self.assertEqual('s1', sw.get_subnet_id_for_addr('10.1.0.2', 'net1'))
+        self.assertEqual(1, m_get_prefix.call_count)
+
+        # Getting an unknown subnet does a targeted read of that subnet...
+        m_get.return_value = (subnet_json('10.3.0.0/16', 'net3'), '6')
+        self.assertEqual('10.3.0.0/16', sw.get_subnet('s3').cidr)
+        m_get.assert_called_once_with('/calico/s3')
+
+        # ...which is remembered, even when the subnet doesn't exist.
+        m_get.reset_mock()
+        m_get.side_effect = etcdv3.KeyNotFound()
+        self.assertIsNone(sw.get_subnet('s4'))
+        self.assertIsNone(sw.get_subnet('s4'))
+        m_get.assert_called_once_with('/calico/s4')
+
+    @mock.patch.object(etcdv3, 'get_prefix')
+    @mock.patch.object(etcdv3, 'get')
+    def test_on_demand_shared_tree_read(self, m_get, m_get_prefix):
+        cfg.CONF.set_override('subnets_on_demand', True, 'calico')
+        sw = SubnetWatcher(mock.Mock(), "/calico")
+
+        def subnet_json(cidr, network_id=None):
+            data = {'cidr': cidr, 'gateway_ip': cidr.split('/')[0]}
+            if network_id:
+                data['network_id'] = network_id
+            return json.dumps(data)
+
+        m_get_prefix.return_value = [
+            ('/calico/s3', subnet_json('10.3.0.0/16'), '6'),
+            ('/calico/s2', subnet_json('10.2.0.0/16', 'net2'), '5'),
+            ('/calico/s1', subnet_json('10.1.0.0/16', 'net1'), '4'),
+        ]
+        self.assertEqual('s1', sw.get_subnet_id_for_addr('10.1.0.1', 'net1'))
+        self.assertEqual(['s1'], list(sw.subnets_by_id))
+
+        # Another network's subnets are read individually, without reading
+        # the whole tree again.
+        m_get.return_value = (subnet_json('10.2.0.0/16', 'net2'), '5')
+        self.assertEqual('s2', sw.get_subnet_id_for_addr('10.2.0.1', 'net2'))
+        m_get.assert_called_once_with('/calico/s2')
+
+        # No network ID means the subnets without a network ID.
+        m_get.reset_mock()
+        m_get.return_value = (subnet_json('10.3.0.0/16'), '6')
+        self.assertEqual('s3', sw.get_subnet_id_for_addr('10.3.0.1', None))
+        m_get.assert_called_once_with('/calico/s3')
+        self.assertEqual(1, m_get_prefix.call_count)
+
+        # A subnet created since the tree was read is found by reading the
+        # tree again...
+        now = time.time()
+        m_get_prefix.return_value = m_get_prefix.return_value + [
+            ('/calico/s5', subnet_json('10.5.0.0/16', 'net5'), '7'),
+        ]
+        with mock.patch('time.time', return_value=now + 2):
+            self.assertEqual('s5', sw.get_subnet_id_for_addr('10.5.0.1',
+                                                             'net5'))
+        self.assertEqual(2, m_get_prefix.call_count)
+
+        # ...but a miss reads the tree at most once per reread interval.
+        with mock.patch('time.time', return_value=now + 2.5):
+            self.assertIsNone(sw.get_subnet_id_for_addr('10.6.0.1', 'net6'))
+        self.assertEqual(2, m_get_prefix.call_count)
+        with mock.patch('time.time', return_value=now + 4):
+            self.assertIsNone(sw.get_subnet_id_for_addr('10.6.0.2', 'net6'))
+        self.assertEqual(3, m_get_prefix.call_count)
+
+    def test_on_demand_single_flight(self):
+        cfg.CONF.set_override('subnets_on_demand', True, 'calico')
+        sw = SubnetWatcher(mock.Mock(), "/calico")
+        release = eventlet.Event()
+        reads = []
+
+        def read():
+            reads.append(1)
+            release.wait()
+
+        threads = [eventlet.spawn(sw._read_once, 'x', read)
+                   for _ in range(3)]
+        eventlet.sleep()
+        release.send()
+        for thread in threads:
+            thread.wait()
+        self.assertEqual(1, len(reads))